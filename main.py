@@ -6,16 +6,1397 @@ import json
 import os
 import zipfile
 import shutil
+import queue
+import collections
+import asyncio
+import functools
+import subprocess
+import contextvars
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from datetime import datetime
 import requests
 # 导入用于处理Markdown的库
 import re
 
+# 上下文滚动摘要消息的前缀（该消息固定位于系统提示词之后）
+CONTEXT_SUMMARY_PREFIX = "【此前对话摘要】"
+
+# 当前协程/线程正在处理的对话（未设置时使用主窗口的对话）
+ACTIVE_CONVERSATION = contextvars.ContextVar("active_conversation", default=None)
+
+# 可单独设置模型路由的请求阶段
+STAGE_TITLES = {
+    "chat": "对话回复",
+    "assessment": "记忆需求评估",
+    "memory_evaluation": "记忆整理评估",
+    "code_fix": "代码修复",
+    "context_summary": "上下文摘要"
+}
+
+class BackgroundJobRunner:
+    """后台任务执行器：定期任务只在工作线程中执行，完成结果通过队列交回UI线程"""
+    def __init__(self, ui_queue, worker_count=1):
+        self.ui_queue = ui_queue
+        self.job_queue = queue.Queue()
+        self.workers = []
+
+        for index in range(worker_count):
+            worker = threading.Thread(target=self.worker_loop, name=f"OPAI-Job-{index}")
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, job_name, func, on_done=None):
+        """提交后台任务；on_done(job_name, result, error)会在UI线程中被调用"""
+        self.job_queue.put((job_name, func, on_done))
+
+    def ensure_background_thread(self, job_name):
+        """确保当前不在UI（主）线程中，防止耗时任务阻塞事件循环"""
+        if threading.current_thread() is threading.main_thread():
+            raise RuntimeError(f"后台任务 {job_name} 不允许在UI线程中执行")
+
+    def worker_loop(self):
+        """工作线程主循环"""
+        while True:
+            job_name, func, on_done = self.job_queue.get()
+            result = None
+            error = None
+            try:
+                result = func()
+            except Exception as e:
+                error = e
+
+            if on_done:
+                self.ui_queue.put(lambda name=job_name, r=result, err=error: on_done(name, r, err))
+
+
+class JobScheduler:
+    """定期任务调度器：具名、可取消、可重新安排的任务，支持随机抖动、防重叠执行和运行统计"""
+    def __init__(self, job_runner):
+        self.job_runner = job_runner
+        self.jobs = {}
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(target=self.scheduler_loop, name="OPAI-Scheduler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def schedule(self, job_name, interval_seconds, func, jitter=0.1, on_done=None):
+        """安排（或替换）一个定期任务，jitter为间隔的随机抖动比例"""
+        with self.condition:
+            old_job = self.jobs.get(job_name, {})
+            self.jobs[job_name] = {
+                "func": func,
+                "interval": interval_seconds,
+                "jitter": jitter,
+                "on_done": on_done,
+                "next_run": self.compute_next_run(interval_seconds, jitter),
+                # 替换任务时保留运行状态和统计，避免与仍在执行的旧任务重叠
+                "running": old_job.get("running", False),
+                "runs": old_job.get("runs", 0),
+                "failures": old_job.get("failures", 0),
+                "skipped": old_job.get("skipped", 0),
+                "last_run": old_job.get("last_run"),
+                "last_duration": old_job.get("last_duration"),
+                "last_error": old_job.get("last_error")
+            }
+            self.condition.notify()
+
+    def reschedule(self, job_name, interval_seconds):
+        """修改任务的执行间隔，并从现在开始重新计时"""
+        with self.condition:
+            job = self.jobs.get(job_name)
+            if job is None:
+                return False
+            job["interval"] = interval_seconds
+            job["next_run"] = self.compute_next_run(interval_seconds, job["jitter"])
+            self.condition.notify()
+            return True
+
+    def cancel(self, job_name):
+        """取消任务（正在执行的本次任务会执行完毕，但不会再被安排）"""
+        with self.condition:
+            removed = self.jobs.pop(job_name, None) is not None
+            self.condition.notify()
+            return removed
+
+    def get_metrics(self):
+        """返回各任务的运行统计：上次耗时、失败次数、下次运行时间等"""
+        with self.condition:
+            return {
+                name: {
+                    "interval": job["interval"],
+                    "next_run": job["next_run"],
+                    "running": job["running"],
+                    "runs": job["runs"],
+                    "failures": job["failures"],
+                    "skipped": job["skipped"],
+                    "last_run": job["last_run"],
+                    "last_duration": job["last_duration"],
+                    "last_error": job["last_error"]
+                }
+                for name, job in self.jobs.items()
+            }
+
+    def compute_next_run(self, interval_seconds, jitter):
+        """计算带随机抖动的下次运行时间"""
+        import random
+        return time.time() + interval_seconds * (1 + random.uniform(-jitter, jitter))
+
+    def scheduler_loop(self):
+        """调度线程主循环：到期任务交给后台执行器运行"""
+        while True:
+            with self.condition:
+                now = time.time()
+                due_jobs = []
+                next_wakeup = None
+
+                for name, job in self.jobs.items():
+                    if job["next_run"] <= now:
+                        job["next_run"] = self.compute_next_run(job["interval"], job["jitter"])
+                        if job["running"]:
+                            # 上一次执行尚未结束，跳过本次，避免任务重叠
+                            job["skipped"] += 1
+                        else:
+                            job["running"] = True
+                            due_jobs.append((name, job))
+                    if next_wakeup is None or job["next_run"] < next_wakeup:
+                        next_wakeup = job["next_run"]
+
+                if not due_jobs:
+                    timeout = None if next_wakeup is None else max(next_wakeup - now, 0)
+                    self.condition.wait(timeout)
+                    continue
+
+            for name, job in due_jobs:
+                self.job_runner.submit(name, lambda n=name, j=job: self.run_job(n, j), job["on_done"])
+
+    def run_job(self, job_name, job):
+        """执行任务并记录耗时和失败次数（在后台工作线程中执行）"""
+        start_time = time.time()
+        try:
+            return job["func"]()
+        except Exception as e:
+            with self.condition:
+                job["failures"] += 1
+                job["last_error"] = str(e)
+            raise
+        finally:
+            with self.condition:
+                job["running"] = False
+                job["runs"] += 1
+                job["last_run"] = start_time
+                job["last_duration"] = time.time() - start_time
+                # 任务被替换时，新任务也需要知道旧任务已结束
+                current_job = self.jobs.get(job_name)
+                if current_job is not None and current_job is not job:
+                    current_job["running"] = False
+
+
+class TokenBucket:
+    """令牌桶限流器：按每分钟请求数发放令牌，并支持按Retry-After暂停"""
+    def __init__(self, requests_per_minute):
+        self.lock = threading.Lock()
+        self.paused_until = 0
+        self.set_rate(requests_per_minute)
+
+    def set_rate(self, requests_per_minute):
+        """设置每分钟请求上限（0表示不限制）"""
+        with self.lock:
+            self.rate = requests_per_minute / 60.0
+            self.capacity = max(1.0, requests_per_minute / 6.0)  # 允许约10秒的突发量
+            self.tokens = self.capacity
+            self.updated_at = time.time()
+
+    def pause_until(self, timestamp):
+        """在指定时间之前不再发放令牌"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, timestamp)
+
+    def acquire(self):
+        """获取一个令牌，必要时阻塞等待"""
+        while True:
+            with self.lock:
+                now = time.time()
+                if now < self.paused_until:
+                    wait_time = self.paused_until - now
+                elif self.rate <= 0:
+                    return
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                    self.updated_at = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait_time = (1 - self.tokens) / self.rate
+            time.sleep(min(wait_time, 1.0))
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """端点处于熔断状态时抛出，请求直接失败而不发送"""
+
+
+class HedgeCancelledError(requests.exceptions.RequestException):
+    """对冲请求中落败的一方被取消时抛出"""
+
+
+class EditConflictError(Exception):
+    """edit_file的修改无法在文件中唯一定位时抛出，此时文件保持不变"""
+
+
+class ResourceLimitExceeded(subprocess.SubprocessError):
+    """子进程超出资源限制（CPU时间、内存或输出字节数）时抛出"""
+    LIMIT_NAMES = {
+        "timeout": ("运行时间", "秒"),
+        "cpu_seconds": ("CPU时间", "秒"),
+        "memory_mb": ("内存", "MB"),
+        "max_output_bytes": ("输出", "字节")
+    }
+
+    def __init__(self, limit, value, stdout="", stderr="", **details):
+        self.limit = limit
+        self.value = value
+        self.stdout = stdout
+        self.stderr = stderr
+        self.details = details
+        name, unit = self.LIMIT_NAMES[limit]
+        super().__init__(f"超出{name}限制（上限{value}{unit}）\n{self.format_violation(limit, value, **details)}")
+
+    @staticmethod
+    def format_violation(limit, value, **details):
+        """结构化的资源限制结果，附在命令输出中供AI识别"""
+        return "[资源限制] " + json.dumps(dict({"limit": limit, "value": value}, **details), ensure_ascii=False)
+
+    @staticmethod
+    def format_output(stdout, stderr):
+        """超时或超出上限前已捕获的输出（已按输出捕获设置只保留首尾部分），附在命令结果中"""
+        parts = []
+        for title, text in (("输出", stdout), ("错误", stderr)):
+            if isinstance(text, bytes):
+                text = text.decode("utf-8", errors="replace")
+            if text:
+                parts.append(f"{title}:\n{text}")
+        return "\n" + "\n".join(parts) if parts else ""
+
+
+class CircuitBreaker:
+    """单个API端点的熔断器：连续失败达到阈值后熔断，冷却结束后放行一次试探请求"""
+    def __init__(self, failure_threshold=5, cooldown_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.half_open_in_flight = False
+
+    @property
+    def state(self):
+        """当前状态：closed（正常）、open（熔断）、half_open（试探中）"""
+        if self.opened_at is None:
+            return "closed"
+        if time.time() - self.opened_at >= self.cooldown_seconds:
+            return "half_open"
+        return "open"
+
+    def allow_request(self):
+        """判断是否允许发送请求"""
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.half_open_in_flight:
+                # 冷却结束，只放行一个试探请求
+                self.half_open_in_flight = True
+                return True
+            return False
+
+    def remaining_cooldown(self):
+        """返回熔断剩余的冷却时间（秒）"""
+        if self.opened_at is None:
+            return 0
+        return max(self.cooldown_seconds - (time.time() - self.opened_at), 0)
+
+    def release_probe(self):
+        """归还试探名额而不记录结果（试探请求被取消或因与端点无关的原因中止时）"""
+        with self.lock:
+            self.half_open_in_flight = False
+
+    def record_success(self):
+        """请求成功，恢复正常状态"""
+        with self.lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.half_open_in_flight = False
+
+    def record_failure(self):
+        """请求失败，达到阈值（或试探请求失败）时熔断"""
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.half_open_in_flight or self.consecutive_failures >= self.failure_threshold:
+                self.opened_at = time.time()
+            self.half_open_in_flight = False
+
+
+class EndpointPool:
+    """API端点池：按权重和响应时间的指数加权移动平均（EWMA）选择端点，并跟踪端点健康状态"""
+    def __init__(self, endpoints, ewma_alpha=0.3, unhealthy_after=2):
+        self.lock = threading.Lock()
+        self.ewma_alpha = ewma_alpha
+        self.unhealthy_after = unhealthy_after  # 连续失败多少次后标记为异常
+        self.stats = {}
+        self.endpoints = []
+        self.update_endpoints(endpoints)
+
+    def update_endpoints(self, endpoints):
+        """更新端点列表，保留同名端点的统计信息"""
+        with self.lock:
+            self.endpoints = list(endpoints)
+            self.stats = {
+                endpoint["name"]: self.stats.get(endpoint["name"], {
+                    "ewma_latency": None,
+                    "consecutive_failures": 0,
+                    "healthy": True
+                })
+                for endpoint in self.endpoints
+            }
+
+    def rank(self, exclude=(), only=None):
+        """返回按优先顺序排列的端点列表
+
+        健康端点在前，按 权重/EWMA响应时间 加权随机排序，响应越快、权重越高越靠前；
+        异常端点和本次请求已失败的端点排在最后，作为兜底。
+        only指定端点名称时，只返回该端点（该端点不存在时忽略此限制）。
+        """
+        import random
+
+        with self.lock:
+            if only and not any(endpoint["name"] == only for endpoint in self.endpoints):
+                print(f"未找到名为 {only} 的端点，改为在所有端点中选择")
+                only = None
+
+            known_latencies = [stat["ewma_latency"] for stat in self.stats.values() if stat["ewma_latency"]]
+            default_latency = min(known_latencies) if known_latencies else 1.0
+
+            preferred = []
+            fallback = []
+            for endpoint in self.endpoints:
+                if only and endpoint["name"] != only:
+                    continue
+                stat = self.stats[endpoint["name"]]
+                if stat["healthy"] and endpoint["name"] not in exclude:
+                    latency = stat["ewma_latency"] or default_latency
+                    score = max(endpoint.get("weight", 1), 0.01) / max(latency, 0.001)
+                    # 加权随机排序：分数越高，排序键越大的概率越高
+                    preferred.append((random.random() ** (1.0 / score), endpoint))
+                else:
+                    fallback.append((stat["consecutive_failures"], endpoint))
+
+        preferred.sort(key=lambda item: item[0], reverse=True)
+        fallback.sort(key=lambda item: item[0])
+        return [endpoint for _, endpoint in preferred] + [endpoint for _, endpoint in fallback]
+
+    def has_alternative(self, exclude):
+        """判断除已排除的端点外是否还有健康端点可用"""
+        with self.lock:
+            return any(
+                self.stats[endpoint["name"]]["healthy"] and endpoint["name"] not in exclude
+                for endpoint in self.endpoints
+            )
+
+    def record_success(self, name, latency):
+        """记录一次成功请求及其响应时间"""
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                return
+            if stat["ewma_latency"] is None:
+                stat["ewma_latency"] = latency
+            else:
+                stat["ewma_latency"] = self.ewma_alpha * latency + (1 - self.ewma_alpha) * stat["ewma_latency"]
+            stat["consecutive_failures"] = 0
+            stat["healthy"] = True
+
+    def record_failure(self, name):
+        """记录一次失败请求，连续失败过多时标记为异常"""
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                return
+            stat["consecutive_failures"] += 1
+            if stat["consecutive_failures"] >= self.unhealthy_after:
+                stat["healthy"] = False
+
+    def get_unhealthy(self):
+        """返回当前被标记为异常的端点"""
+        with self.lock:
+            return [endpoint for endpoint in self.endpoints if not self.stats[endpoint["name"]]["healthy"]]
+
+
+class RequestDispatcher:
+    """LLM请求调度器：前台交互通道优先，后台通道在前台有请求等待或进行时让行"""
+    def __init__(self, lane_limits, requests_per_minute=0):
+        self.lane_limits = dict(lane_limits)
+        self.active = {lane: 0 for lane in self.lane_limits}
+        self.waiting = {lane: 0 for lane in self.lane_limits}
+        self.condition = threading.Condition()
+        self.rate_limiter = TokenBucket(requests_per_minute)
+
+    def can_start(self, lane):
+        """判断指定通道当前能否开始新请求"""
+        if self.active[lane] >= self.lane_limits[lane]:
+            return False
+        if lane == "background":
+            # 前台有请求在等待或进行时，后台请求一律推迟
+            return self.waiting["interactive"] == 0 and self.active["interactive"] == 0
+        return True
+
+    def submit(self, lane, func):
+        """在指定通道中执行请求函数（阻塞直到获得执行机会），返回函数结果"""
+        with self.condition:
+            self.waiting[lane] += 1
+            try:
+                while not self.can_start(lane):
+                    self.condition.wait(0.5)
+            finally:
+                self.waiting[lane] -= 1
+            self.active[lane] += 1
+
+        try:
+            self.rate_limiter.acquire()
+            if lane == "background":
+                # 等待令牌期间可能有前台请求到来，此时让出
+                with self.condition:
+                    while self.waiting["interactive"] > 0 or self.active["interactive"] > 0:
+                        self.condition.wait(0.5)
+            return func()
+        finally:
+            with self.condition:
+                self.active[lane] -= 1
+                self.condition.notify_all()
+
+    def defer_for(self, seconds):
+        """收到429或Retry-After时，暂停所有通道的新请求"""
+        self.rate_limiter.pause_until(time.time() + seconds)
+        print(f"API限流，{seconds:.1f}秒后再发送新请求")
+
+    def parse_retry_after(self, value):
+        """解析Retry-After响应头（秒数或HTTP日期），无法解析时返回None"""
+        if not value:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            from email.utils import parsedate_to_datetime
+            retry_time = parsedate_to_datetime(value)
+            return max(retry_time.timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+
+class OutputCapture:
+    """有界的输出捕获：内存中只保留开头和结尾固定长度的内容，输出超出时把完整内容写入磁盘上的溢出文件
+
+    溢出文件命名为spill-<编号>.txt，可通过read_output命令按行读取。head_chars为None时不限制（全部保存在内存中）。
+    """
+    SPILL_PREFIX = "spill-"
+
+    def __init__(self, head_chars=None, tail_chars=0, spill_dir=None):
+        self.head_chars = head_chars
+        self.tail_chars = tail_chars
+        self.spill_dir = spill_dir
+        self.head = []
+        self.head_size = 0
+        self.tail = collections.deque()
+        self.tail_size = 0
+        self.total_chars = 0
+        self.total_bytes = 0
+        self.spill_file = None
+        self.spill_id = None
+
+    def write(self, text, byte_count):
+        """追加一段已解码的输出，byte_count为其原始字节数"""
+        self.total_bytes += byte_count
+        self.total_chars += len(text)
+        if self.head_chars is None:
+            self.head.append(text)
+            return
+
+        # 第一次超出首尾容量时开始溢出到文件：此前的内容都还在内存中，先整体写入
+        if self.spill_file is None and self.total_chars > self.head_chars + self.tail_chars and self.spill_dir:
+            import uuid
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self.spill_id = f"{self.SPILL_PREFIX}{uuid.uuid4().hex[:10]}"
+            self.spill_file = open(os.path.join(self.spill_dir, f"{self.spill_id}.txt"), "w", encoding="utf-8")
+            self.spill_file.write("".join(self.head) + "".join(self.tail))
+        if self.spill_file is not None:
+            self.spill_file.write(text)
+
+        if self.head_size < self.head_chars:
+            taken = text[:self.head_chars - self.head_size]
+            self.head.append(taken)
+            self.head_size += len(taken)
+            text = text[len(taken):]
+        if text:
+            self.tail.append(text)
+            self.tail_size += len(text)
+            while self.tail and self.tail_size - len(self.tail[0]) >= self.tail_chars:
+                self.tail_size -= len(self.tail.popleft())
+            if self.tail_size > self.tail_chars:
+                excess = self.tail_size - self.tail_chars
+                self.tail[0] = self.tail[0][excess:]
+                self.tail_size -= excess
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+
+    @property
+    def omitted_chars(self):
+        if self.head_chars is None:
+            return 0
+        return self.total_chars - self.head_size - self.tail_size
+
+    def getvalue(self):
+        """返回捕获的内容；输出被截断时中间替换为省略说明（包含总字节数和溢出文件编号）"""
+        head = "".join(self.head)
+        tail = "".join(self.tail)
+        if not self.omitted_chars:
+            return head + tail
+        note = f"...(省略 {self.omitted_chars} 个字符，完整输出共 {self.total_bytes} 字节"
+        if self.spill_id:
+            note += f"，已保存为输出 {self.spill_id}，可使用read_output命令按行查看"
+        return f"{head}\n{note})...\n{tail}"
+
+    @classmethod
+    def prune_spills(cls, spill_dir, max_bytes):
+        """保存的输出文件（溢出文件及摘要时保存的完整输出）总大小超出上限时，从最早的文件开始删除"""
+        try:
+            names = [name for name in os.listdir(spill_dir) if name.startswith((cls.SPILL_PREFIX, "out-"))]
+        except OSError:
+            return
+        files = []
+        for name in names:
+            path = os.path.join(spill_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total_size <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+            except OSError:
+                pass
+
+
+class AsyncEngine:
+    """异步核心引擎：在独立线程中运行asyncio事件循环，承载对话流程、子进程和阻塞调用，
+    并通过事件流把消息推送给订阅者（如Tk界面）
+    """
+    def __init__(self, max_workers=8):
+        self.loop = asyncio.new_event_loop()
+        # 阻塞调用（HTTP请求、文件读写等）共用一个有界线程池，而不是每个任务一个线程
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="OPAI-IO")
+        self.loop.set_default_executor(self.executor)
+        self.subscribers = []
+        self.subscribers_lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self.run_loop, name="OPAI-Engine")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run_loop(self):
+        """事件循环线程主函数"""
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        """在引擎事件循环中运行协程（可在任意线程调用），返回concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """在线程池中执行阻塞函数并等待结果（沿用调用方的上下文变量，如当前对话）"""
+        context = contextvars.copy_context()
+        return await self.loop.run_in_executor(None, functools.partial(context.run, func, *args, **kwargs))
+
+    def subscribe(self, callback):
+        """订阅事件流；callback(event)在发布事件的线程中被调用"""
+        with self.subscribers_lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """取消订阅事件流"""
+        with self.subscribers_lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def publish(self, event_type, **payload):
+        """发布事件：{"type": 事件类型, ...}"""
+        event = dict(payload, type=event_type)
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                print(f"处理引擎事件 {event_type} 时发生错误: {e}")
+
+    @staticmethod
+    def make_limit_setter(limits):
+        """返回在子进程中设置资源上限（内存、CPU时间）的函数，没有需要设置的上限时返回None（仅POSIX）"""
+        import resource
+        import sys
+        settings = []
+        if limits.get("memory_mb"):
+            # Linux上RLIMIT_DATA覆盖堆和私有匿名映射，比RLIMIT_AS更接近实际内存占用（不受虚拟地址预留影响）
+            kind = resource.RLIMIT_DATA if sys.platform.startswith("linux") else resource.RLIMIT_AS
+            settings.append((kind, limits["memory_mb"] * 1024 * 1024, limits["memory_mb"] * 1024 * 1024))
+        if limits.get("cpu_seconds"):
+            # 超过软上限时收到SIGXCPU，仍不退出则在硬上限时被强制结束
+            settings.append((resource.RLIMIT_CPU, limits["cpu_seconds"], limits["cpu_seconds"] + 1))
+        if not settings:
+            return None
+
+        # 不能高于当前的硬上限
+        adjusted = []
+        for kind, soft, hard in settings:
+            current_hard = resource.getrlimit(kind)[1]
+            if current_hard != resource.RLIM_INFINITY:
+                hard = min(hard, current_hard)
+                soft = min(soft, hard)
+            adjusted.append((kind, soft, hard))
+
+        def set_limits():
+            for kind, soft, hard in adjusted:
+                resource.setrlimit(kind, (soft, hard))
+        return set_limits
+
+    @staticmethod
+    def detect_limit_violation(returncode, stderr, limits, enforced=True):
+        """根据结束子进程的信号判断是否因超出CPU时间或内存上限而失败，返回ResourceLimitExceeded或None
+
+        enforced表示上限是否确实在子进程中生效。只有被SIGABRT/SIGKILL结束且错误输出中有内存分配失败的信息
+        （如C++的bad_alloc、V8堆溢出）时才视为超出内存上限；其他异常结束（如assert失败）按普通的运行失败处理。
+        """
+        import signal
+        if not returncode or not enforced:
+            return None
+
+        def killed_by(*names):
+            numbers = [getattr(signal, name) for name in names if hasattr(signal, name)]
+            return any(returncode in (-number, 128 + number) for number in numbers)
+
+        if limits.get("cpu_seconds") and killed_by("SIGXCPU"):
+            return ResourceLimitExceeded("cpu_seconds", limits["cpu_seconds"], stderr=stderr, returncode=returncode)
+        if limits.get("memory_mb") and killed_by("SIGABRT", "SIGKILL"):
+            markers = ["MemoryError", "bad_alloc", "Cannot allocate memory", "OutOfMemoryError",
+                       "out of memory", "ERR_WORKER_OUT_OF_MEMORY"]
+            evidence = next((marker for marker in markers if marker in stderr), None)
+            if evidence:
+                return ResourceLimitExceeded("memory_mb", limits["memory_mb"], stderr=stderr, returncode=returncode, evidence=evidence)
+        return None
+
+    async def run_process(self, args, shell=False, cwd=None, timeout=30, on_output=None, spawn=None, limits=None, capture=None):
+        """异步执行子进程，返回subprocess.CompletedProcess（输出为文本）
+
+        输出按块增量读取，每读到一块就调用on_output(流名称, 文本)，无需等进程结束。
+        与subprocess.run保持一致：超时抛出subprocess.TimeoutExpired，找不到程序抛出FileNotFoundError。
+        spawn为可选的协程函数，返回与asyncio子进程接口相同的对象（如预热进程池fork出的子进程），此时不再启动args。
+        limits为资源上限（memory_mb、cpu_seconds、max_output_bytes，0为不限制），超出时抛出ResourceLimitExceeded；
+        在POSIX系统上子进程运行在独立的进程组中，超时或超出上限时连同它创建的进程一起结束。
+        capture为输出捕获设置（head_chars、tail_chars、spill_dir），结果中只保留首尾部分，完整输出写入溢出文件；
+        为空时完整输出保存在内存中。
+        """
+        limits = limits or {}
+        popen_options = {}
+        if os.name == "posix" and spawn is None:
+            popen_options["start_new_session"] = True
+            set_limits = self.make_limit_setter(limits)
+            if set_limits is not None:
+                popen_options["preexec_fn"] = set_limits
+
+        if spawn is not None:
+            process = await spawn()
+        elif shell:
+            process = await asyncio.create_subprocess_shell(
+                args, cwd=cwd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, **popen_options)
+        else:
+            process = await asyncio.create_subprocess_exec(
+                *args, cwd=cwd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, **popen_options)
+
+        def kill():
+            if "start_new_session" in popen_options:
+                import signal
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                    return
+                except OSError:
+                    pass
+            process.kill()
+
+        capture = capture or {}
+        output = {name: OutputCapture(capture.get("head_chars"), capture.get("tail_chars", 0), capture.get("spill_dir"))
+                  for name in ("stdout", "stderr")}
+        max_output_bytes = limits.get("max_output_bytes", 0)
+        output_state = {"bytes": 0, "exceeded": False}
+
+        async def pump(stream, name):
+            # 增量解码，避免多字节字符被分块截断
+            import codecs
+            import locale
+            decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))(errors="replace")
+            while True:
+                data = await stream.read(4096)
+                output_state["bytes"] += len(data)
+                if max_output_bytes and output_state["bytes"] > max_output_bytes and not output_state["exceeded"]:
+                    output_state["exceeded"] = True
+                    kill()
+                text = decoder.decode(data, final=not data).replace("\r\n", "\n")
+                if text:
+                    output[name].write(text, len(data))
+                    if on_output is not None:
+                        on_output(name, text)
+                if not data:
+                    break
+
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(pump(process.stdout, "stdout"), pump(process.stderr, "stderr"), process.wait()),
+                timeout
+            )
+        except asyncio.TimeoutError:
+            kill()
+            await process.wait()
+            raise subprocess.TimeoutExpired(args, timeout, output=output["stdout"].getvalue(), stderr=output["stderr"].getvalue())
+        finally:
+            output["stdout"].close()
+            output["stderr"].close()
+
+        stdout, stderr = output["stdout"].getvalue(), output["stderr"].getvalue()
+        if output_state["exceeded"]:
+            raise ResourceLimitExceeded("max_output_bytes", max_output_bytes, stdout, stderr, output_bytes=output_state["bytes"])
+        # 直接启动时上限只在POSIX上通过setrlimit生效；spawn（预热进程池、守护进程）自行在子进程中设置上限
+        violation = self.detect_limit_violation(process.returncode, stderr, limits, enforced=os.name == "posix" or spawn is not None)
+        if violation is not None:
+            violation.stdout = stdout
+            raise violation
+        return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+
+    def run_process_sync(self, args, shell=False, cwd=None, timeout=30, on_output=None, spawn=None, limits=None, capture=None):
+        """在引擎中执行子进程并阻塞等待结果（供线程池中的同步代码调用）"""
+        if threading.current_thread() is self.thread:
+            raise RuntimeError("不能在引擎事件循环线程中同步等待子进程，请使用run_process")
+        return self.submit(self.run_process(
+            args, shell=shell, cwd=cwd, timeout=timeout, on_output=on_output, spawn=spawn, limits=limits, capture=capture)).result()
+
+
+class Conversation:
+    """单个对话的状态：上下文消息、滚动摘要及命令输出去重记录，多个对话可在同一引擎中并发进行"""
+    id_counter = itertools.count(1)
+
+    def __init__(self, system_prompt, conversation_id=None, title=""):
+        self.conversation_id = conversation_id or f"conv-{next(Conversation.id_counter)}"
+        self.title = title
+        self.response_future = None  # 正在引擎中进行的一轮对话
+        self.turn_active = False  # 主窗口中是否有一轮正在进行（仅在UI线程中访问）
+        self.turn_id = 0  # 每发起一轮递增，用于忽略已停止的旧一轮迟到的结束事件（仅在UI线程中访问）
+        self.pending_messages = []  # 回复进行期间发送的消息，当前一轮结束后依次发出（仅在UI线程中访问）
+        self.context_messages = [{"role": "system", "content": system_prompt}]
+        self.context_summary = ""
+        self.context_lock = threading.Lock()
+        self.context_generation = 0  # 每次清除上下文时递增，用于丢弃过期的摘要结果
+        self.output_digest_seen = {}  # 已出现过的命令输出（内容哈希 -> 输出编号），用于去重
+
+    def reset(self, system_prompt):
+        """清除上下文，只保留系统提示词"""
+        with self.context_lock:
+            self.context_messages = [{"role": "system", "content": system_prompt}]
+            self.context_summary = ""
+            self.context_generation += 1
+            self.output_digest_seen = {}
+
+
+class CompileCache:
+    """编译缓存：按源代码内容、编译器版本和编译参数的哈希保存编译产物，总大小超出上限时按最近使用时间淘汰"""
+    STAGING_PREFIX = ".tmp-"
+    STAGING_MAX_AGE = 3600  # 残留的临时编译目录超过此时间（秒）后清理
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def make_key(self, *parts):
+        """把各组成部分（源代码、编译器版本、编译参数等）哈希为缓存键"""
+        import hashlib
+        digest = hashlib.sha256()
+        for part in parts:
+            data = part if isinstance(part, bytes) else str(part).encode("utf-8")
+            digest.update(len(data).to_bytes(8, "big"))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def lookup(self, key):
+        """查找缓存条目，命中时刷新最近使用时间并返回条目目录"""
+        entry_dir = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry_dir):
+            return None
+        try:
+            os.utime(entry_dir)
+        except OSError:
+            return None
+        return entry_dir
+
+    def create_staging_dir(self, key):
+        """创建临时编译目录，编译成功后再整体移入缓存，避免并发编译读到不完整的产物"""
+        import tempfile
+        os.makedirs(self.cache_dir, exist_ok=True)
+        return tempfile.mkdtemp(prefix=f"{self.STAGING_PREFIX}{key[:12]}-", dir=self.cache_dir)
+
+    def discard(self, staging_dir):
+        """丢弃编译失败的临时目录"""
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def commit(self, key, staging_dir):
+        """把临时目录中的编译产物存入缓存，返回条目目录"""
+        entry_dir = os.path.join(self.cache_dir, key)
+        try:
+            os.rename(staging_dir, entry_dir)
+        except OSError:
+            # 其他线程已经存入了相同的条目
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        try:
+            os.utime(entry_dir)
+        except OSError:
+            pass
+        self.evict(keep=key)
+        return entry_dir
+
+    def evict(self, keep=None):
+        """总大小超出上限时，从最久未使用的条目开始删除"""
+        with self.lock:
+            entries = []
+            total_size = 0
+            now = time.time()
+            try:
+                names = os.listdir(self.cache_dir)
+            except OSError:
+                return
+            for name in names:
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    mtime = os.path.getmtime(path)
+                except OSError:
+                    continue
+                if name.startswith(self.STAGING_PREFIX):
+                    if now - mtime > self.STAGING_MAX_AGE:
+                        shutil.rmtree(path, ignore_errors=True)
+                    continue
+                size = 0
+                for dir_path, _, file_names in os.walk(path):
+                    for file_name in file_names:
+                        try:
+                            size += os.path.getsize(os.path.join(dir_path, file_name))
+                        except OSError:
+                            pass
+                entries.append((mtime, name, path, size))
+                total_size += size
+            entries.sort()
+            for mtime, name, path, size in entries:
+                if total_size <= self.max_bytes:
+                    break
+                if name == keep:
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+                total_size -= size
+
+
+class WarmProcess:
+    """预热进程池fork出的子进程，接口与asyncio子进程一致（stdout、stderr、wait()、kill()、returncode）"""
+    def __init__(self, pid, stdout, stderr, control_reader, control_writer):
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.control_reader = control_reader
+        self.control_writer = control_writer
+        self.returncode = None
+
+    async def wait(self):
+        """等待母进程回报子进程的退出码"""
+        if self.returncode is None:
+            line = await self.control_reader.readline()
+            # 母进程异常退出时拿不到退出码
+            self.returncode = json.loads(line)["returncode"] if line else -1
+            self.control_writer.close()
+        return self.returncode
+
+    def kill(self):
+        """结束子进程及其创建的所有进程（子进程是独立的进程组）"""
+        import signal
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+class PythonWarmPool:
+    """Python预热进程池：常驻的母进程预先导入常用模块，每次运行脚本时fork出独立的子进程（仅支持fork的系统）"""
+    # 母进程：预先导入模块后在Unix套接字上等待请求；每个请求携带子进程的stdout/stderr管道，
+    # fork出的子进程在新会话中用runpy运行脚本，母进程回报子进程编号和退出码
+    ZYGOTE_SOURCE = """
+import array, importlib, json, os, runpy, select, signal, socket, sys, traceback
+
+socket_path = sys.argv[1]
+failed = []
+for name in sys.argv[2:]:
+    try:
+        importlib.import_module(name)
+    except Exception:
+        failed.append(name)
+
+listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+listener.bind(socket_path)
+listener.listen(64)
+wakeup_r, wakeup_w = os.pipe()
+os.set_blocking(wakeup_r, False)
+os.set_blocking(wakeup_w, False)
+signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+signal.set_wakeup_fd(wakeup_w)
+sys.stdout.write(json.dumps({"ready": True, "failed": failed}) + "\\n")
+sys.stdout.flush()
+
+def serve():
+    children = {}
+    while True:
+        readable = select.select([0, listener, wakeup_r], [], [])[0]
+        if 0 in readable and not os.read(0, 4096):
+            return None
+        if wakeup_r in readable:
+            try:
+                while os.read(wakeup_r, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+            while children:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if pid == 0:
+                    break
+                returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+                conn = children.pop(pid, None)
+                if conn is not None:
+                    try:
+                        conn.sendall((json.dumps({"returncode": returncode}) + "\\n").encode())
+                    except OSError:
+                        pass
+                    conn.close()
+        if listener in readable:
+            conn = listener.accept()[0]
+            fds = array.array("i")
+            message, ancdata, flags, address = conn.recvmsg(65536, socket.CMSG_LEN(2 * fds.itemsize))
+            for level, kind, data in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+            while not message.endswith(b"\\n"):
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                message += chunk
+            if len(fds) != 2:
+                for fd in fds:
+                    os.close(fd)
+                conn.close()
+                continue
+            pid = os.fork()
+            if pid == 0:
+                conn.close()
+                return json.loads(message), fds
+            os.close(fds[0])
+            os.close(fds[1])
+            children[pid] = conn
+            conn.sendall((json.dumps({"pid": pid}) + "\\n").encode())
+
+job = serve()
+if job is None:
+    os.unlink(socket_path)
+    sys.exit(0)
+
+request, fds = job
+signal.set_wakeup_fd(-1)
+signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+listener.close()
+os.close(wakeup_r)
+os.close(wakeup_w)
+os.setsid()
+if request.get("memory_mb"):
+    import resource
+    memory_limit = request["memory_mb"] * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_DATA if sys.platform.startswith("linux") else resource.RLIMIT_AS, (memory_limit, memory_limit))
+if request.get("cpu_seconds"):
+    import resource
+    resource.setrlimit(resource.RLIMIT_CPU, (request["cpu_seconds"], request["cpu_seconds"] + 1))
+devnull = os.open(os.devnull, os.O_RDONLY)
+os.dup2(devnull, 0)
+os.dup2(fds[0], 1)
+os.dup2(fds[1], 2)
+os.close(devnull)
+os.close(fds[0])
+os.close(fds[1])
+os.chdir(request["cwd"])
+path = request["path"]
+sys.argv = [path] + request.get("args", [])
+sys.path[0] = os.path.dirname(path)
+del job, request, fds
+try:
+    runpy.run_path(path, run_name="__main__")
+except SystemExit:
+    raise
+except BaseException as e:
+    # 只显示脚本自身的调用栈，与直接运行解释器的输出一致
+    tb = e.__traceback__
+    while tb is not None and tb.tb_frame.f_code.co_filename != path:
+        tb = tb.tb_next
+    traceback.print_exception(type(e), e, tb)
+    sys.exit(1)
+"""
+
+    def __init__(self, interpreter="python", modules=()):
+        self.interpreter = interpreter
+        self.modules = list(modules)
+        self.process = None
+        self.socket_dir = None
+        self.socket_path = None
+        self.failed_modules = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def is_supported():
+        """当前系统是否支持fork和Unix套接字传递文件描述符"""
+        import socket
+        return hasattr(os, "fork") and hasattr(socket, "AF_UNIX") and hasattr(socket.socket, "sendmsg")
+
+    def ensure_started(self):
+        """启动母进程（已在运行时直接返回，异常退出后自动重启）"""
+        import tempfile
+        with self.lock:
+            if self.process is not None and self.process.poll() is None:
+                return
+            self.stop_locked()
+            self.socket_dir = tempfile.mkdtemp(prefix="opai-python-")
+            self.socket_path = os.path.join(self.socket_dir, "zygote.sock")
+            self.process = subprocess.Popen(
+                [self.interpreter, "-u", "-c", self.ZYGOTE_SOURCE, self.socket_path] + self.modules,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+            )
+            line = self.process.stdout.readline()
+            if not line:
+                self.stop_locked()
+                raise RuntimeError("Python预热进程启动失败")
+            self.failed_modules = json.loads(line).get("failed", [])
+
+    def stop(self):
+        """结束母进程（已fork出的子进程不受影响）"""
+        with self.lock:
+            self.stop_locked()
+
+    def stop_locked(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+            self.process.stdin.close()
+            self.process.stdout.close()
+            self.process = None
+        if self.socket_dir is not None:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+            self.socket_dir = None
+
+    async def spawn(self, path, cwd, limits=None):
+        """在母进程中fork一个子进程运行脚本，返回WarmProcess（在引擎事件循环中调用）；limits中的内存和CPU上限在子进程中设置"""
+        import array
+        import socket
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.ensure_started)
+
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+            limits = limits or {}
+            request = {"path": path, "cwd": cwd, "memory_mb": limits.get("memory_mb", 0), "cpu_seconds": limits.get("cpu_seconds", 0)}
+            request = (json.dumps(request) + "\n").encode("utf-8")
+            sock.sendmsg([request], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [stdout_w, stderr_w]))])
+        except OSError:
+            sock.close()
+            os.close(stdout_r)
+            os.close(stderr_r)
+            raise
+        finally:
+            os.close(stdout_w)
+            os.close(stderr_w)
+
+        control_reader, control_writer = await asyncio.open_unix_connection(sock=sock)
+        line = await control_reader.readline()
+        if not line:
+            control_writer.close()
+            os.close(stdout_r)
+            os.close(stderr_r)
+            raise ConnectionError("Python预热进程没有响应")
+
+        streams = []
+        for fd in (stdout_r, stderr_r):
+            reader = asyncio.StreamReader()
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, "rb", 0))
+            streams.append(reader)
+        return WarmProcess(json.loads(line)["pid"], streams[0], streams[1], control_reader, control_writer)
+
+
+class DaemonProcess:
+    """Node.js运行器守护进程中的一次运行，接口与asyncio子进程一致（stdout、stderr、wait()、kill()、returncode）"""
+    def __init__(self, daemon, run_id, process):
+        import locale
+        self.daemon = daemon
+        self.run_id = run_id
+        self.process = process  # 所属的守护进程
+        self.encoding = locale.getpreferredencoding(False)  # 与直接启动进程时的解码方式一致
+        self.stdout = asyncio.StreamReader()
+        self.stderr = asyncio.StreamReader()
+        self.exited = asyncio.get_event_loop().create_future()
+        self.returncode = None
+
+    def feed(self, stream, text):
+        """写入守护进程转发的输出"""
+        reader = self.stderr if stream == "stderr" else self.stdout
+        reader.feed_data(text.encode(self.encoding, errors="replace"))
+
+    def finish(self, returncode):
+        """运行结束（守护进程退出时returncode为-1）"""
+        if self.exited.done():
+            return
+        self.stdout.feed_eof()
+        self.stderr.feed_eof()
+        self.returncode = returncode
+        self.exited.set_result(returncode)
+
+    async def wait(self):
+        return await asyncio.shield(self.exited)
+
+    def kill(self):
+        self.daemon.kill_run(self)
+
+
+class NodeRunnerDaemon:
+    """常驻的Node.js运行器守护进程：通过标准输入输出上的JSON行协议接收运行请求，每次运行在新的worker线程中执行脚本，
+    多次运行按编号区分输出；异常退出或健康检查无响应时由OPAI重启（在引擎事件循环中使用）
+    """
+    NAME = "Node.js"
+    SOURCE_NAME = "opai_node_runner.js"
+    SOURCE = r"""'use strict';
+// OPAI Node.js runner daemon: each run executes in a fresh worker thread.
+const { Worker } = require('worker_threads');
+const readline = require('readline');
+
+const workers = new Map();
+
+function send(message) {
+  process.stdout.write(JSON.stringify(message) + '\n');
+}
+
+function run(request) {
+  const id = request.id;
+  let worker;
+  try {
+    const options = { argv: request.args || [], stdout: true, stderr: true, stdin: false };
+    if (request.memory_mb) {
+      options.resourceLimits = { maxOldGenerationSizeMb: request.memory_mb };
+    }
+    worker = new Worker(request.path, options);
+  } catch (error) {
+    send({ id, stream: 'stderr', data: String((error && error.stack) || error) + '\n' });
+    send({ id, exit: 1 });
+    return;
+  }
+  workers.set(id, worker);
+  const ended = [];
+  for (const name of ['stdout', 'stderr']) {
+    const stream = worker[name];
+    stream.setEncoding('utf8');
+    stream.on('data', (data) => send({ id, stream: name, data }));
+    ended.push(new Promise((resolve) => stream.on('end', resolve)));
+  }
+  let failed = false;
+  worker.on('error', (error) => {
+    failed = true;
+    send({ id, stream: 'stderr', data: String((error && error.stack) || error) + '\n' });
+  });
+  worker.on('exit', (code) => {
+    workers.delete(id);
+    // Flush the remaining output before reporting the exit code.
+    Promise.race([Promise.all(ended), new Promise((resolve) => setTimeout(resolve, 1000))]).then(() => {
+      send({ id, exit: failed && code === 0 ? 1 : code });
+    });
+  });
+}
+
+readline.createInterface({ input: process.stdin }).on('line', (line) => {
+  let request;
+  try {
+    request = JSON.parse(line);
+  } catch (error) {
+    return;
+  }
+  if (request.op === 'ping') {
+    send({ id: request.id, pong: true });
+  } else if (request.op === 'kill') {
+    const worker = workers.get(request.id);
+    if (worker) {
+      worker.terminate();
+    }
+  } else if (request.op === 'run') {
+    run(request);
+  }
+}).on('close', () => process.exit(0));
+"""
+    START_TIMEOUT = 30  # 启动后等待首次健康检查响应的时间（秒）
+    KILL_GRACE = 5  # 终止运行后等待守护进程回报的时间（秒），超时则重启守护进程
+
+    def __init__(self, daemon_dir, cwd):
+        self.daemon_dir = daemon_dir
+        self.cwd = cwd
+        self.process = None
+        self.runs = {}  # 运行编号 -> DaemonProcess
+        self.pings = {}  # 健康检查编号 -> Future
+        self.ids = itertools.count(1)
+        self.start_lock = None  # asyncio.Lock需在事件循环中创建
+        self.starts = 0
+
+    def is_running(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def ensure_started(self):
+        """启动守护进程（已在运行时直接返回）"""
+        if self.start_lock is None:
+            self.start_lock = asyncio.Lock()
+        async with self.start_lock:
+            if self.is_running():
+                return
+            os.makedirs(self.daemon_dir, exist_ok=True)
+            source_path = os.path.join(self.daemon_dir, self.SOURCE_NAME)
+            with open(source_path, "w", encoding="utf-8") as f:
+                f.write(self.SOURCE)
+            self.process = await asyncio.create_subprocess_exec(
+                "node", source_path, cwd=self.cwd,
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+                limit=16 * 1024 * 1024
+            )
+            asyncio.ensure_future(self.read_loop(self.process))
+            if not await self.ping(self.START_TIMEOUT):
+                await self.stop()
+                raise RuntimeError(f"{self.NAME}守护进程启动失败")
+            self.starts += 1
+
+    async def read_loop(self, process):
+        """读取守护进程的消息并分发给对应的运行；守护进程退出后结束其中所有的运行"""
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                break
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            message_id = message.get("id")
+            if "pong" in message:
+                future = self.pings.pop(message_id, None)
+                if future is not None and not future.done():
+                    future.set_result(True)
+            elif message_id in self.runs:
+                if "stream" in message:
+                    self.runs[message_id].feed(message["stream"], message.get("data", ""))
+                elif "exit" in message:
+                    self.runs.pop(message_id).finish(message["exit"])
+        await process.wait()
+        for run_id, run in list(self.runs.items()):
+            if run.process is process:
+                del self.runs[run_id]
+                run.finish(-1)
+
+    def send(self, message):
+        self.process.stdin.write((json.dumps(message) + "\n").encode("utf-8"))
+
+    async def ping(self, timeout):
+        """健康检查：守护进程在timeout秒内响应时返回True"""
+        ping_id = next(self.ids)
+        future = asyncio.get_event_loop().create_future()
+        self.pings[ping_id] = future
+        try:
+            self.send({"op": "ping", "id": ping_id})
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, OSError):
+            return False
+        finally:
+            self.pings.pop(ping_id, None)
+
+    async def spawn(self, request):
+        """在守护进程中开始一次运行，返回DaemonProcess"""
+        await self.ensure_started()
+        run = DaemonProcess(self, next(self.ids), self.process)
+        self.runs[run.run_id] = run
+        self.send(dict(request, id=run.run_id))
+        return run
+
+    def kill_run(self, run):
+        """终止一次运行（超时时调用）"""
+        try:
+            self.send({"op": "kill", "id": run.run_id})
+        except OSError:
+            pass
+
+        def check_killed():
+            # 守护进程没有及时回报时直接结束它，下次运行时重启
+            if not run.exited.done() and run.process.returncode is None:
+                run.process.kill()
+
+        asyncio.get_event_loop().call_later(self.KILL_GRACE, check_killed)
+
+    async def health_check(self):
+        """异常退出或没有响应的守护进程重新启动（从未启动过的不处理）"""
+        if self.process is None:
+            return
+        if self.is_running() and await self.ping(5):
+            return
+        print(f"{self.NAME}守护进程没有响应，正在重启")
+        await self.stop()
+        await self.ensure_started()
+
+    async def stop(self):
+        """结束守护进程"""
+        if self.is_running():
+            self.process.kill()
+            await self.process.wait()
+
+
 class OPAIApp:
+    READ_FILE_CHUNK_BYTES = 8 * 1024 * 1024  # read_file计数换行符和grep解码时每块的字节数
+
     def __init__(self, root):
+        # root为None时以无界面模式运行（命令行/批处理），不创建任何Tk组件
         self.root = root
-        self.root.title("OnPython AI (OPAI)")
-        self.root.geometry("800x600")
+        self.headless = root is None
+        if not self.headless:
+            self.root.title("OnPython AI (OPAI)")
+            self.root.geometry("800x600")
 
         # 主题配置
         self.is_dark_theme = False
@@ -27,6 +1408,7 @@ class OPAIApp:
 
         # 记忆库存储路径
         self.memory_dir = os.path.join(self.data_dir, "Memory")
+        self.outputs_dir = os.path.join(self.data_dir, "Outputs")  # 命令完整输出存储目录
         self.short_term_memory_file = os.path.join(self.memory_dir, "short_term_memory.json")
         self.long_term_memory_file = os.path.join(self.memory_dir, "long_term_memory.json")
         self.memory = {
@@ -37,6 +1419,45 @@ class OPAIApp:
         # 加载配置
         self.config = self.load_config()
 
+        # 后台任务：定期任务在工作线程中执行，结果通过队列交回UI线程
+        self.memory_lock = threading.RLock()  # 保护记忆库和对话历史的并发访问
+        self.ui_queue = queue.Queue()
+        self.job_runner = BackgroundJobRunner(self.ui_queue, worker_count=2)
+        self.scheduler = JobScheduler(self.job_runner)
+
+        # LLM请求调度：前台交互通道优先于后台通道，并共享限流器和连接池
+        self.dispatcher = RequestDispatcher(
+            {
+                "interactive": self.config.get("api_interactive_concurrency", 2),
+                "background": self.config.get("api_background_concurrency", 1)
+            },
+            self.config.get("api_requests_per_minute", 0)
+        )
+        self.http_session = requests.Session()
+        self.http_session.trust_env = False  # 不使用系统代理
+
+        # 各API端点的熔断器
+        self.circuit_breakers = {}
+        self.circuit_breakers_lock = threading.Lock()
+
+        # 多端点负载均衡：按权重和响应时间（EWMA）选择健康的端点
+        self.endpoint_pool = EndpointPool(self.get_configured_endpoints())
+
+        # 对冲请求：首字节时间样本及触发/胜出统计
+        self.hedge_lock = threading.Lock()
+        self.first_byte_latencies = collections.deque(maxlen=200)
+        self.hedge_stats = {"requests": 0, "hedged": 0, "wins": 0}
+        self.scheduler.schedule(
+            "endpoint_health_check",
+            self.config.get("endpoint_health_check_interval", 60),
+            self.check_endpoint_health
+        )
+        self.scheduler.schedule(
+            "runner_daemon_health_check",
+            self.config.get("runner_daemon_health_check_interval", 60),
+            self.check_node_runner_daemon
+        )
+
         # 检查是否启用暗色主题
         self.is_dark_theme = self.config.get("dark_theme", False)
 
@@ -46,14 +1467,55 @@ class OPAIApp:
         # 初始化对话历史记录
         self.conversation_history = []
 
-        # 初始化上下文消息列表（用于API调用）
-        self.context_messages = [
-            {"role": "system", "content": self.config["system_prompt"]}
-        ]
+        # 对话（上下文消息、滚动摘要、输出去重记录）：主窗口每个标签页一个，无界面模式使用main
+        # 被移出上下文窗口的对话会在后台增量压缩进滚动摘要
+        self.main_conversation = Conversation(self.config["system_prompt"], "main", "对话 1")
+        self.current_conversation = self.main_conversation  # 主窗口当前选中的对话
+        self.conversation_tabs = {}  # 对话编号 -> {"conversation", "frame", "chat_display"}
+        self.conversation_title_counter = itertools.count(2)
+        self.compression_queue = queue.Queue()
+        self.compression_thread = None
+
+        # 异步核心引擎：对话流程、HTTP请求和命令执行都在引擎中运行，界面通过事件流接收消息
+        self.engine = AsyncEngine(max_workers=self.config.get("engine_worker_count", 8))
+
+        # 正在运行的命令进程：实时输出先进入缓冲区，由UI线程批量写入对话框
+        self.process_counter = itertools.count(1)
+        self.live_processes = {}  # 进程编号 -> {"label", "start_time", "conversation_id"}（仅在UI线程中访问）
+
+        # 编译缓存：源代码未变化时直接运行缓存的编译产物
+        self.compile_cache = CompileCache(
+            os.path.join(self.data_dir, "CompileCache"),
+            self.config.get("compile_cache_max_mb", 256) * 1024 * 1024
+        )
+        self.compiler_versions = {}  # 编译器命令 -> 版本信息
+        self.compiler_versions_lock = threading.Lock()
+
+        # Python预热进程池（按需创建）
+        self.python_pool = None
+        self.python_pool_lock = threading.Lock()
+
+        # 常驻的Node.js运行器守护进程（按需启动）
+        self.node_daemon = None
+        self.node_daemon_lock = threading.Lock()
+        self.output_buffer = []
+        self.output_buffer_lock = threading.Lock()
+        self.output_flush_pending = False
+        if self.headless:
+            # 没有UI线程，后台任务的完成回调由专门的线程依次执行
+            callback_thread = threading.Thread(target=self.drain_ui_queue, name="OPAI-Callbacks")
+            callback_thread.daemon = True
+            callback_thread.start()
+            return
+
+        self.engine.subscribe(self.on_engine_event)
 
         # 创建主界面
         self.create_widgets()
 
+        # 开始轮询后台线程投递的UI回调
+        self.process_ui_queue()
+
     def get_theme_colors(self):
         """获取当前主题的颜色方案"""
         if self.is_dark_theme:
@@ -95,14 +1557,9 @@ class OPAIApp:
         """应用当前主题到UI组件"""
         colors = self.get_theme_colors()
 
-        # 应用到聊天显示区域
-        self.chat_display.config(
-            bg=colors["text_bg"],
-            fg=colors["text_fg"],
-            insertbackground=colors["fg"],  # 光标颜色
-            selectbackground=colors["highlight_bg"],
-            selectforeground=colors["highlight_fg"]
-        )
+        # 应用到各对话标签页的聊天显示区域
+        for tab in self.conversation_tabs.values():
+            self.apply_chat_display_theme(tab["chat_display"])
 
         # 应用到输入区域
         self.user_input.config(
@@ -120,6 +1577,17 @@ class OPAIApp:
         self.chat_frame.config()  # ttk组件主要受系统主题影响
         self.input_frame.config()
 
+    def apply_chat_display_theme(self, chat_display):
+        """将当前主题应用到一个聊天显示区域"""
+        colors = self.get_theme_colors()
+        chat_display.config(
+            bg=colors["text_bg"],
+            fg=colors["text_fg"],
+            insertbackground=colors["fg"],  # 光标颜色
+            selectbackground=colors["highlight_bg"],
+            selectforeground=colors["highlight_fg"]
+        )
+
     def detect_system_theme(self):
         """检测系统主题"""
         try:
@@ -148,23 +1616,29 @@ class OPAIApp:
         # 文件菜单
         file_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="文件", menu=file_menu)
+        file_menu.add_command(label="新建对话", command=self.new_conversation, accelerator="Ctrl+T")
+        file_menu.add_command(label="关闭对话", command=self.close_conversation, accelerator="Ctrl+W")
+        file_menu.add_separator()
         file_menu.add_command(label="导入 .opai 文件", command=self.import_opai_file)
         file_menu.add_command(label="清除对话上下文", command=self.clear_context)
         file_menu.add_separator()
         file_menu.add_command(label="退出", command=self.root.quit)
+        self.root.bind("<Control-t>", lambda event: self.new_conversation())
+        self.root.bind("<Control-w>", lambda event: self.close_conversation())
         
-        # 创建对话记录框
+        # 创建对话记录区域：每个对话一个标签页
         self.chat_frame = ttk.Frame(self.root)
         self.chat_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+        self.conversation_notebook = ttk.Notebook(self.chat_frame)
+        self.conversation_notebook.pack(fill=tk.BOTH, expand=True)
+        self.conversation_notebook.bind("<<NotebookTabChanged>>", self.on_conversation_tab_changed)
         
-        self.chat_display = scrolledtext.ScrolledText(
-            self.chat_frame, 
-            wrap=tk.WORD, 
-            state=tk.DISABLED,
-            font=("微软雅黑", 10)
-        )
-        self.chat_display.pack(fill=tk.BOTH, expand=True)
-        
+        # 正在运行的命令及已运行时间
+        self.process_status_var = tk.StringVar(value="")
+        self.process_status_label = ttk.Label(self.root, textvariable=self.process_status_var)
+        self.process_status_label.pack(fill=tk.X, padx=10, pady=(0, 5))
+
         # 创建输入区域
         self.input_frame = ttk.Frame(self.root)
         self.input_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
@@ -194,6 +1668,9 @@ class OPAIApp:
         )
         self.settings_button.pack(side=tk.RIGHT, padx=(0, 5))
 
+        # 第一个对话标签页
+        self.add_conversation_tab(self.main_conversation)
+
         # 应用主题
         self.apply_theme()
         
@@ -203,11 +1680,68 @@ class OPAIApp:
         # 启动记忆库定期总结任务
         self.start_memory_summarization()
     
+    def add_conversation_tab(self, conversation):
+        """为对话创建一个标签页"""
+        frame = ttk.Frame(self.conversation_notebook)
+        chat_display = scrolledtext.ScrolledText(
+            frame,
+            wrap=tk.WORD,
+            state=tk.DISABLED,
+            font=("微软雅黑", 10)
+        )
+        chat_display.pack(fill=tk.BOTH, expand=True)
+        self.apply_chat_display_theme(chat_display)
+
+        self.conversation_tabs[conversation.conversation_id] = {
+            "conversation": conversation,
+            "frame": frame,
+            "chat_display": chat_display
+        }
+        self.conversation_notebook.add(frame, text=conversation.title)
+        self.conversation_notebook.select(frame)
+        self.current_conversation = conversation
+        self.update_send_button()
+
+    def new_conversation(self):
+        """新建一个对话标签页，上下文与其他对话相互独立"""
+        conversation = Conversation(self.config["system_prompt"], title=f"对话 {next(self.conversation_title_counter)}")
+        self.add_conversation_tab(conversation)
+        self.display_message("系统", "已新建对话。")
+
+    def close_conversation(self):
+        """关闭当前对话标签页（至少保留一个），正在进行的回复会被取消"""
+        if len(self.conversation_tabs) <= 1:
+            self.clear_context()
+            return
+
+        conversation = self.current_conversation
+        if conversation.response_future is not None and not conversation.response_future.done():
+            conversation.response_future.cancel()
+        tab = self.conversation_tabs.pop(conversation.conversation_id)
+        self.conversation_notebook.forget(tab["frame"])
+        tab["frame"].destroy()
+        self.on_conversation_tab_changed()
+
+    def on_conversation_tab_changed(self, event=None):
+        """切换标签页时更新当前对话，并按该对话是否正在生成更新按钮"""
+        selected = self.conversation_notebook.select()
+        for tab in self.conversation_tabs.values():
+            if str(tab["frame"]) == selected:
+                self.current_conversation = tab["conversation"]
+                break
+        self.update_send_button()
+
+    def update_send_button(self):
+        """根据当前对话是否有正在进行的回复，显示“发送”或“停止”"""
+        if self.current_conversation.turn_active:
+            self.send_button.config(text="停止", command=self.stop_generation)
+        else:
+            self.send_button.config(text="发送", command=self.send_message)
+
     def clear_context(self):
         """清除对话上下文，开始新的对话"""
         # 保留系统提示词，清除用户和AI的消息
-        system_prompt = self.config["system_prompt"]
-        self.context_messages = [{"role": "system", "content": system_prompt}]
+        self.conversation.reset(self.config["system_prompt"])
         self.display_message("系统", "对话上下文已清除，现在开始新的对话。")
     
     def import_opai_file(self):
@@ -267,16 +1801,17 @@ class OPAIApp:
                     
                     self.display_message("系统", f"已将 {actual_file_name} 复制到 {self.onpython_dir} 目录")
             
-            # 将程序信息保存到记忆库
-            self.memory["programs"][program_name] = {
-                "name": program_name,
-                "usage": content,
-                "location": self.onpython_dir,
-                "added_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            }
-            
-            # 保存记忆库
-            self.save_memory()
+            with self.memory_lock:
+                # 将程序信息保存到记忆库
+                self.memory["programs"][program_name] = {
+                    "name": program_name,
+                    "usage": content,
+                    "location": self.onpython_dir,
+                    "added_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                }
+
+                # 保存记忆库
+                self.save_memory()
             
             self.display_message("系统", f"程序 {program_name} 导入完成，并已记录到记忆库中！")
     
@@ -284,8 +1819,12 @@ class OPAIApp:
         """启动记忆库定期总结任务"""
         # 使用配置文件中的对话保存时间间隔
         save_interval_minutes = self.config.get("conversation_save_interval", 30)  # 默认30分钟
-        save_interval_ms = save_interval_minutes * 60 * 1000  # 转换为毫秒
-        self.root.after(save_interval_ms, self.create_memory_summary)
+        self.scheduler.schedule(
+            "memory_summary",
+            save_interval_minutes * 60,
+            self.create_memory_summary,
+            on_done=self.on_periodic_job_done
+        )
 
         # 启动记忆库整理任务
         self.start_memory整理()
@@ -294,27 +1833,74 @@ class OPAIApp:
         """启动记忆库定期整理任务"""
         # 使用配置文件中的记忆整理时间间隔
         整理_interval_minutes = self.config.get("memory整理_interval", 60)  # 默认60分钟
-        整理_interval_ms = 整理_interval_minutes * 60 * 1000  # 转换为毫秒
-        self.root.after(整理_interval_ms, self.整理_memory)
+        self.scheduler.schedule(
+            "memory整理",
+            整理_interval_minutes * 60,
+            self.整理_memory,
+            on_done=self.on_periodic_job_done
+        )
+
+    def on_periodic_job_done(self, job_name, result, error):
+        """后台定期任务完成后的回调（在UI线程中执行）"""
+        if error is not None:
+            print(f"后台任务 {job_name} 执行失败: {error}")
+        elif result:
+            print(result)
+
+    def post_to_ui(self, callback):
+        """将回调投递到UI线程执行（可在任意线程调用）；无界面模式下直接执行"""
+        if self.headless:
+            callback()
+            return
+        self.ui_queue.put(callback)
+
+    def drain_ui_queue(self):
+        """无界面模式下依次执行后台线程投递的回调"""
+        while True:
+            callback = self.ui_queue.get()
+            try:
+                callback()
+            except Exception as e:
+                print(f"处理回调时发生错误: {e}")
+
+    def process_ui_queue(self):
+        """在UI线程中处理后台线程投递的回调，并安排下一次轮询"""
+        while True:
+            try:
+                callback = self.ui_queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                callback()
+            except Exception as e:
+                print(f"处理UI回调时发生错误: {e}")
+
+        self.update_process_status()
+        self.root.after(100, self.process_ui_queue)
 
     def 整理_memory(self):
-        """整理短期记忆，使用AI来评估重要性并保存到长期记忆库"""
-        # 分析对话历史，提取信息供AI评估
+        """整理短期记忆，使用AI来评估重要性并保存到长期记忆库（在后台线程中执行）"""
+        self.job_runner.ensure_background_thread("memory整理")
+
+        # 只提取上次评估之后的新对话，供AI评估
         reference_conversations = self.extract_important_conversations()
 
         if reference_conversations:
-            # 使用AI来判断哪些对话是重要的，需要保存到长期记忆
-            self.request_ai_memory_evaluation(reference_conversations)
+            # 按token预算分批提交，每批评估成功后推进已评估位置
+            token_budget = self.config.get("memory_evaluation_token_budget", 3000)
+            batches = self.split_conversations_by_token_budget(reference_conversations, token_budget)
+            for batch in batches:
+                # 使用AI来判断哪些对话是重要的，需要保存到长期记忆
+                if not self.request_ai_memory_evaluation(batch):
+                    break  # 评估失败时保留位置，下次从这里继续
+
+                with self.memory_lock:
+                    self.memory["memory_evaluation"]["last_evaluated_seq"] = batch[-1]["seq"]
+                    self.save_memory()
         else:
-            print("没有足够的对话历史来进行记忆评估")
-
-        print(f"记忆库整理完成，当前长期记忆库大小: {len(self.memory['long_term_memory'])}")
+            print("自上次记忆评估以来没有新的对话，跳过本次评估")
 
-        # 继续安排下一次整理任务（使用新配置的时间间隔）
-        # 重新计算时间间隔以确保使用最新配置
-        整理_interval_minutes = self.config.get("memory整理_interval", 60)  # 重新获取当前配置
-        整理_interval_ms = 整理_interval_minutes * 60 * 1000
-        self.root.after(整理_interval_ms, self.整理_memory)  # 重新安排任务
+        return f"记忆库整理完成，当前长期记忆库大小: {len(self.memory['long_term_memory'])}"
 
     def request_ai_memory_evaluation(self, reference_conversations):
         """请求AI评估哪些对话重要并需要保存到长期记忆"""
@@ -345,43 +1931,19 @@ class OPAIApp:
         ]
 
         # 检查配置是否完整
-        if not self.config.get("api_url") or not self.config.get("api_key") or not self.config.get("model"):
+        if not self.is_api_configured():
             print("无法评估记忆：API配置不完整")
-            return
+            return False
 
         try:
-            # 准备API请求
-            headers = {"Content-Type": "application/json"}
-
-            # 对于OpenAI API风格的服务，使用Bearer认证
-            if "openai.com" in self.config["api_url"] or "api.openai.com" in self.config["api_url"]:
-                headers["Authorization"] = f"Bearer {self.config['api_key']}"
-            # 对于Azure OpenAI
-            elif "azure.com" in self.config["api_url"] or "openai.azure.com" in self.config["api_url"]:
-                headers["api-key"] = self.config['api_key']
-            # 对于其他API服务
-            else:
-                headers["Authorization"] = f"Bearer {self.config['api_key']}"
-
             data = {
                 "model": self.config["model"],
                 "messages": temp_messages,
                 "temperature": 0.3  # 较低的temperature以获得更准确的分析
             }
 
-            import urllib3
-            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-            # 创建不使用系统代理的会话
-            session = requests.Session()
-            session.trust_env = False
-
-            response = session.post(
-                self.config["api_url"],
-                headers=headers,
-                json=data,
-                timeout=60
-            )
+            # 记忆评估属于后台请求，走低优先级通道
+            response = self.post_api_request(data, lane="background", timeout=60, stage="memory_evaluation")
 
             if response.status_code == 200:
                 result = response.json()
@@ -415,24 +1977,31 @@ class OPAIApp:
 
                 except (KeyError, IndexError):
                     print(f"无法从API响应中提取AI评估结果: {result}")
+
+                # 请求已成功完成，这批对话视为已评估（即使结果无法解析，也不再重复提交）
+                return True
             else:
                 print(f"AI记忆评估请求失败：{response.status_code} - {response.text}")
 
         except Exception as e:
             print(f"AI记忆评估过程中发生错误: {str(e)}")
 
+        return False
+
     def extract_important_conversations(self):
-        """从对话历史中提取重要对话，仅作为AI总结的参考"""
+        """从对话历史中提取上次评估之后的新对话，仅作为AI总结的参考"""
         # 这个函数现在只用于提供给AI进行总结的参考信息
         # 不再自动将信息添加到长期记忆库
         important_items = []
 
-        # 获取最近的对话历史作为AI总结的参考
-        # 限制为最近的50条记录以避免上下文过长
-        recent_history = self.conversation_history[-50:] if len(self.conversation_history) > 50 else self.conversation_history
+        # 只提取序号大于已评估位置的对话，避免重复提交相同内容
+        last_evaluated_seq = self.memory["memory_evaluation"].get("last_evaluated_seq", 0)
 
-        for entry in recent_history:
+        for entry in self.conversation_history:
+            if entry.get("seq", 0) <= last_evaluated_seq:
+                continue
             important_items.append({
+                "seq": entry.get("seq"),
                 "timestamp": entry.get("timestamp"),
                 "sender": entry.get("sender"),
                 "message": entry.get("message"),
@@ -441,6 +2010,40 @@ class OPAIApp:
 
         return important_items
 
+    def estimate_tokens(self, text):
+        """粗略估算文本的token数（中文按每字1个token，其他字符按每4个字符1个token）"""
+        cjk_count = len(re.findall(r'[\u4e00-\u9fff]', text))
+        return cjk_count + (len(text) - cjk_count) // 4 + 1
+
+    def split_conversations_by_token_budget(self, conversations, token_budget):
+        """将对话按token预算切分为多个批次，每批的估算token数不超过预算"""
+        batches = []
+        current_batch = []
+        current_tokens = 0
+
+        for conv in conversations:
+            message = conv.get("message") or ""
+            tokens = self.estimate_tokens(message)
+
+            # 单条消息超过预算时截断，保证每批都能提交
+            if tokens > token_budget:
+                message = message[:token_budget] + "..."
+                conv = dict(conv, message=message)
+                tokens = self.estimate_tokens(message)
+
+            if current_batch and current_tokens + tokens > token_budget:
+                batches.append(current_batch)
+                current_batch = []
+                current_tokens = 0
+
+            current_batch.append(conv)
+            current_tokens += tokens
+
+        if current_batch:
+            batches.append(current_batch)
+
+        return batches
+
     def add_to_long_term_memory(self, content, tags=None):
         """手动将重要信息添加到长期记忆库 - 只能通过AI总结或特殊指令调用"""
         if tags is None:
@@ -454,11 +2057,12 @@ class OPAIApp:
             "added_by": "AI_Summary"  # 标记为AI总结添加
         }
 
-        # 将条目添加到长期记忆库
-        self.memory["long_term_memory"].append(memory_entry)
+        with self.memory_lock:
+            # 将条目添加到长期记忆库
+            self.memory["long_term_memory"].append(memory_entry)
 
-        # 保存记忆库（不再限制条目数量）
-        self.save_memory()
+            # 保存记忆库（不再限制条目数量）
+            self.save_memory()
 
         print(f"已将信息添加到长期记忆库: {content[:50]}...")
 
@@ -484,8 +2088,12 @@ class OPAIApp:
         # 获取相似度阈值
         similarity_threshold = self.config.get("memory_similarity_threshold", 85)
 
+        # 多个对话可能同时查询，而后台任务会修改记忆库，先在锁内取快照
+        with self.memory_lock:
+            long_term_memory = list(self.memory.get("long_term_memory", []))
+
         # 遍历长期记忆库中的所有记忆
-        for memory_item in self.memory.get("long_term_memory", []):
+        for memory_item in long_term_memory:
             # 对于新格式的记忆项，使用 'content' 字段
             # 对于旧格式的记忆项，使用 'message' 字段
             memory_text = memory_item.get("content", memory_item.get("message", ""))
@@ -519,67 +2127,25 @@ class OPAIApp:
         return relevant_memories[:5]
 
     def create_memory_summary(self):
-        """创建记忆库总结"""
-        # 获取当前时间
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        """创建记忆库总结（在后台线程中执行）"""
+        self.job_runner.ensure_background_thread("memory_summary")
 
-        # 分析对话历史
-        user_messages = [entry for entry in self.conversation_history if entry["sender"] == "用户"]
-        ai_messages = [entry for entry in self.conversation_history if entry["sender"] == "AI"]
-        system_messages = [entry for entry in self.conversation_history if entry["sender"] == "系统"]
-
-        # 生成总结内容
-        summary_content = f"定期总结 - {current_time}\n"
-        summary_content += f"- 本次会话期间，用户发送了 {len(user_messages)} 条消息\n"
-        summary_content += f"- AI回复了 {len(ai_messages)} 条消息\n"
-        summary_content += f"- 系统发送了 {len(system_messages)} 条消息\n"
-        summary_content += f"- 当前已导入 {len(self.memory['programs'])} 个程序到记忆库\n"
-        summary_content += f"- 长期记忆库中包含 {len(self.memory['long_term_memory'])} 条重要信息\n"
-
-        # 如果有用户消息，添加最近的几条
-        if user_messages:
-            summary_content += "- 最近的用户请求:\n"
-            # 显示最近的3条用户消息
-            recent_user_msgs = user_messages[-3:]
-            for msg in recent_user_msgs:
-                msg_preview = msg["message"][:50] + "..." if len(msg["message"]) > 50 else msg["message"]
-                summary_content += f"  * {msg_preview}\n"
-
-        # 创建总结条目
-        summary = {
-            "date": current_time,
-            "type": "periodic_summary",
-            "content": summary_content
-        }
-
-        # 添加到记忆库的总结列表
-        self.memory["summaries"].append(summary)
-
-        # 限制总结数量，只保留最近的10条
-        if len(self.memory["summaries"]) > 10:
-            self.memory["summaries"] = self.memory["summaries"][-10:]
-
-        # 保存记忆库
-        self.save_memory()
-
-        # 显示提示信息（不直接显示在聊天窗口中，以免打扰用户）
-        print(f"记忆库总结已创建于 {current_time}")
-
-        # 继续设置下一次的总结任务（使用新配置的时间间隔）
-        # 重新计算时间间隔以确保使用最新配置
-        save_interval_minutes = self.config.get("conversation_save_interval", 30)  # 重新获取当前配置
-        save_interval_ms = save_interval_minutes * 60 * 1000
-        self.root.after(save_interval_ms, self.create_memory_summary)  # 重新安排任务
-
-    def create_memory_summary(self):
-        """创建记忆库总结"""
         # 获取当前时间
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        # 分析对话历史
-        user_messages = [entry for entry in self.conversation_history if entry["sender"] == "用户"]
-        ai_messages = [entry for entry in self.conversation_history if entry["sender"] == "AI"]
-        system_messages = [entry for entry in self.conversation_history if entry["sender"] == "系统"]
+        # 分析对话历史（先取快照，单次遍历统计各角色消息）
+        with self.memory_lock:
+            history_snapshot = list(self.conversation_history)
+        user_messages = []
+        ai_messages = []
+        system_messages = []
+        for entry in history_snapshot:
+            if entry["sender"] == "用户":
+                user_messages.append(entry)
+            elif entry["sender"] == "AI":
+                ai_messages.append(entry)
+            elif entry["sender"] == "系统":
+                system_messages.append(entry)
 
         # 生成总结内容
         summary_content = f"定期总结 - {current_time}\n"
@@ -605,24 +2171,18 @@ class OPAIApp:
             "content": summary_content
         }
 
-        # 添加到记忆库的总结列表
-        self.memory["summaries"].append(summary)
+        with self.memory_lock:
+            # 添加到记忆库的总结列表
+            self.memory["summaries"].append(summary)
 
-        # 限制总结数量，只保留最近的10条
-        if len(self.memory["summaries"]) > 10:
-            self.memory["summaries"] = self.memory["summaries"][-10:]
+            # 限制总结数量，只保留最近的10条
+            if len(self.memory["summaries"]) > 10:
+                self.memory["summaries"] = self.memory["summaries"][-10:]
 
-        # 保存记忆库
-        self.save_memory()
-
-        # 显示提示信息（不直接显示在聊天窗口中，以免打扰用户）
-        print(f"记忆库总结已创建于 {current_time}")
+            # 保存记忆库
+            self.save_memory()
 
-        # 继续设置下一次的总结任务（使用新配置的时间间隔）
-        # 重新计算时间间隔以确保使用最新配置
-        save_interval_minutes = self.config.get("conversation_save_interval", 30)  # 重新获取当前配置
-        save_interval_ms = save_interval_minutes * 60 * 1000
-        self.root.after(save_interval_ms, self.create_memory_summary)  # 重新安排任务
+        return f"记忆库总结已创建于 {current_time}"
     
     def handle_enter_key(self, event):
         """处理回车键事件，如果同时按下Shift则换行，否则发送消息"""
@@ -632,9 +2192,16 @@ class OPAIApp:
             self.send_message()  # 发送消息
             return "break"  # 阻止默认换行行为
     
-    def display_message(self, sender, message):
-        """在对话记录框中显示消息"""
-        self.chat_display.config(state=tk.NORMAL)
+    def display_message(self, sender, message, conversation_id=None):
+        """在对话记录框中显示消息（默认显示在当前对话的标签页中）"""
+        tab = self.conversation_tabs.get(conversation_id or self.current_conversation.conversation_id)
+        if tab is None:
+            # 标签页已关闭，只记录对话历史
+            self.record_history(sender, message)
+            return
+
+        chat_display = tab["chat_display"]
+        chat_display.config(state=tk.NORMAL)
         timestamp = datetime.now().strftime("%H:%M:%S")
 
         # 将Markdown格式转换为tkinter Text组件支持的格式
@@ -654,37 +2221,47 @@ class OPAIApp:
             color = colors["fg"]  # 默认颜色
 
         # 获取起始位置，用于后续着色
-        start_pos = self.chat_display.index("end-2c")
+        start_pos = chat_display.index("end-2c")
 
         # 插入时间戳
         timestamp_text = f"[{timestamp}] "
-        self.chat_display.insert(tk.END, timestamp_text)
+        chat_display.insert(tk.END, timestamp_text)
 
         # 设置时间戳颜色
-        self.chat_display.tag_add("timestamp", start_pos, f"{start_pos}+{len(timestamp_text)}c")
-        self.chat_display.tag_config("timestamp", foreground=colors["timestamp_fg"])
+        chat_display.tag_add("timestamp", start_pos, f"{start_pos}+{len(timestamp_text)}c")
+        chat_display.tag_config("timestamp", foreground=colors["timestamp_fg"])
 
         # 插入发送者和消息
         sender_text = f"{sender}: "
-        self.chat_display.insert(tk.END, sender_text)
-        self.chat_display.tag_add("sender", f"{start_pos}+{len(timestamp_text)}c", f"{start_pos}+{len(timestamp_text+sender_text)}c")
-        self.chat_display.tag_config("sender", foreground=color, font=("微软雅黑", 10, "bold"))
+        chat_display.insert(tk.END, sender_text)
+        chat_display.tag_add("sender", f"{start_pos}+{len(timestamp_text)}c", f"{start_pos}+{len(timestamp_text+sender_text)}c")
+        chat_display.tag_config("sender", foreground=color, font=("微软雅黑", 10, "bold"))
 
         # 插入消息内容
         message_start = f"{start_pos}+{len(timestamp_text+sender_text)}c"
-        self.chat_display.insert(tk.END, f"{formatted_message}\n\n")
-        self.chat_display.tag_add("message", message_start, f"{message_start}+{len(formatted_message)}c")
-        self.chat_display.tag_config("message", foreground=color)
+        chat_display.insert(tk.END, f"{formatted_message}\n\n")
+        chat_display.tag_add("message", message_start, f"{message_start}+{len(formatted_message)}c")
+        chat_display.tag_config("message", foreground=color)
 
-        self.chat_display.config(state=tk.DISABLED)
-        self.chat_display.see(tk.END)  # 自动滚动到底部
+        chat_display.config(state=tk.DISABLED)
+        chat_display.see(tk.END)  # 自动滚动到底部
 
         # 同时记录到对话历史
-        self.conversation_history.append({
-            "timestamp": timestamp,
-            "sender": sender,
-            "message": message
-        })
+        self.record_history(sender, message, timestamp)
+
+    def record_history(self, sender, message, timestamp=None):
+        """记录一条对话历史（序号单调递增并持久化，用于增量记忆评估）"""
+        timestamp = timestamp or datetime.now().strftime("%H:%M:%S")
+        with self.memory_lock:
+            evaluation_state = self.memory["memory_evaluation"]
+            seq = evaluation_state.get("next_seq", 1)
+            evaluation_state["next_seq"] = seq + 1
+            self.conversation_history.append({
+                "seq": seq,
+                "timestamp": timestamp,
+                "sender": sender,
+                "message": message
+            })
     
     def convert_markdown_to_text(self, markdown_text):
         """将Markdown格式转换为普通文本（简化实现）"""
@@ -785,26 +2362,56 @@ class OPAIApp:
         if not user_text:
             return
 
+        conversation = self.current_conversation
+
         # 显示用户消息
         self.display_message("用户", user_text)
 
         # 清空输入框
         self.user_input.delete("1.0", tk.END)
 
+        # 当前对话仍在生成回复时，消息先排队，等这一轮结束后再发出
+        if conversation.turn_active:
+            conversation.pending_messages.append(user_text)
+            self.display_message("系统", f"消息已排队（共 {len(conversation.pending_messages)} 条），将在当前回复结束后发送。")
+            return
+
+        self.start_conversation_turn(conversation, user_text)
+
+    def start_conversation_turn(self, conversation, user_text):
+        """在异步引擎中处理一轮对话，各对话的回复可同时进行"""
+        conversation.turn_active = True
+        conversation.turn_id += 1
+        conversation.response_future = self.engine.submit(self.get_ai_response(user_text, conversation, conversation.turn_id))
+
         # 更新按钮为停止生成
-        self.send_button.config(text="停止", command=self.stop_generation)
+        self.update_send_button()
 
-        # 在新线程中处理AI响应
-        self.response_thread = threading.Thread(
-            target=self.get_ai_response,
-            args=(user_text,)
-        )
-        self.response_thread.start()
+    def dispatch_pending_messages(self, conversation):
+        """一轮对话结束后发出排队的消息；开启合并时，排队的多条消息合并为一轮发送"""
+        if not conversation.pending_messages:
+            return False
+
+        if self.config.get("coalesce_queued_messages", True):
+            user_text = "\n\n".join(conversation.pending_messages)
+            conversation.pending_messages = []
+        else:
+            user_text = conversation.pending_messages.pop(0)
+
+        self.start_conversation_turn(conversation, user_text)
+        return True
 
     def stop_generation(self):
         """停止AI生成"""
-        # 这里可以实现停止逻辑
-        self.display_message("系统", "已停止生成响应。")
+        # 取消当前对话正在进行的对话流程（已在线程池中执行的请求或命令会在完成后被丢弃）
+        conversation = self.current_conversation
+        dropped = len(conversation.pending_messages)
+        conversation.pending_messages = []  # 停止时一并丢弃排队的消息
+        conversation.turn_active = False
+        future = conversation.response_future
+        if future is not None and not future.done():
+            future.cancel()
+        self.display_message("系统", f"已停止生成响应，并丢弃 {dropped} 条排队消息。" if dropped else "已停止生成响应。")
         self.send_button.config(text="发送", command=self.send_message)
 
     def process_command(self, user_message):
@@ -859,124 +2466,260 @@ class OPAIApp:
         return None  # 不是系统命令，返回None
     
     def execute_json_commands(self, json_commands):
-        """执行JSON格式的命令"""
-        executed_commands = []
-        for cmd in json_commands:
-            cmd_type = cmd.get("type")
-            cmd_params = cmd.get("params", {})
+        """执行JSON格式的命令：按路径读写关系排出依赖，互不相关的命令并行执行
+
+        返回的结果与命令一一对应，顺序与命令顺序一致。
+        """
+        dependencies = self.plan_command_dependencies(json_commands)
+        max_parallelism = max(1, int(self.config.get("command_max_parallelism", 4)))
+        if max_parallelism == 1 or len(json_commands) <= 1:
+            return [self.execute_json_command(cmd) for cmd in json_commands]
+
+        from concurrent.futures import wait, FIRST_COMPLETED
+
+        results = [None] * len(json_commands)
+        remaining = {index: set(predecessors) for index, predecessors in enumerate(dependencies)}
+        dependents = {index: [] for index in range(len(json_commands))}
+        for index, predecessors in enumerate(dependencies):
+            for predecessor in predecessors:
+                dependents[predecessor].append(index)
+
+        # 沿用调用方的上下文变量（当前对话），命令结果才会计入正确的对话
+        context = contextvars.copy_context()
+        running = {}
+        with ThreadPoolExecutor(max_workers=max_parallelism, thread_name_prefix="OPAI-Cmd") as executor:
+            while remaining or running:
+                # 依赖已完成的命令按原顺序提交，同时运行的命令数不超过上限
+                ready = sorted(index for index, predecessors in remaining.items() if not predecessors)
+                for index in ready[:max_parallelism - len(running)]:
+                    del remaining[index]
+                    future = executor.submit(context.copy().run, self.execute_json_command, json_commands[index])
+                    running[future] = index
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = running.pop(future)
+                    try:
+                        results[index] = future.result()
+                    except Exception as e:
+                        results[index] = f"执行命令时发生错误: {str(e)}"
+                    for dependent in dependents[index]:
+                        remaining[dependent].discard(index)
+
+        return results
+
+    def get_command_resources(self, cmd):
+        """返回命令读取和写入的路径（绝对路径），以及是否为屏障命令（与前后所有命令都有依赖）"""
+        cmd_type = cmd.get("type")
+        cmd_params = cmd.get("params", {}) or {}
+        path = cmd_params.get("path")
+        full_path = os.path.abspath(path) if isinstance(path, str) and path else None
+
+        if cmd_type in ["run_bash", "run_cmd", "run_powershell"]:
+            return set(), set(), True  # 命令行可能读写任意位置
+        if full_path is None:
+            return set(), set(), False
+        if cmd_type in ["create_file", "create_folder", "edit_file"]:
+            return set(), {full_path}, False
+        if cmd_type in ["read_file", "list_dir"]:
+            return {full_path}, set(), False
+        if cmd_type in ["run_python", "run_javascript", "run_java", "run_cpp", "run_c"]:
+            # 运行程序会读取所在目录、可能在其中生成文件（编译产物、程序输出）；
+            # 用特殊资源"<process>"让各个程序按顺序运行
+            directory = os.path.dirname(full_path)
+            return {full_path}, {directory, "<process>"}, False
+        if cmd_type == "build":
+            # 构建会在项目目录中生成产物
+            return {full_path}, {full_path, "<process>"}, False
+        return set(), set(), False  # message、read_output等不涉及文件
+
+    def plan_command_dependencies(self, json_commands):
+        """根据读写的路径计算每个命令必须等待的前序命令（下标集合）
+
+        两个命令涉及相同路径或存在父子目录关系、且至少一方写入时，后者依赖前者；
+        因此写文件在运行该文件之前，创建文件夹在其中的文件之前。
+        """
+        def overlaps(path_a, path_b):
+            if path_a == path_b:
+                return True
+            if path_a.startswith("<") or path_b.startswith("<"):
+                return False
+            return path_a.startswith(path_b.rstrip(os.sep) + os.sep) or path_b.startswith(path_a.rstrip(os.sep) + os.sep)
+
+        def conflicts(paths_a, paths_b):
+            return any(overlaps(a, b) for a in paths_a for b in paths_b)
+
+        resources = [self.get_command_resources(cmd) for cmd in json_commands]
+        dependencies = []
+        for index, (reads, writes, barrier) in enumerate(resources):
+            predecessors = set()
+            for previous in range(index):
+                previous_reads, previous_writes, previous_barrier = resources[previous]
+                if (barrier or previous_barrier or
+                        conflicts(writes, previous_reads | previous_writes) or
+                        conflicts(reads, previous_writes)):
+                    predecessors.add(previous)
+            dependencies.append(predecessors)
+        return dependencies
+
+    def execute_json_command(self, cmd):
+        """执行单条JSON格式的命令，返回执行结果"""
+        cmd_type = cmd.get("type")
+        cmd_params = cmd.get("params", {})
+
+        if cmd_type == "create_file":
+            # 格式: {"type": "create_file", "params": {"path": "file.py", "content": "print('hello')"}}
+            file_path = cmd_params.get("path")
+            content = cmd_params.get("content")
+            try:
+                with open(file_path, 'w', encoding='utf-8') as f:
+                    f.write(content)
+                result = f"文件 '{file_path}' 创建成功！"
+            except Exception as e:
+                result = f"创建文件失败：{str(e)}"
+            return result  # 只返回执行结果，不包含命令描述
+
+        elif cmd_type == "edit_file":
+            # 格式: {"type": "edit_file", "params": {"path": "file.py", "edits": [{"search": "原内容", "replace": "新内容"}]}}
+            #   或: {"type": "edit_file", "params": {"path": "file.py", "diff": "统一diff格式的补丁"}}
+            file_path = cmd_params.get("path")
+            result = self.edit_file(file_path, cmd_params.get("edits"), cmd_params.get("diff"))
+            return result  # 只返回执行结果，不包含命令描述
             
-            if cmd_type == "create_file":
-                # 格式: {"type": "create_file", "params": {"path": "file.py", "content": "print('hello')"}}
-                file_path = cmd_params.get("path")
-                content = cmd_params.get("content")
-                try:
-                    with open(file_path, 'w', encoding='utf-8') as f:
-                        f.write(content)
-                    result = f"文件 '{file_path}' 创建成功！"
-                except Exception as e:
-                    result = f"创建文件失败：{str(e)}"
-                executed_commands.append(result)  # 只返回执行结果，不包含命令描述
-                
-            elif cmd_type == "create_folder":
-                # 格式: {"type": "create_folder", "params": {"path": "my_folder"}}
-                folder_path = cmd_params.get("path")
-                try:
-                    os.makedirs(folder_path, exist_ok=True)
-                    result = f"文件夹 '{folder_path}' 创建成功！"
-                except Exception as e:
-                    result = f"创建文件夹失败：{str(e)}"
-                executed_commands.append(result)  # 只返回执行结果，不包含命令描述
-                
-            elif cmd_type == "run_python":
-                # 格式: {"type": "run_python", "params": {"path": "script.py"}}
-                file_path = cmd_params.get("path")
-                result = self.run_python_file(f"/run python {file_path}")
-                executed_commands.append(result)  # 只返回执行结果，不包含命令描述
-                
-            elif cmd_type == "run_javascript":
-                # 格式: {"type": "run_javascript", "params": {"path": "script.js"}}
-                file_path = cmd_params.get("path")
-                result = self.run_javascript_file(file_path)
-                executed_commands.append(result)  # 只返回执行结果，不包含命令描述
-                
-            elif cmd_type == "run_java":
-                # 格式: {"type": "run_java", "params": {"path": "program.java"}}
-                file_path = cmd_params.get("path")
-                result = self.run_java_file(file_path)
-                executed_commands.append(result)  # 只返回执行结果，不包含命令描述
-                
-            elif cmd_type == "run_cpp":
-                # 格式: {"type": "run_cpp", "params": {"path": "program.cpp"}}
-                file_path = cmd_params.get("path")
-                result = self.run_cpp_file(file_path)
-                executed_commands.append(result)  # 只返回执行结果，不包含命令描述
-                
-            elif cmd_type == "run_c":
-                # 格式: {"type": "run_c", "params": {"path": "program.c"}}
-                file_path = cmd_params.get("path")
-                result = self.run_c_file(file_path)
-                executed_commands.append(result)  # 只返回执行结果，不包含命令描述
-                
-            elif cmd_type == "run_bash":
-                # 格式: {"type": "run_bash", "params": {"command": "ls -la"}}
-                command = cmd_params.get("command")
-                result = self.run_bash_command(command)
-                executed_commands.append(result)  # 只返回执行结果，不包含命令描述
-                
-            elif cmd_type == "run_cmd":
-                # 格式: {"type": "run_cmd", "params": {"command": "dir"}}
-                command = cmd_params.get("command")
-                # 检查是否为高危命令
-                if self.is_high_risk_command(command):
-                    # 需要用户确认
-                    confirmed = self.ask_user_confirmation(f"检测到高危CMD命令，是否执行？\n命令: {command}")
-                    if confirmed:
-                        result = self.run_cmd_command(command)
-                    else:
-                        result = f"用户取消执行高危命令: {command}"
-                else:
+        elif cmd_type == "create_folder":
+            # 格式: {"type": "create_folder", "params": {"path": "my_folder"}}
+            folder_path = cmd_params.get("path")
+            try:
+                os.makedirs(folder_path, exist_ok=True)
+                result = f"文件夹 '{folder_path}' 创建成功！"
+            except Exception as e:
+                result = f"创建文件夹失败：{str(e)}"
+            return result  # 只返回执行结果，不包含命令描述
+            
+        elif cmd_type == "run_python":
+            # 格式: {"type": "run_python", "params": {"path": "script.py"}}
+            file_path = cmd_params.get("path")
+            result = self.run_python_file(f"/run python {file_path}")
+            return result  # 只返回执行结果，不包含命令描述
+            
+        elif cmd_type == "run_javascript":
+            # 格式: {"type": "run_javascript", "params": {"path": "script.js"}}
+            file_path = cmd_params.get("path")
+            result = self.run_javascript_file(file_path)
+            return result  # 只返回执行结果，不包含命令描述
+            
+        elif cmd_type == "run_java":
+            # 格式: {"type": "run_java", "params": {"path": "program.java"}}
+            file_path = cmd_params.get("path")
+            result = self.run_java_file(file_path)
+            return result  # 只返回执行结果，不包含命令描述
+            
+        elif cmd_type == "run_cpp":
+            # 格式: {"type": "run_cpp", "params": {"path": "program.cpp"}}
+            file_path = cmd_params.get("path")
+            result = self.run_cpp_file(file_path)
+            return result  # 只返回执行结果，不包含命令描述
+            
+        elif cmd_type == "run_c":
+            # 格式: {"type": "run_c", "params": {"path": "program.c"}}
+            file_path = cmd_params.get("path")
+            result = self.run_c_file(file_path)
+            return result  # 只返回执行结果，不包含命令描述
+
+        elif cmd_type == "build":
+            # 格式: {"type": "build", "params": {"path": "project_dir", "target": "可选的构建目标"}}
+            project_path = cmd_params.get("path")
+            result = self.run_build(project_path, cmd_params.get("target"))
+            return result  # 只返回执行结果，不包含命令描述
+            
+        elif cmd_type == "run_bash":
+            # 格式: {"type": "run_bash", "params": {"command": "ls -la"}}
+            command = cmd_params.get("command")
+            result = self.run_bash_command(command)
+            return result  # 只返回执行结果，不包含命令描述
+            
+        elif cmd_type == "run_cmd":
+            # 格式: {"type": "run_cmd", "params": {"command": "dir"}}
+            command = cmd_params.get("command")
+            # 检查是否为高危命令
+            if self.is_high_risk_command(command):
+                # 需要用户确认
+                confirmed = self.ask_user_confirmation(f"检测到高危CMD命令，是否执行？\n命令: {command}")
+                if confirmed:
                     result = self.run_cmd_command(command)
-                executed_commands.append(result)  # 只返回执行结果，不包含命令描述
-
-            elif cmd_type == "run_powershell":
-                # 格式: {"type": "run_powershell", "params": {"command": "Get-Process"}}
-                command = cmd_params.get("command")
-                # 检查是否为高危命令
-                if self.is_high_risk_powershell_command(command):
-                    # 需要用户确认
-                    confirmed = self.ask_user_confirmation(f"检测到高危PowerShell命令，是否执行？\n命令: {command}")
-                    if confirmed:
-                        result = self.run_powershell_command(command)
-                    else:
-                        result = f"用户取消执行高危PowerShell命令: {command}"
                 else:
+                    result = f"用户取消执行高危命令: {command}"
+            else:
+                result = self.run_cmd_command(command)
+            return result  # 只返回执行结果，不包含命令描述
+
+        elif cmd_type == "run_powershell":
+            # 格式: {"type": "run_powershell", "params": {"command": "Get-Process"}}
+            command = cmd_params.get("command")
+            # 检查是否为高危命令
+            if self.is_high_risk_powershell_command(command):
+                # 需要用户确认
+                confirmed = self.ask_user_confirmation(f"检测到高危PowerShell命令，是否执行？\n命令: {command}")
+                if confirmed:
                     result = self.run_powershell_command(command)
-                executed_commands.append(result)  # 只返回执行结果，不包含命令描述
-                
-            elif cmd_type == "read_file":
-                # 格式: {"type": "read_file", "params": {"path": "file.py"}}
-                file_path = cmd_params.get("path")
-                result = self.read_file_content(f"/read file {file_path}")
-                executed_commands.append(result)  # 只返回执行结果，不包含命令描述
-                
-            elif cmd_type == "list_dir":
-                # 格式: {"type": "list_dir", "params": {"path": "directory"}}
-                dir_path = cmd_params.get("path")
-                result = self.process_command(f"/list dir {dir_path}")
-                executed_commands.append(result)  # 只返回执行结果，不包含命令描述
-                
-            elif cmd_type == "message":
-                # 格式: {"type": "message", "params": {"content": "This is a message"}}
-                content = cmd_params.get("content")
-                executed_commands.append(content)  # 返回消息内容
-        
-        return executed_commands
+                else:
+                    result = f"用户取消执行高危PowerShell命令: {command}"
+            else:
+                result = self.run_powershell_command(command)
+            return result  # 只返回执行结果，不包含命令描述
+            
+        elif cmd_type == "read_file":
+            # 格式: {"type": "read_file", "params": {"path": "file.py", "offset": 0, "limit": 200}}
+            #   可选参数: "unit": "bytes"按字节读取, "tail": 100读取最后100行, "grep": "正则"搜索并显示"context"行上下文
+            file_path = cmd_params.get("path")
+            result = self.read_file_content(file_path, cmd_params.get("offset"), cmd_params.get("limit"), cmd_params.get("unit", "lines"),
+                                            cmd_params.get("tail"), cmd_params.get("grep"), cmd_params.get("context", 2))
+            return result  # 只返回执行结果，不包含命令描述
+            
+        elif cmd_type == "list_dir":
+            # 格式: {"type": "list_dir", "params": {"path": "directory"}}
+            dir_path = cmd_params.get("path")
+            result = self.process_command(f"/list dir {dir_path}")
+            return result  # 只返回执行结果，不包含命令描述
+            
+        elif cmd_type == "read_output":
+            # 格式: {"type": "read_output", "params": {"id": "out-1a2b3c4d5e", "offset": 0, "limit": 200}}
+            output_id = cmd_params.get("id")
+            result = self.read_command_output(output_id, cmd_params.get("offset", 0), cmd_params.get("limit", 200))
+            return result  # 只返回执行结果，不包含命令描述
+
+        elif cmd_type == "message":
+            # 格式: {"type": "message", "params": {"content": "This is a message"}}
+            content = cmd_params.get("content")
+            return content  # 返回消息内容
+
+        return f"未知的命令类型：{cmd_type}"
 
     def ask_user_confirmation(self, message):
         """弹出确认对话框，询问用户是否执行高危操作"""
         import tkinter as tk
         from tkinter import messagebox
 
+        # 无界面模式下无法确认，高危命令一律不执行
+        if self.headless:
+            print(f"无界面模式下拒绝执行需要确认的操作: {message}")
+            return False
+
+        # 命令在引擎线程池中执行，对话框必须交给UI线程弹出，这里阻塞等待用户选择
+        if threading.current_thread() is not threading.main_thread():
+            answered = threading.Event()
+            answer = {"confirmed": False}
+
+            def ask():
+                try:
+                    answer["confirmed"] = self.ask_user_confirmation(message)
+                finally:
+                    answered.set()
+
+            self.post_to_ui(ask)
+            answered.wait()
+            return answer["confirmed"]
+
         # 创建一个临时的根窗口，如果不存在的话
         temp_root = None
         if not self.root.winfo_exists():
@@ -1014,153 +2757,259 @@ class OPAIApp:
         command_lower = command.lower()
         return any(keyword in command_lower for keyword in high_risk_keywords)
 
+    def get_command_limits(self, command_type):
+        """返回命令类型的超时时间和资源上限：timeout（秒）、memory_mb、cpu_seconds、max_output_bytes（0为不限制）"""
+        configured = self.config.get("command_limits", {})
+        limits = {"timeout": 30, "memory_mb": 0, "cpu_seconds": 0, "max_output_bytes": 0}
+        limits.update(configured.get("default", {}))
+        limits.update(configured.get(command_type, {}))
+        return limits
+
+    def run_streaming_process(self, args, shell=False, cwd=None, timeout=None, label=None, spawn=None, command_type=None):
+        """执行命令用的子进程：输出实时通过引擎事件流推送到当前对话，结束后返回完整结果
+
+        超时时间和资源上限按command_type（如run_python、build）从配置中读取，显式传入的timeout优先。
+        """
+        limits = self.get_command_limits(command_type)
+        if timeout is None:
+            timeout = limits["timeout"]
+        process_id = f"proc-{next(self.process_counter)}"
+        conversation_id = self.conversation.conversation_id
+        label = label or (args if isinstance(args, str) else " ".join(str(arg) for arg in args))
+        start_time = time.time()
+
+        # 结果中只保留输出的首尾部分，完整输出溢出到文件；实时显示的输出总量同样有上限
+        capture = {
+            "head_chars": self.config.get("output_capture_head_chars", 32768),
+            "tail_chars": self.config.get("output_capture_tail_chars", 32768),
+            "spill_dir": self.outputs_dir
+        }
+        live_limit = self.config.get("live_output_total_max_chars", 200000)
+        live_state = {"chars": 0, "stopped": False}
+
+        def on_output(stream, text):
+            if live_state["stopped"]:
+                return
+            if live_state["chars"] + len(text) > live_limit:
+                text = text[:live_limit - live_state["chars"]] + f"\n...(实时输出超过 {live_limit} 个字符，后续内容不再显示，运行结束后显示首尾部分)...\n"
+                live_state["stopped"] = True
+            live_state["chars"] += len(text)
+            self.engine.publish("command_output", process_id=process_id, stream=stream, text=text, conversation_id=conversation_id)
+
+        self.engine.publish("process_started", process_id=process_id, label=label, conversation_id=conversation_id)
+        returncode = None
+        try:
+            result = self.engine.run_process_sync(
+                args, shell=shell, cwd=cwd, timeout=timeout, on_output=on_output, spawn=spawn, limits=limits, capture=capture)
+            returncode = result.returncode
+            return result
+        finally:
+            OutputCapture.prune_spills(self.outputs_dir, self.config.get("output_spill_max_mb", 512) * 1024 * 1024)
+            self.engine.publish(
+                "process_finished",
+                process_id=process_id,
+                returncode=returncode,
+                elapsed=time.time() - start_time,
+                conversation_id=conversation_id
+            )
+
     def run_javascript_file(self, file_path):
-        """运行JavaScript文件"""
+        """运行JavaScript文件（启用守护进程时在常驻Node.js进程的worker线程中运行）"""
         import subprocess
         try:
-            result = subprocess.run(
-                ["node", file_path],
-                capture_output=True,
-                text=True,
-                timeout=30
-            )
+            result = self.run_with_node_daemon(
+                ["node", file_path], {"op": "run", "path": os.path.abspath(file_path)}, command_type="run_javascript")
+            if result is None:
+                result = self.run_streaming_process(
+                    ["node", file_path],
+                    command_type="run_javascript"
+                )
             
             if result.returncode == 0:
                 return f"JavaScript文件运行成功！\n输出:\n{result.stdout}"
             else:
                 return f"JavaScript文件运行失败！\n错误:\n{result.stderr}"
-        except subprocess.TimeoutExpired:
-            return "错误：JavaScript文件运行超时（超过30秒）"
+        except subprocess.TimeoutExpired as e:
+            return f"错误：JavaScript文件运行超时（超过{e.timeout}秒）\n{ResourceLimitExceeded.format_violation('timeout', e.timeout)}{ResourceLimitExceeded.format_output(e.stdout, e.stderr)}"
+        except ResourceLimitExceeded as e:
+            return f"错误：JavaScript文件运行{e}{e.format_output(e.stdout, e.stderr)}"
         except FileNotFoundError:
             return "错误：未找到Node.js。请确保已安装Node.js并添加到系统PATH中。"
         except Exception as e:
             return f"执行JavaScript文件时发生错误: {str(e)}"
 
+    def get_compiler_version(self, compiler, version_flag="--version"):
+        """获取编译器版本信息（作为编译缓存键的一部分，每个编译器只查询一次）"""
+        with self.compiler_versions_lock:
+            if compiler in self.compiler_versions:
+                return self.compiler_versions[compiler]
+        result = self.engine.run_process_sync([compiler, version_flag], timeout=10)
+        version = (result.stdout + result.stderr).strip()
+        with self.compiler_versions_lock:
+            self.compiler_versions[compiler] = version
+        return version
+
+    def read_source_bundle(self, file_path, related_extensions):
+        """读取源文件及同目录下相关文件（头文件、其他Java源文件）的内容，用于计算编译缓存键"""
+        file_path = os.path.abspath(file_path)
+        if not os.path.isfile(file_path):
+            # 不能抛出FileNotFoundError，否则会被当作未找到编译器
+            raise OSError(f"源文件不存在: {file_path}")
+        file_dir = os.path.dirname(file_path)
+        with open(file_path, "rb") as f:
+            parts = [f.read()]
+        for name in sorted(os.listdir(file_dir)):
+            path = os.path.join(file_dir, name)
+            if path == file_path or not name.lower().endswith(related_extensions) or not os.path.isfile(path):
+                continue
+            parts.append(name.encode("utf-8"))
+            with open(path, "rb") as f:
+                parts.append(f.read())
+        return parts
+
+    def compile_with_cache(self, language, compiler, compile_args, file_path, related_extensions, compile_func):
+        """查找编译缓存，未命中时调用compile_func(临时目录)编译；返回(条目目录, 是否命中, 编译失败结果)"""
+        key = self.compile_cache.make_key(
+            language,
+            self.get_compiler_version(compiler, "-version" if compiler == "javac" else "--version"),
+            " ".join(compile_args),
+            *self.read_source_bundle(file_path, related_extensions)
+        )
+        entry_dir = self.compile_cache.lookup(key)
+        if entry_dir is not None:
+            return entry_dir, True, None
+
+        staging_dir = self.compile_cache.create_staging_dir(key)
+        try:
+            compile_result = compile_func(staging_dir)
+        except Exception:
+            self.compile_cache.discard(staging_dir)
+            raise
+        if compile_result.returncode != 0:
+            self.compile_cache.discard(staging_dir)
+            return None, False, compile_result
+        return self.compile_cache.commit(key, staging_dir), False, None
+
     def run_java_file(self, file_path):
-        """运行Java文件"""
+        """运行Java文件（编译产物按源代码内容缓存，源代码未变化时跳过编译）"""
         import subprocess
         import os
         try:
             # 获取文件目录和文件名
+            file_path = os.path.abspath(file_path)
             file_dir = os.path.dirname(file_path)
             file_name = os.path.basename(file_path)
             class_name = os.path.splitext(file_name)[0]
             
-            # 编译Java文件
-            compile_result = subprocess.run(
-                ["javac", file_path],
-                capture_output=True,
-                text=True,
-                timeout=30,
-                cwd=file_dir or '.'
+            # 编译Java文件（同目录下的其他Java源文件也计入缓存键）
+            class_dir, cache_hit, compile_result = self.compile_with_cache(
+                "java", "javac", [], file_path, (".java",),
+                lambda staging_dir: self.run_streaming_process(
+                    ["javac", "-d", staging_dir, file_path],
+                    command_type="run_java",
+                    cwd=file_dir
+                )
             )
             
-            if compile_result.returncode != 0:
+            if compile_result is not None:
                 return f"Java文件编译失败！\n错误:\n{compile_result.stderr}"
+            cache_note = "（编译缓存命中，跳过编译）" if cache_hit else "（编译缓存未命中，已编译并缓存）"
             
             # 运行编译后的类
-            run_result = subprocess.run(
-                ["java", class_name],
-                capture_output=True,
-                text=True,
-                timeout=30,
-                cwd=file_dir or '.'
+            run_result = self.run_streaming_process(
+                ["java", "-cp", class_dir, class_name],
+                command_type="run_java",
+                cwd=file_dir
             )
             
             if run_result.returncode == 0:
-                return f"Java程序运行成功！\n输出:\n{run_result.stdout}"
+                return f"Java程序运行成功！\n{cache_note}\n输出:\n{run_result.stdout}"
             else:
-                return f"Java程序运行失败！\n错误:\n{run_result.stderr}"
-        except subprocess.TimeoutExpired:
-            return "错误：Java程序运行超时（超过30秒）"
+                return f"Java程序运行失败！\n{cache_note}\n错误:\n{run_result.stderr}"
+        except subprocess.TimeoutExpired as e:
+            return f"错误：Java程序运行超时（超过{e.timeout}秒）\n{ResourceLimitExceeded.format_violation('timeout', e.timeout)}{ResourceLimitExceeded.format_output(e.stdout, e.stderr)}"
+        except ResourceLimitExceeded as e:
+            return f"错误：Java程序运行{e}{e.format_output(e.stdout, e.stderr)}"
         except FileNotFoundError:
             return "错误：未找到Java编译器或运行时。请确保已安装Java并添加到系统PATH中。"
         except Exception as e:
             return f"执行Java文件时发生错误: {str(e)}"
 
     def run_cpp_file(self, file_path):
-        """运行C++文件"""
+        """运行C++文件（编译产物按源代码内容缓存，源代码未变化时跳过编译）"""
         import subprocess
         import os
         try:
-            # 生成输出文件名
-            output_path = os.path.splitext(file_path)[0] + '.exe' if os.name == 'nt' else os.path.splitext(file_path)[0]
+            # 可执行文件保存在编译缓存中，不再每次运行后删除
+            executable_name = "program.exe" if os.name == 'nt' else "program"
             
-            # 编译C++文件
-            compile_result = subprocess.run(
-                ["g++", "-o", output_path, file_path],
-                capture_output=True,
-                text=True,
-                timeout=30
+            # 编译C++文件（同目录下的头文件也计入缓存键）
+            cache_dir, cache_hit, compile_result = self.compile_with_cache(
+                "cpp", "g++", ["-o"], file_path, (".h", ".hpp", ".hh", ".hxx"),
+                lambda staging_dir: self.run_streaming_process(
+                    ["g++", "-o", os.path.join(staging_dir, executable_name), file_path],
+                    command_type="run_cpp"
+                )
             )
             
-            if compile_result.returncode != 0:
+            if compile_result is not None:
                 return f"C++文件编译失败！\n错误:\n{compile_result.stderr}"
+            cache_note = "（编译缓存命中，跳过编译）" if cache_hit else "（编译缓存未命中，已编译并缓存）"
             
             # 运行编译后的程序
-            run_result = subprocess.run(
-                [output_path],
-                capture_output=True,
-                text=True,
-                timeout=30
+            run_result = self.run_streaming_process(
+                [os.path.join(cache_dir, executable_name)],
+                command_type="run_cpp"
             )
             
-            # 删除编译后的可执行文件
-            try:
-                os.remove(output_path)
-            except:
-                pass  # 忽略删除失败
-            
             if run_result.returncode == 0:
-                return f"C++程序运行成功！\n输出:\n{run_result.stdout}"
+                return f"C++程序运行成功！\n{cache_note}\n输出:\n{run_result.stdout}"
             else:
-                return f"C++程序运行失败！\n错误:\n{run_result.stderr}"
-        except subprocess.TimeoutExpired:
-            return "错误：C++程序运行超时（超过30秒）"
+                return f"C++程序运行失败！\n{cache_note}\n错误:\n{run_result.stderr}"
+        except subprocess.TimeoutExpired as e:
+            return f"错误：C++程序运行超时（超过{e.timeout}秒）\n{ResourceLimitExceeded.format_violation('timeout', e.timeout)}{ResourceLimitExceeded.format_output(e.stdout, e.stderr)}"
+        except ResourceLimitExceeded as e:
+            return f"错误：C++程序运行{e}{e.format_output(e.stdout, e.stderr)}"
         except FileNotFoundError:
             return "错误：未找到g++编译器。请确保已安装GCC编译器并添加到系统PATH中。"
         except Exception as e:
             return f"执行C++文件时发生错误: {str(e)}"
 
     def run_c_file(self, file_path):
-        """运行C文件"""
+        """运行C文件（编译产物按源代码内容缓存，源代码未变化时跳过编译）"""
         import subprocess
         import os
         try:
-            # 生成输出文件名
-            output_path = os.path.splitext(file_path)[0] + '.exe' if os.name == 'nt' else os.path.splitext(file_path)[0]
+            # 可执行文件保存在编译缓存中，不再每次运行后删除
+            executable_name = "program.exe" if os.name == 'nt' else "program"
             
-            # 编译C文件
-            compile_result = subprocess.run(
-                ["gcc", "-o", output_path, file_path],
-                capture_output=True,
-                text=True,
-                timeout=30
+            # 编译C文件（同目录下的头文件也计入缓存键）
+            cache_dir, cache_hit, compile_result = self.compile_with_cache(
+                "c", "gcc", ["-o"], file_path, (".h",),
+                lambda staging_dir: self.run_streaming_process(
+                    ["gcc", "-o", os.path.join(staging_dir, executable_name), file_path],
+                    command_type="run_c"
+                )
             )
             
-            if compile_result.returncode != 0:
+            if compile_result is not None:
                 return f"C文件编译失败！\n错误:\n{compile_result.stderr}"
+            cache_note = "（编译缓存命中，跳过编译）" if cache_hit else "（编译缓存未命中，已编译并缓存）"
             
             # 运行编译后的程序
-            run_result = subprocess.run(
-                [output_path],
-                capture_output=True,
-                text=True,
-                timeout=30
+            run_result = self.run_streaming_process(
+                [os.path.join(cache_dir, executable_name)],
+                command_type="run_c"
             )
             
-            # 删除编译后的可执行文件
-            try:
-                os.remove(output_path)
-            except:
-                pass  # 忽略删除失败
-            
             if run_result.returncode == 0:
-                return f"C程序运行成功！\n输出:\n{run_result.stdout}"
+                return f"C程序运行成功！\n{cache_note}\n输出:\n{run_result.stdout}"
             else:
-                return f"C程序运行失败！\n错误:\n{run_result.stderr}"
-        except subprocess.TimeoutExpired:
-            return "错误：C程序运行超时（超过30秒）"
+                return f"C程序运行失败！\n{cache_note}\n错误:\n{run_result.stderr}"
+        except subprocess.TimeoutExpired as e:
+            return f"错误：C程序运行超时（超过{e.timeout}秒）\n{ResourceLimitExceeded.format_violation('timeout', e.timeout)}{ResourceLimitExceeded.format_output(e.stdout, e.stderr)}"
+        except ResourceLimitExceeded as e:
+            return f"错误：C程序运行{e}{e.format_output(e.stdout, e.stderr)}"
         except FileNotFoundError:
             return "错误：未找到gcc编译器。请确保已安装GCC编译器并添加到系统PATH中。"
         except Exception as e:
@@ -1170,20 +3019,20 @@ class OPAIApp:
         """运行bash命令"""
         import subprocess
         try:
-            result = subprocess.run(
+            result = self.run_streaming_process(
                 command,
                 shell=True,
-                capture_output=True,
-                text=True,
-                timeout=30
+                command_type="run_bash"
             )
             
             if result.returncode == 0:
                 return f"Bash命令执行成功！\n输出:\n{result.stdout}"
             else:
                 return f"Bash命令执行失败！\n错误:\n{result.stderr}"
-        except subprocess.TimeoutExpired:
-            return "错误：Bash命令执行超时（超过30秒）"
+        except subprocess.TimeoutExpired as e:
+            return f"错误：Bash命令执行超时（超过{e.timeout}秒）\n{ResourceLimitExceeded.format_violation('timeout', e.timeout)}{ResourceLimitExceeded.format_output(e.stdout, e.stderr)}"
+        except ResourceLimitExceeded as e:
+            return f"错误：Bash命令执行{e}{e.format_output(e.stdout, e.stderr)}"
         except Exception as e:
             return f"执行Bash命令时发生错误: {str(e)}"
     
@@ -1191,20 +3040,20 @@ class OPAIApp:
         """运行cmd命令"""
         import subprocess
         try:
-            result = subprocess.run(
+            result = self.run_streaming_process(
                 command,
                 shell=True,
-                capture_output=True,
-                text=True,
-                timeout=30
+                command_type="run_cmd"
             )
             
             if result.returncode == 0:
                 return f"CMD命令执行成功！\n输出:\n{result.stdout}"
             else:
                 return f"CMD命令执行失败！\n错误:\n{result.stderr}"
-        except subprocess.TimeoutExpired:
-            return "错误：CMD命令执行超时（超过30秒）"
+        except subprocess.TimeoutExpired as e:
+            return f"错误：CMD命令执行超时（超过{e.timeout}秒）\n{ResourceLimitExceeded.format_violation('timeout', e.timeout)}{ResourceLimitExceeded.format_output(e.stdout, e.stderr)}"
+        except ResourceLimitExceeded as e:
+            return f"错误：CMD命令执行{e}{e.format_output(e.stdout, e.stderr)}"
         except Exception as e:
             return f"执行CMD命令时发生错误: {str(e)}"
     
@@ -1212,24 +3061,268 @@ class OPAIApp:
         """运行PowerShell命令"""
         import subprocess
         try:
-            result = subprocess.run(
+            result = self.run_streaming_process(
                 ["powershell", "-Command", command],
-                capture_output=True,
-                text=True,
-                timeout=30
+                command_type="run_powershell"
             )
             
             if result.returncode == 0:
                 return f"PowerShell命令执行成功！\n输出:\n{result.stdout}"
             else:
                 return f"PowerShell命令执行失败！\n错误:\n{result.stderr}"
-        except subprocess.TimeoutExpired:
-            return "错误：PowerShell命令执行超时（超过30秒）"
+        except subprocess.TimeoutExpired as e:
+            return f"错误：PowerShell命令执行超时（超过{e.timeout}秒）\n{ResourceLimitExceeded.format_violation('timeout', e.timeout)}{ResourceLimitExceeded.format_output(e.stdout, e.stderr)}"
+        except ResourceLimitExceeded as e:
+            return f"错误：PowerShell命令执行{e}{e.format_output(e.stdout, e.stderr)}"
         except FileNotFoundError:
             return "错误：未找到PowerShell。请确保系统支持PowerShell。"
         except Exception as e:
             return f"执行PowerShell命令时发生错误: {str(e)}"
 
+    def get_build_jobs(self):
+        """构建时的并行任务数（配置为0时使用CPU核心数）"""
+        jobs = self.config.get("build_jobs", 0)
+        return jobs if jobs > 0 else (os.cpu_count() or 1)
+
+    def detect_build_system(self, project_dir):
+        """根据目录中的构建文件识别构建系统，没有构建文件时返回None"""
+        names = set(os.listdir(project_dir))
+        if names & {"GNUmakefile", "makefile", "Makefile"}:
+            return "make"
+        if "CMakeLists.txt" in names:
+            return "cmake"
+        if "pom.xml" in names:
+            return "maven"
+        if names & {"build.gradle", "build.gradle.kts"}:
+            return "gradle"
+        if "package.json" in names:
+            return "npm"
+        return None
+
+    def resolve_build_tool(self, name, project_dir=None):
+        """查找构建工具的可执行文件（Windows下包括.cmd/.bat），找不到时抛出FileNotFoundError"""
+        if project_dir:
+            # 项目自带的包装脚本（如gradlew）优先
+            for candidate in (name + ".bat", name) if os.name == 'nt' else (name,):
+                wrapper = os.path.join(project_dir, candidate)
+                if os.path.isfile(wrapper):
+                    return os.path.abspath(wrapper)
+            return None
+        tool = shutil.which(name)
+        if tool is None:
+            raise FileNotFoundError(name)
+        return tool
+
+    def run_build(self, project_path, target=None):
+        """构建项目：识别Makefile/CMake/Maven/Gradle/package.json并增量并行构建，没有构建文件时按源文件增量编译"""
+        import subprocess
+        project_dir = os.path.abspath(project_path or ".")
+        if os.path.isfile(project_dir):
+            project_dir = os.path.dirname(project_dir)
+        if not os.path.isdir(project_dir):
+            return f"构建失败！\n错误:\n目录不存在: {project_path}"
+
+        build_system = self.detect_build_system(project_dir)
+        jobs = self.get_build_jobs()
+        try:
+            if build_system is None:
+                return self.build_bare_sources(project_dir, jobs)
+
+            steps = []
+            if build_system == "make":
+                steps.append([self.resolve_build_tool("make"), f"-j{jobs}"] + ([target] if target else []))
+            elif build_system == "cmake":
+                build_dir = os.path.join(project_dir, "build")
+                cmake = self.resolve_build_tool("cmake")
+                if not os.path.exists(os.path.join(build_dir, "CMakeCache.txt")):
+                    steps.append([cmake, "-S", project_dir, "-B", build_dir])  # 首次构建时生成构建目录
+                steps.append([cmake, "--build", build_dir, "-j", str(jobs)] + (["--target", target] if target else []))
+            elif build_system == "maven":
+                steps.append([self.resolve_build_tool("mvn"), "-q", "-T", str(jobs), target or "compile"])
+            elif build_system == "gradle":
+                gradle = self.resolve_build_tool("gradlew", project_dir) or self.resolve_build_tool("gradle")
+                steps.append([gradle, target or "build", "--parallel"])
+            elif build_system == "npm":
+                with open(os.path.join(project_dir, "package.json"), "r", encoding="utf-8") as f:
+                    scripts = json.load(f).get("scripts", {})
+                script = target or "build"
+                if script not in scripts:
+                    return f"构建失败！\n错误:\npackage.json中没有{script}脚本"
+                npm = self.resolve_build_tool("npm")
+                if not os.path.isdir(os.path.join(project_dir, "node_modules")):
+                    steps.append([npm, "install"])
+                steps.append([npm, "run", script])
+
+            outputs = []
+            for args in steps:
+                result = self.run_streaming_process(args, cwd=project_dir, command_type="build")
+                outputs.append(result.stdout)
+                if result.returncode != 0:
+                    return f"构建失败！\n构建系统: {build_system}\n错误:\n{result.stderr or result.stdout}"
+            return f"构建成功！\n构建系统: {build_system}（{jobs}个并行任务）\n输出:\n{''.join(outputs)}"
+        except subprocess.TimeoutExpired as e:
+            return f"错误：构建超时（超过{e.timeout}秒）\n{ResourceLimitExceeded.format_violation('timeout', e.timeout)}{ResourceLimitExceeded.format_output(e.stdout, e.stderr)}"
+        except ResourceLimitExceeded as e:
+            return f"错误：构建{e}{e.format_output(e.stdout, e.stderr)}"
+        except FileNotFoundError as e:
+            return f"错误：未找到构建工具{e.args[0] if e.args else ''}。请确保已安装并添加到系统PATH中。"
+        except Exception as e:
+            return f"构建项目时发生错误: {str(e)}"
+
+    def file_fingerprint(self, path, previous=None):
+        """返回文件指纹（修改时间、大小、内容哈希）；修改时间和大小都未变时沿用上次的哈希，不再读取文件"""
+        import hashlib
+        stat = os.stat(path)
+        if previous and previous.get("mtime") == stat.st_mtime and previous.get("size") == stat.st_size:
+            return previous
+        with open(path, "rb") as f:
+            content_hash = hashlib.sha256(f.read()).hexdigest()
+        return {"mtime": stat.st_mtime, "size": stat.st_size, "hash": content_hash}
+
+    def fingerprint_changed(self, path, previous):
+        """文件内容相对上次记录是否有变化（只改了修改时间、内容不变视为未变化）"""
+        if not previous:
+            return True
+        try:
+            return self.file_fingerprint(path, previous)["hash"] != previous.get("hash")
+        except OSError:
+            return True
+
+    def build_bare_sources(self, project_dir, jobs):
+        """没有构建文件时按源文件增量编译：C/C++每个源文件编译为单独的目标文件，只重新编译内容或依赖的头文件有变化的文件"""
+        state_dir = os.path.join(project_dir, ".opai-build")
+        manifest_file = os.path.join(state_dir, "manifest.json")
+        skipped_dirs = {"build", "node_modules", "__pycache__"}
+
+        sources = []
+        for dir_path, dir_names, file_names in os.walk(project_dir):
+            dir_names[:] = [name for name in dir_names if not name.startswith(".") and name not in skipped_dirs]
+            for name in sorted(file_names):
+                if name.lower().endswith((".c", ".cpp", ".cc", ".cxx", ".java")):
+                    sources.append(os.path.relpath(os.path.join(dir_path, name), project_dir))
+        if not sources:
+            return "构建失败！\n错误:\n目录中没有构建文件（Makefile、CMakeLists.txt、pom.xml、build.gradle、package.json），也没有C/C++/Java源文件"
+
+        try:
+            with open(manifest_file, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        records = manifest.get("sources", {})
+        os.makedirs(state_dir, exist_ok=True)
+
+        def save_manifest():
+            with open(manifest_file, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+        java_sources = [source for source in sources if source.lower().endswith(".java")]
+        native_sources = [source for source in sources if source not in java_sources]
+
+        if not native_sources:
+            # Java：任一源文件变化时整体重新编译（javac会一并处理类之间的依赖）
+            classes_dir = os.path.join(state_dir, "classes")
+            compiler_version = self.get_compiler_version("javac", "-version")
+            changed = [source for source in java_sources
+                       if self.fingerprint_changed(os.path.join(project_dir, source), records.get(source))]
+            if (not changed and set(records) == set(java_sources) and os.path.isdir(classes_dir) and
+                    manifest.get("compiler") == compiler_version):
+                return f"构建成功！\n（{len(java_sources)}个Java源文件均未变化，跳过编译）\n类文件目录: {classes_dir}"
+            result = self.run_streaming_process(
+                ["javac", "-d", classes_dir] + [os.path.join(project_dir, source) for source in java_sources],
+                cwd=project_dir, command_type="build"
+            )
+            if result.returncode != 0:
+                return f"构建失败！\n错误:\n{result.stderr}"
+            manifest["compiler"] = compiler_version
+            manifest["sources"] = {source: self.file_fingerprint(os.path.join(project_dir, source))
+                                   for source in java_sources}
+            save_manifest()
+            return f"构建成功！\n（编译了{len(java_sources)}个Java源文件）\n类文件目录: {classes_dir}"
+
+        # C/C++：每个源文件编译为单独的目标文件，依赖的头文件由编译器生成的.d文件记录
+        # 同时存在Java源文件时无法链接进同一个可执行文件，只构建C/C++并在结果中列出跳过的Java源文件
+        skipped_note = ""
+        if java_sources:
+            skipped_note = (f"\n注意：目录中同时存在C/C++和Java源文件，只构建了C/C++，"
+                            f"跳过了{len(java_sources)}个Java源文件: {', '.join(java_sources)}")
+        is_cpp = any(not source.lower().endswith(".c") for source in native_sources)
+        linker = "g++" if is_cpp else "gcc"
+        compiler_versions = {
+            compiler: self.get_compiler_version(compiler)
+            for compiler in {"gcc" if source.lower().endswith(".c") else "g++" for source in native_sources}
+        }
+        objects_dir = os.path.join(state_dir, "obj")
+        os.makedirs(objects_dir, exist_ok=True)
+
+        def object_path(source):
+            return os.path.join(objects_dir, source.replace(os.sep, "__").replace("/", "__") + ".o")
+
+        def needs_compile(source):
+            record = records.get(source)
+            compiler = "gcc" if source.lower().endswith(".c") else "g++"
+            if not record or record.get("compiler") != compiler_versions[compiler]:
+                return True
+            if not os.path.exists(object_path(source)):
+                return True
+            if self.fingerprint_changed(os.path.join(project_dir, source), record.get("source")):
+                return True
+            return any(self.fingerprint_changed(dep, dep_record) for dep, dep_record in record.get("deps", {}).items())
+
+        def compile_source(source):
+            compiler = "gcc" if source.lower().endswith(".c") else "g++"
+            source_path = os.path.join(project_dir, source)
+            dep_file = object_path(source)[:-2] + ".d"
+            result = self.run_streaming_process(
+                [compiler, "-c", source_path, "-o", object_path(source), "-MMD", "-MF", dep_file],
+                cwd=project_dir, command_type="build"
+            )
+            if result.returncode != 0:
+                return source, result, None
+            # .d文件格式为"目标: 源文件 头文件1 头文件2"，行尾的反斜杠表示续行
+            with open(dep_file, "r", encoding="utf-8", errors="replace") as f:
+                dep_text = f.read().replace("\\\n", " ")
+            deps = dep_text.split(": ", 1)[1].split() if ": " in dep_text else []
+            record = {
+                "compiler": compiler_versions[compiler],
+                "source": self.file_fingerprint(source_path),
+                "deps": {
+                    os.path.abspath(os.path.join(project_dir, dep)): self.file_fingerprint(os.path.join(project_dir, dep))
+                    for dep in deps if os.path.abspath(os.path.join(project_dir, dep)) != os.path.abspath(source_path)
+                }
+            }
+            return source, result, record
+
+        to_compile = [source for source in native_sources if needs_compile(source)]
+        failures = []
+        with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(to_compile) or 1)), thread_name_prefix="OPAI-Build") as executor:
+            for source, result, record in executor.map(compile_source, to_compile):
+                if record is None:
+                    failures.append(f"{source}:\n{result.stderr}")
+                    records.pop(source, None)
+                else:
+                    records[source] = record
+
+        # 删除已不存在的源文件的记录
+        for source in list(records):
+            if source not in native_sources:
+                records.pop(source)
+        manifest["sources"] = records
+        save_manifest()
+        if failures:
+            return (f"构建失败！\n（{len(failures)}/{len(to_compile)}个源文件编译失败）{skipped_note}\n错误:\n" +
+                    "\n".join(failures))
+
+        executable = os.path.join(state_dir, "program.exe" if os.name == 'nt' else "program")
+        linked_objects = [object_path(source) for source in native_sources]
+        if to_compile or not os.path.exists(executable) or manifest.get("linked_objects") != linked_objects:
+            result = self.run_streaming_process([linker, "-o", executable] + linked_objects, cwd=project_dir, command_type="build")
+            if result.returncode != 0:
+                return f"构建失败！\n（链接失败）{skipped_note}\n错误:\n{result.stderr}"
+            manifest["linked_objects"] = linked_objects
+            save_manifest()
+        return (f"构建成功！\n（重新编译了{len(to_compile)}/{len(native_sources)}个源文件，"
+                f"{len(native_sources) - len(to_compile)}个未变化已跳过）{skipped_note}\n可执行文件: {executable}")
+
     def extract_json_commands(self, ai_response):
         """从AI响应中提取JSON格式的命令"""
         import json
@@ -1267,23 +3360,94 @@ class OPAIApp:
             # 提取文件路径
             file_path = command[12:].strip()  # 移除 '/run python ' 部分
             
+            # 启用预热进程池时从常驻进程fork子进程运行，省去解释器启动和模块导入的时间
+            result = None
+            pool = self.get_python_warm_pool()
+            if pool is not None:
+                try:
+                    result = self.run_streaming_process(
+                        ["python", "-u", file_path],
+                        command_type="run_python",
+                        spawn=functools.partial(
+                            pool.spawn, os.path.abspath(file_path), os.getcwd(), self.get_command_limits("run_python"))
+                    )
+                except (OSError, RuntimeError, ValueError) as e:
+                    print(f"Python预热进程不可用，改为直接启动解释器: {e}")
+            
             # 运行Python文件
-            result = subprocess.run(
-                ["python", file_path],
-                capture_output=True,
-                text=True,
-                timeout=30  # 30秒超时
-            )
+            if result is None:
+                result = self.run_streaming_process(
+                    ["python", "-u", file_path],  # -u：不缓冲输出，便于实时显示
+                    command_type="run_python"
+                )
             
             if result.returncode == 0:
                 return f"Python文件运行成功！\n输出:\n{result.stdout}"
             else:
                 return f"Python文件运行失败！\n错误:\n{result.stderr}"
-        except subprocess.TimeoutExpired:
-            return "错误：Python文件运行超时（超过30秒）"
+        except subprocess.TimeoutExpired as e:
+            return f"错误：Python文件运行超时（超过{e.timeout}秒）\n{ResourceLimitExceeded.format_violation('timeout', e.timeout)}{ResourceLimitExceeded.format_output(e.stdout, e.stderr)}"
+        except ResourceLimitExceeded as e:
+            return f"错误：Python文件运行{e}{e.format_output(e.stdout, e.stderr)}"
         except Exception as e:
             return f"执行Python文件时发生错误: {str(e)}"
 
+    def get_python_warm_pool(self):
+        """返回Python预热进程池（未启用或系统不支持fork时返回None），预先导入的模块配置变化时重新创建"""
+        if not self.config.get("python_warm_pool", False) or not PythonWarmPool.is_supported():
+            return None
+        modules = [name.strip() for name in self.config.get("python_warm_pool_modules", []) if name.strip()]
+        with self.python_pool_lock:
+            if self.python_pool is None or self.python_pool.modules != modules:
+                if self.python_pool is not None:
+                    self.python_pool.stop()
+                self.python_pool = PythonWarmPool("python", modules)
+            return self.python_pool
+
+    def get_node_runner_daemon(self):
+        """返回Node.js运行器守护进程，未启用时返回None"""
+        if not self.config.get("node_runner_daemon", False):
+            return None
+        with self.node_daemon_lock:
+            if self.node_daemon is None:
+                self.node_daemon = NodeRunnerDaemon(os.path.abspath(os.path.join(self.data_dir, "Daemons")), os.getcwd())
+            return self.node_daemon
+
+    def run_with_node_daemon(self, args, request, cwd=None, command_type=None):
+        """通过Node.js运行器守护进程执行（输出、退出码和超时与直接启动进程一致），未启用或守护进程不可用时返回None
+
+        守护进程无法对单次运行限制CPU时间，配置了CPU时间上限时返回None，改为单独启动进程。
+        """
+        daemon = self.get_node_runner_daemon()
+        if daemon is None:
+            return None
+        limits = self.get_command_limits(command_type)
+        if limits["cpu_seconds"]:
+            return None
+        if limits["memory_mb"]:
+            request = dict(request, memory_mb=limits["memory_mb"])
+        try:
+            return self.run_streaming_process(args, cwd=cwd, command_type=command_type, spawn=functools.partial(daemon.spawn, request))
+        except (OSError, RuntimeError, ValueError) as e:
+            print(f"{daemon.NAME}守护进程不可用，改为直接启动: {e}")
+            return None
+
+    def check_node_runner_daemon(self):
+        """定期健康检查：已禁用时停止守护进程，异常退出或没有响应时重启（在后台线程中执行）"""
+        self.job_runner.ensure_background_thread("runner_daemon_health_check")
+
+        with self.node_daemon_lock:
+            daemon = self.node_daemon
+        if daemon is None:
+            return
+        try:
+            if self.config.get("node_runner_daemon", False):
+                self.engine.submit(daemon.health_check()).result()
+            else:
+                self.engine.submit(daemon.stop()).result()
+        except Exception as e:
+            print(f"{daemon.NAME}守护进程健康检查失败: {e}")
+
     def analyze_and_fix_code(self, file_path, error_message):
         """分析代码错误并尝试自动修复（AI辅助）"""
         try:
@@ -1294,14 +3458,8 @@ class OPAIApp:
             # 构建AI请求来修复错误
             fix_request = f"以下Python代码在运行时出现错误：\n错误信息：{error_message}\n代码内容：\n{original_code}\n\n请分析错误并提供修复后的代码。"
             
-            # 使用AI API来获取修复建议
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.config['api_key']}"
-            }
-            
             # 构建消息历史
-            messages = self.context_messages + [{"role": "user", "content": fix_request}]
+            messages = self.conversation.context_messages + [{"role": "user", "content": fix_request}]
             
             data = {
                 "model": self.config["model"],
@@ -1309,19 +3467,8 @@ class OPAIApp:
                 "temperature": 0.3  # 降低温度以获得更准确的修复
             }
             
-            import urllib3
-            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-            
-            # 创建不使用系统代理的会话
-            session = requests.Session()
-            session.trust_env = False
-            
-            response = session.post(
-                self.config["api_url"],
-                headers=headers,
-                json=data,
-                timeout=30
-            )
+            # 使用AI API来获取修复建议
+            response = self.post_api_request(data, lane="interactive", timeout=30, stage="code_fix")
             
             if response.status_code == 200:
                 result = response.json()
@@ -1338,44 +3485,706 @@ class OPAIApp:
         except Exception as e:
             return f"自动修复过程中发生错误: {str(e)}"
 
-    def read_file_content(self, command):
-        """读取文件内容命令"""
+    def find_line_block(self, lines, block, expected=None):
+        """在文件的行列表中定位一段连续的行，返回(起始行下标, 匹配方式)
+
+        依次尝试：完全一致、忽略首尾空白、相似度不低于edit_fuzzy_threshold的模糊匹配。
+        同一方式匹配到多处时，选择离expected最近的一处；没有expected时视为冲突。
+        模糊匹配没有expected（diff行号）参考时，只接受至少3行且相似度明显高于其他位置的匹配。
+        """
+        import difflib
+        size = len(block)
+        if size == 0 or size > len(lines):
+            raise EditConflictError("要修改的内容为空或比文件还长")
+
+        def choose(candidates, kind):
+            if len(candidates) > 1 and expected is None:
+                raise EditConflictError(f"要修改的内容在文件中{kind}匹配到 {len(candidates)} 处（第{'、'.join(str(i + 1) for i in candidates[:5])}行），请提供更多上下文使其唯一")
+            return min(candidates, key=lambda index: abs(index - expected)) if expected is not None else candidates[0]
+
+        windows = range(len(lines) - size + 1)
+        candidates = [i for i in windows if lines[i:i + size] == block]
+        if candidates:
+            return choose(candidates, "完全"), "完全匹配"
+
+        stripped_lines = [line.strip() for line in lines]
+        stripped_block = [line.strip() for line in block]
+        candidates = [i for i in windows if stripped_lines[i:i + size] == stripped_block]
+        if candidates:
+            return choose(candidates, "忽略空白后"), "忽略空白匹配"
+
+        threshold = self.config.get("edit_fuzzy_threshold", 0.85)
+        margin = 0.1  # 没有行号参考时，最佳匹配的相似度至少要比其他位置高出的值
+        target = "\n".join(stripped_block)
+        scored = []
+        for i in windows:
+            matcher = difflib.SequenceMatcher(None, "\n".join(stripped_lines[i:i + size]), target, autojunk=False)
+            # 快速估算的上界已低于阈值减去余量的位置，既不可能匹配，也不会影响余量判断
+            if matcher.real_quick_ratio() < threshold - margin or matcher.quick_ratio() < threshold - margin:
+                continue
+            scored.append((matcher.ratio(), i))
+        best_ratio = max((ratio for ratio, _ in scored), default=0)
+        if best_ratio < threshold:
+            raise EditConflictError("要修改的内容在文件中找不到（可能文件已被修改），请先用read_file查看文件的当前内容")
+        kind = f"模糊匹配，相似度{best_ratio:.0%}"
+        best = [i for ratio, i in scored if ratio == best_ratio]
+        if expected is not None:
+            return choose(best, "模糊"), kind
+
+        # 没有行号参考时，相似的行（如MAX = 10与MAX = 100）很容易被误改，只接受足够长且明显优于其他位置的匹配
+        start = best[0]
+        runner_up = max((ratio for ratio, i in scored if abs(i - start) >= size), default=0)
+        if size < 3 or best_ratio - runner_up < margin:
+            raise EditConflictError(f"要修改的内容在文件中没有完全一致的位置（最接近的是第{start + 1}行，相似度{best_ratio:.0%}），"
+                                    "请先用read_file确认原内容，或改用diff参数提供带行号的补丁")
+        return start, kind
+
+    def apply_search_replace(self, text, search, replace):
+        """应用一处搜索/替换修改，返回(新内容, 模糊匹配说明或None)"""
+        if not search:
+            raise EditConflictError("search不能为空")
+        count = text.count(search)
+        if count == 1:
+            return text.replace(search, replace, 1), None
+        if count > 1:
+            raise EditConflictError(f"search内容在文件中出现了 {count} 次，请提供更多上下文使其唯一")
+
+        # 原文不完全一致时按行模糊定位，整行替换
+        lines = text.split("\n")
+        search_lines = search.strip("\n").split("\n")
+        start, kind = self.find_line_block(lines, search_lines)
+        replace_lines = replace.strip("\n").split("\n") if replace.strip("\n") else []
+        lines[start:start + len(search_lines)] = replace_lines
+        return "\n".join(lines), f"第{start + 1}行（{kind}）"
+
+    def apply_unified_diff(self, text, diff):
+        """应用统一diff格式的补丁，返回(新内容, 模糊匹配说明列表)；行号不准确时在附近查找上下文"""
+        hunks = []
+        hunk = None
+        for line in diff.replace("\r\n", "\n").split("\n"):
+            if line.startswith("@@"):
+                match = re.match(r"@@ -(\d+)(?:,(\d+))? \+\d+(?:,\d+)? @@", line)
+                hunk = {"old_start": int(match.group(1)) if match else None,
+                        "old_count": int(match.group(2)) if match and match.group(2) is not None else None,
+                        "old": [], "new": []}
+                hunks.append(hunk)
+            elif hunk is None or line.startswith("\\"):
+                continue  # 文件头（---/+++）及"\ No newline at end of file"
+            elif line.startswith("-"):
+                hunk["old"].append(line[1:])
+            elif line.startswith("+"):
+                hunk["new"].append(line[1:])
+            else:
+                hunk["old"].append(line[1:])
+                hunk["new"].append(line[1:])
+        if not hunks:
+            raise EditConflictError("diff中没有找到以@@开头的修改块")
+
+        lines = text.split("\n")
+        notes = []
+        offset = 0  # 前面的修改块造成的行号偏移
+        for number, hunk in enumerate(hunks, 1):
+            # 去掉末尾因diff文本结尾换行产生的空上下文行
+            while hunk["old"] and hunk["new"] and hunk["old"][-1] == "" and hunk["new"][-1] == "":
+                hunk["old"].pop()
+                hunk["new"].pop()
+            if hunk["old_start"] is None:
+                expected = None
+            elif hunk["old_count"] == 0:
+                # 纯插入的修改块（如diff -U0的输出）中，起始行号是插入位置的前一行
+                expected = hunk["old_start"] + offset
+            else:
+                expected = max(hunk["old_start"] - 1 + offset, 0)
+            if not hunk["old"]:
+                start = min(expected if expected is not None else len(lines), len(lines))
+            else:
+                try:
+                    start, kind = self.find_line_block(lines, hunk["old"], expected)
+                except EditConflictError as e:
+                    raise EditConflictError(f"第{number}个修改块：{e}")
+                if kind != "完全匹配" or (expected is not None and start != expected):
+                    notes.append(f"第{number}个修改块定位到第{start + 1}行（{kind}）")
+            lines[start:start + len(hunk["old"])] = hunk["new"]
+            offset += len(hunk["new"]) - len(hunk["old"])
+        return "\n".join(lines), notes
+
+    def restore_line_endings(self, original, text):
+        """把统一为LF换行后修改的结果恢复为原文件的换行符：未改动的行保留各自的换行符，修改或新增的行沿用被替换的行或相邻行的换行符"""
+        import difflib
+        old_lines = original.split("\n")
+        endings = ["\r\n" if line.endswith("\r") else "\n" for line in old_lines[:-1]]
+        old_lines = [line[:-1] if line.endswith("\r") else line for line in old_lines[:-1]] + old_lines[-1:]
+        new_lines = text.split("\n")
+
+        def ending_at(index):
+            if 0 <= index < len(endings):
+                return endings[index]
+            return endings[-1] if endings else "\n"
+
+        parts = []
+        matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            for offset, line in enumerate(new_lines[j1:j2]):
+                if j1 + offset == len(new_lines) - 1:
+                    parts.append(line)  # 最后一行之后没有换行符
+                elif tag == "equal" or i1 + offset < i2:
+                    parts.append(line + ending_at(i1 + offset))
+                else:
+                    parts.append(line + ending_at(i2 - 1 if i2 > i1 else i1))
+        return "".join(parts)
+
+    def edit_file(self, file_path, edits=None, diff=None):
+        """按搜索/替换片段或统一diff修改文件：所有修改都能定位时才一次性原子写入，任一处冲突则文件保持不变"""
+        import difflib
+        import tempfile
+        if not file_path or not os.path.isfile(file_path):
+            return f"修改文件失败：文件 '{file_path}' 不存在（新建文件请使用create_file）"
+        if not edits and not diff:
+            return "修改文件失败：需要提供edits（搜索/替换列表）或diff（统一diff格式的补丁）"
+
         try:
-            # 提取文件路径
-            file_path = command[11:].strip()  # 移除 '/read file ' 部分
-            
-            # 读取文件内容
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
-            return f"文件 '{file_path}' 的内容:\n{content[:1000]}..." if len(content) > 1000 else f"文件 '{file_path}' 的内容:\n{content}"
+            with open(file_path, "r", encoding="utf-8", newline="") as f:
+                original = f.read()
+        except UnicodeDecodeError:
+            return f"修改文件失败：文件 '{file_path}' 不是UTF-8文本文件"
+        except Exception as e:
+            return f"修改文件失败：{str(e)}"
+
+        text = original.replace("\r\n", "\n")
+        try:
+            notes = []
+            if diff:
+                text, diff_notes = self.apply_unified_diff(text, diff)
+                notes.extend(diff_notes)
+            for number, edit in enumerate(edits or [], 1):
+                try:
+                    text, note = self.apply_search_replace(
+                        text, (edit.get("search") or "").replace("\r\n", "\n"), (edit.get("replace") or "").replace("\r\n", "\n"))
+                except EditConflictError as e:
+                    raise EditConflictError(f"第{number}处修改：{e}")
+                if note:
+                    notes.append(f"第{number}处修改定位到{note}")
+        except EditConflictError as e:
+            return f"修改文件失败（文件未改动）：{e}"
+
+        updated = self.restore_line_endings(original, text) if "\r\n" in original else text
+        if updated == original:
+            return f"文件 '{file_path}' 内容没有变化"
+
+        # 先写入同目录下的临时文件，再整体替换原文件
+        temp_path = None
+        try:
+            file_dir = os.path.dirname(os.path.abspath(file_path))
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", newline="", dir=file_dir, delete=False,
+                                             prefix=".opai-edit-", suffix=".tmp") as f:
+                f.write(updated)
+                f.flush()
+                os.fsync(f.fileno())
+                temp_path = f.name
+            shutil.copymode(file_path, temp_path)
+            os.replace(temp_path, file_path)
+        except Exception as e:
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+            return f"修改文件失败：{str(e)}"
+
+        changes = list(difflib.unified_diff(original.replace("\r\n", "\n").split("\n"), text.split("\n"), lineterm="", n=1))[2:]
+        max_lines = 60
+        if len(changes) > max_lines:
+            changes = changes[:max_lines] + [f"...(还有 {len(changes) - max_lines} 行改动)"]
+        result = f"文件 '{file_path}' 修改成功！\n改动:\n" + "\n".join(changes)
+        if notes:
+            result += "\n注意：" + "；".join(notes)
+        return result
+
+    def sniff_file_encoding(self, sample):
+        """根据文件开头的字节判断文本编码，判断为二进制文件时返回None"""
+        import codecs
+        if sample.startswith(codecs.BOM_UTF8):
+            return "utf-8-sig"
+        if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+            return "utf-16"
+        # 含NUL字节或控制字符过多时视为二进制文件
+        controls = sum(1 for byte in sample if byte < 32 and byte not in (9, 10, 12, 13, 27))
+        if b"\x00" in sample or controls > len(sample) // 10:
+            return None
+        for encoding in ("utf-8", "gbk"):
+            try:
+                # 样本末尾可能截断了多字节字符，用增量解码器忽略末尾不完整的部分
+                codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+                return encoding
+            except UnicodeDecodeError:
+                continue
+        return "latin-1"
+
+    def read_file_content(self, file_path, offset=None, limit=None, unit="lines", tail=None, grep=None, context=2):
+        """读取文件内容命令：按行或字节读取指定范围、读取末尾若干行或按正则搜索
+
+        文本文件通过mmap按需定位，不会把整个文件读入内存：按行、按字节读取的耗时只与读取的范围有关，
+        tail只需按字节数出前面的换行符以显示行号，grep按块解码整个文件（从offset行开始）；
+        UTF-16文件逐行流式读取。二进制文件只能按字节读取，以十六进制显示。
+        """
+        import mmap
+        max_chars = self.config.get("read_file_max_chars", 20000)
+        max_line_chars = 2000  # 超长的单行（如压缩后的代码）截断显示
+        try:
+            if not file_path or not os.path.isfile(file_path):
+                return f"读取文件时发生错误: 文件 '{file_path}' 不存在"
+            unit = "bytes" if unit == "bytes" else "lines"
+            offset = max(int(offset or 0), 0)
+            tail = max(int(tail), 1) if tail else None
+            context = min(max(int(context or 0), 0), 20)
+            if grep:
+                limit = min(max(int(limit or 50), 1), 500)  # grep时limit为最多匹配数
+            elif unit == "bytes":
+                limit = min(max(int(limit or 4096), 1), 65536)
+            else:
+                limit = min(max(int(limit or 200), 1), 2000)
+            if tail:
+                tail = min(tail, 65536 if unit == "bytes" else 2000)
+
+            with open(file_path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                encoding = self.sniff_file_encoding(f.read(8192))
+                if size == 0:
+                    return f"文件 '{file_path}' 是空文件"
+                header = f"文件 '{file_path}'（{size} 字节，{encoding or '二进制'}）"
+                if encoding is None and (unit != "bytes" or grep):
+                    return f"{header}是二进制文件，无法按文本显示，可使用unit为bytes按字节读取（以十六进制显示）"
+                if encoding == "utf-16":
+                    if unit == "bytes":
+                        return f"{header}是UTF-16编码，只能按行读取"
+                    f.seek(0)
+                    return self.read_file_stream(f, header, encoding, offset, limit, tail, grep, context, max_chars, max_line_chars)
+
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    def decode(begin, stop):
+                        text = mm[begin:min(stop, begin + max_line_chars * 4)].decode(encoding or "latin-1", errors="replace").rstrip("\r")
+                        if len(text) > max_line_chars or stop - begin > max_line_chars * 4:
+                            text = text[:max_line_chars] + f"...（该行共 {stop - begin} 字节）"
+                        return text
+
+                    if unit == "bytes":
+                        begin = max(size - tail, 0) if tail else min(offset, size)
+                        stop = size if tail else min(begin + limit, size)
+                        if encoding is None:
+                            window = mm[begin:min(stop, begin + 4096)]
+                            stop = begin + len(window)
+                            content = "\n".join(f"{begin + i:08x}  {window[i:i + 16].hex(' ')}" for i in range(0, len(window), 16))
+                        else:
+                            content = mm[begin:stop].decode(encoding, errors="replace")[:max_chars]
+                        result = f"{header} 第 {begin}-{stop} 字节:\n{content}"
+                        if stop < size:
+                            result += f"\n[后面还有 {size - stop} 字节，可使用offset={stop}继续读取]"
+                        return result
+
+                    if grep:
+                        return self.grep_file_mmap(mm, size, header, encoding, grep, offset, limit, context, max_chars, decode)
+
+                    rows = []
+                    chars = 0
+                    if tail:
+                        # 从文件末尾向前找换行符，文件末尾的换行不算作空行
+                        stop = size - 1 if mm[size - 1:size] == b"\n" else size
+                        begin = stop
+                        cursor = stop
+                        for _ in range(tail):
+                            found = mm.rfind(b"\n", 0, cursor)
+                            if found < 0:
+                                begin = 0
+                                break
+                            begin, cursor = found + 1, found
+                        # 行号按块数出前面的换行符得到（只计数，不解码）
+                        line_no = 1
+                        for chunk_start in range(0, begin, self.READ_FILE_CHUNK_BYTES):
+                            line_no += mm[chunk_start:min(chunk_start + self.READ_FILE_CHUNK_BYTES, begin)].count(b"\n")
+                        position = begin
+                        while position <= stop:
+                            line_end = mm.find(b"\n", position, stop)
+                            line_end = stop if line_end < 0 else line_end
+                            rows.append(f"{line_no + len(rows):>6}\t{decode(position, line_end)}")
+                            position = line_end + 1
+                        # 超出字符上限时优先保留最后的行
+                        kept = []
+                        for text in reversed(rows):
+                            chars += len(text) + 1
+                            if chars > max_chars and kept:
+                                break
+                            kept.append(text)
+                        first_no = line_no + len(rows) - len(kept)
+                        note = f"，省略了前面 {len(rows) - len(kept)} 行" if len(kept) < len(rows) else ""
+                        return f"{header} 最后 {len(kept)} 行（第 {first_no}-{line_no + len(rows) - 1} 行）{note}:\n" + "\n".join(reversed(kept))
+
+                    # 跳过offset行后逐行读取
+                    position = 0
+                    for _ in range(offset):
+                        found = mm.find(b"\n", position)
+                        if found < 0:
+                            position = size
+                            break
+                        position = found + 1
+                    while position < size and len(rows) < limit:
+                        line_end = mm.find(b"\n", position)
+                        line_end = size if line_end < 0 else line_end
+                        text = decode(position, line_end)
+                        if chars + len(text) > max_chars and rows:
+                            break
+                        chars += len(text) + 1
+                        rows.append(f"{offset + len(rows) + 1:>6}\t{text}")
+                        position = line_end + 1
+                    if not rows:
+                        return f"{header}共不足 {offset + 1} 行"
+                    result = f"{header} 第 {offset + 1}-{offset + len(rows)} 行:\n" + "\n".join(rows)
+                    if position < size:
+                        result += f"\n[后面还有内容（剩余 {size - position} 字节），可使用offset={offset + len(rows)}继续读取]"
+                    return result
+        except re.error as e:
+            return f"读取文件时发生错误: 无效的正则表达式 ({str(e)})"
         except Exception as e:
             return f"读取文件时发生错误: {str(e)}"
 
-    def get_ai_response(self, user_message):
-        """获取AI的响应"""
-        # 首先检查是否为系统命令
-        command_result = self.process_command(user_message)
-        if command_result:
-            self.root.after(0, lambda: self.display_message("系统", command_result))
-            self.root.after(0, lambda: self.send_button.config(text="发送", command=self.send_message))
-            return
+    def grep_file_mmap(self, mm, size, header, encoding, grep, offset, limit, context, max_chars, decode):
+        """在mmap映射的文件中按正则搜索，输出格式与grep -n相同（匹配行用冒号，上下文行用短横线）
+
+        按块解码后在文本上匹配，不把正则编码为字节，避免多字节编码（如GBK）中跨字符边界的误匹配；
+        解码使用surrogateescape，重新编码可精确换算回字节位置，用于读取上下文行。
+        """
+        text_encoding = "utf-8" if encoding == "utf-8-sig" else encoding
+        pattern = re.compile(grep, re.MULTILINE)
+        shown = {}  # 行号 -> (内容, 是否匹配行)
+        matches = 0
+        position = 0
+        # offset为起始行号（从0开始），跳过前面的行
+        for _ in range(offset):
+            found = mm.find(b"\n", position)
+            if found < 0:
+                position = size
+                break
+            position = found + 1
+        chunk_line = offset + 1  # 当前块第一行的行号
+
+        truncated = False
+        while position < size and not truncated:
+            # 每块在换行符处结束，块内的行都是完整的
+            stop = min(position + self.READ_FILE_CHUNK_BYTES, size)
+            if stop < size:
+                found = mm.rfind(b"\n", position, stop)
+                if found < 0:
+                    found = mm.find(b"\n", stop)
+                stop = size if found < 0 else found + 1
+            text = mm[position:stop].decode(text_encoding, errors="surrogateescape")
+
+            counted_char, counted_byte, counted_line = 0, position, chunk_line  # 已换算到的位置
+            search_at = 0
+            while search_at <= len(text):
+                match = pattern.search(text, search_at)
+                if not match or match.start() >= len(text):
+                    break
+                if matches >= limit:
+                    truncated = True
+                    break
+                line_start_char = text.rfind("\n", 0, match.start()) + 1
+                line_end_char = text.find("\n", match.start())
+                line_end_char = len(text) if line_end_char < 0 else line_end_char
+                skipped = text[counted_char:line_start_char]
+                counted_byte += len(skipped.encode(text_encoding, errors="surrogateescape"))
+                counted_line += skipped.count("\n")
+                counted_char = line_start_char
+                line_start, line_no = counted_byte, counted_line
+                line_end = mm.find(b"\n", line_start)
+                line_end = size if line_end < 0 else line_end
+                matches += 1
+                shown[line_no] = (decode(line_start, line_end), True)
+
+                # 前面的上下文行
+                begin = line_start
+                for k in range(1, context + 1):
+                    if begin == 0:
+                        break
+                    previous = mm.rfind(b"\n", 0, begin - 1) + 1
+                    shown.setdefault(line_no - k, (decode(previous, begin - 1), False))
+                    begin = previous
+                # 后面的上下文行
+                after = line_end
+                for k in range(1, context + 1):
+                    if after + 1 >= size:
+                        break
+                    following = mm.find(b"\n", after + 1)
+                    following = size if following < 0 else following
+                    shown.setdefault(line_no + k, (decode(after + 1, following), False))
+                    after = following
+                search_at = line_end_char + 1  # 每行只记一次匹配
+            chunk_line = counted_line + text.count("\n", counted_char)
+            position = stop
+
+        if not matches:
+            return f"{header}中没有匹配 '{grep}' 的行"
+        lines = []
+        chars = 0
+        previous_no = None
+        for line_no in sorted(shown):
+            text, is_match = shown[line_no]
+            if previous_no is not None and line_no > previous_no + 1:
+                lines.append("--")
+            entry = f"{line_no}{':' if is_match else '-'}{text}"
+            chars += len(entry) + 1
+            if chars > max_chars:
+                truncated = True
+                break
+            lines.append(entry)
+            previous_no = line_no
+        result = f"{header}中匹配 '{grep}' 的行（{matches} 处）:\n" + "\n".join(lines)
+        if truncated:
+            result += f"\n[匹配结果已截断，可使用offset={previous_no}从该行之后继续搜索]"
+        return result
+
+    def read_file_stream(self, f, header, encoding, offset, limit, tail, grep, context, max_chars, max_line_chars):
+        """逐行流式读取不能按字节定位换行符的文件（如UTF-16）"""
+        import io
+        stream = io.TextIOWrapper(f, encoding=encoding, errors="replace", newline=None)
+        lines = (line.rstrip("\n")[:max_line_chars] for line in stream)
+        if tail:
+            kept = list(collections.deque(enumerate(lines, 1), maxlen=tail))
+            if not kept:
+                return f"{header}是空文件"
+            rows = "\n".join(f"{line_no:>6}\t{text}" for line_no, text in kept)
+            return f"{header} 最后 {len(kept)} 行（第 {kept[0][0]}-{kept[-1][0]} 行）:\n" + rows[-max_chars:]
+        if grep:
+            pattern = re.compile(grep, re.MULTILINE)
+            before = collections.deque(maxlen=context)
+            output = []
+            after = 0
+            matches = 0
+            last_no = None
+            for line_no, text in enumerate(itertools.islice(lines, offset, None), offset + 1):
+                if pattern.search(text):
+                    if matches >= limit:
+                        break
+                    matches += 1
+                    first_no = before[0][0] if before else line_no
+                    if last_no is not None and first_no > last_no + 1:
+                        output.append("--")
+                    output.extend(f"{no}-{content}" for no, content in before)
+                    output.append(f"{line_no}:{text}")
+                    before.clear()
+                    after = context
+                    last_no = line_no
+                elif after:
+                    output.append(f"{line_no}-{text}")
+                    after -= 1
+                    last_no = line_no
+                else:
+                    before.append((line_no, text))
+            if not matches:
+                return f"{header}中没有匹配 '{grep}' 的行"
+            return f"{header}中匹配 '{grep}' 的行（{matches} 处）:\n" + "\n".join(output)[:max_chars]
+        rows = [f"{line_no:>6}\t{text}" for line_no, text in enumerate(itertools.islice(lines, offset, offset + limit), offset + 1)]
+        if not rows:
+            return f"{header}共不足 {offset + 1} 行"
+        return f"{header} 第 {offset + 1}-{offset + len(rows)} 行:\n" + "\n".join(rows)[:max_chars]
+
+    def digest_command_output(self, output):
+        """生成命令输出的精简摘要：折叠重复行、保留首尾若干行，重复输出替换为引用"""
+        import hashlib
+
+        output = output or ""
+        output_hash = hashlib.sha1(output.encode("utf-8", errors="replace")).hexdigest()
+        output_id = f"out-{output_hash[:10]}"
+        output_path = os.path.join(self.outputs_dir, f"{output_id}.txt")
+
+        # 本次对话中已出现过完全相同的输出且完整内容仍在，只保留引用
+        if output_hash in self.conversation.output_digest_seen and os.path.exists(output_path):
+            return f"[输出 {output_id}] 与之前的输出完全相同，已省略（可使用read_output命令查看完整内容）"
+
+        head_lines = self.config.get("output_digest_head_lines", 20)
+        tail_lines = self.config.get("output_digest_tail_lines", 20)
+        max_chars = self.config.get("output_digest_max_chars", 4000)
+
+        # 折叠连续重复的行
+        lines = output.split("\n")
+        collapsed = []
+        index = 0
+        while index < len(lines):
+            repeat = 1
+            while index + repeat < len(lines) and lines[index + repeat] == lines[index]:
+                repeat += 1
+            line = lines[index]
+            if len(line) > 500:
+                line = line[:500] + "...(该行过长，已截断)"
+            collapsed.append(line)
+            if repeat > 1:
+                collapsed.append(f"...(上一行重复 {repeat - 1} 次)")
+            index += repeat
+
+        # 只保留开头和结尾的若干行
+        if len(collapsed) > head_lines + tail_lines:
+            omitted = len(collapsed) - head_lines - tail_lines
+            collapsed = collapsed[:head_lines] + [f"...(省略 {omitted} 行)..."] + collapsed[-tail_lines:]
+
+        digest = "\n".join(collapsed)
+        if len(digest) > max_chars:
+            half = max_chars // 2
+            digest = digest[:half] + f"\n...(省略 {len(digest) - max_chars} 个字符)...\n" + digest[-half:]
+
+        # 短输出每次都原样保留（引用本身不比输出短）
+        if digest == output:
+            return output
+
+        # 保存完整输出，便于AI通过read_output命令按需查看
+        try:
+            if not os.path.exists(output_path):
+                with open(output_path, 'w', encoding='utf-8') as f:
+                    f.write(output)
+        except Exception as e:
+            print(f"保存命令完整输出失败: {e}")
+            return digest
+        OutputCapture.prune_spills(self.outputs_dir, self.config.get("output_spill_max_mb", 512) * 1024 * 1024)
 
-        # 检查配置是否完整
-        if not self.config.get("api_url") or not self.config.get("api_key") or not self.config.get("model"):
-            error_msg = "错误：请先在设置中配置API URL、API Key和模型名称！"
-            self.root.after(0, lambda: self.display_message("系统", error_msg))
-            self.root.after(0, lambda: self.send_button.config(text="发送", command=self.send_message))
+        self.conversation.output_digest_seen[output_hash] = output_id
+        return f"{digest}\n[输出 {output_id}：共 {len(lines)} 行、{len(output)} 个字符，已摘要显示，可使用read_output命令查看完整内容]"
+
+    def read_command_output(self, output_id, offset=0, limit=200):
+        """按行读取已保存的命令完整输出"""
+        if not output_id or not re.fullmatch(r"(out|spill)-[0-9a-f]{10}", str(output_id)):
+            return f"错误：无效的输出编号 '{output_id}'"
+
+        output_path = os.path.join(self.outputs_dir, f"{output_id}.txt")
+        if not os.path.exists(output_path):
+            return f"错误：未找到输出 '{output_id}'"
+
+        try:
+            offset = max(int(offset), 0)
+            limit = min(max(int(limit), 1), 500)  # 单次最多读取500行
+            selected = []
+            total = 0
+            with open(output_path, 'r', encoding='utf-8') as f:
+                for line_no, line in enumerate(f):
+                    total += 1
+                    if offset <= line_no < offset + limit:
+                        selected.append(line.rstrip("\n"))
+
+            content = "\n".join(selected)
+            return f"输出 '{output_id}' 第 {offset + 1}-{offset + len(selected)} 行（共 {total} 行）:\n{content}"
+        except Exception as e:
+            return f"读取输出时发生错误: {str(e)}"
+
+    def publish_message(self, sender, message):
+        """通过引擎事件流发布一条要显示的消息（可在任意线程调用）"""
+        self.engine.publish("message", sender=sender, message=message, conversation_id=self.conversation.conversation_id)
+
+    def on_engine_event(self, event):
+        """界面对引擎事件流的订阅：事件交回UI线程处理"""
+        if event["type"] == "command_output":
+            # 实时输出可能非常频繁，先缓冲，UI线程每次轮询批量写入一次
+            with self.output_buffer_lock:
+                self.output_buffer.append(event)
+                if self.output_flush_pending:
+                    return
+                self.output_flush_pending = True
+            self.post_to_ui(self.flush_command_output)
+            return
+        self.post_to_ui(lambda: self.handle_engine_event(event))
+
+    def flush_command_output(self):
+        """在UI线程中把缓冲的实时输出批量写入对应对话的标签页"""
+        with self.output_buffer_lock:
+            events = self.output_buffer
+            self.output_buffer = []
+            self.output_flush_pending = False
+
+        chunks = {}
+        for event in events:
+            chunks.setdefault(event["conversation_id"], []).append(event["text"])
+
+        max_chars = self.config.get("live_output_max_chars", 20000)
+        for conversation_id, texts in chunks.items():
+            text = "".join(texts)
+            if len(text) > max_chars:
+                text = f"...(输出过快，省略 {len(text) - max_chars} 个字符)...\n" + text[-max_chars:]
+            self.append_live_output(conversation_id, text)
+
+    def append_live_output(self, conversation_id, text):
+        """在对话标签页末尾追加一段实时输出（不计入对话历史）"""
+        tab = self.conversation_tabs.get(conversation_id)
+        if tab is None:
+            return
+        chat_display = tab["chat_display"]
+        colors = self.get_theme_colors()
+        chat_display.config(state=tk.NORMAL)
+        start_pos = chat_display.index("end-1c")
+        chat_display.insert(tk.END, text)
+        chat_display.tag_add("live_output", start_pos, "end-1c")
+        chat_display.tag_config("live_output", foreground=colors["timestamp_fg"])
+        chat_display.config(state=tk.DISABLED)
+        chat_display.see(tk.END)
+
+    def update_process_status(self):
+        """刷新正在运行的命令及其已运行时间"""
+        if not self.live_processes:
+            self.process_status_var.set("")
             return
+        now = time.time()
+        self.process_status_var.set("正在运行: " + "；".join(
+            f"{process['label'][:60]}（{now - process['start_time']:.1f}秒）"
+            for process in self.live_processes.values()
+        ))
+
+    def handle_engine_event(self, event):
+        """在UI线程中处理引擎事件"""
+        if event["type"] == "message":
+            self.display_message(event["sender"], event["message"], event.get("conversation_id"))
+        elif event["type"] == "process_started":
+            self.live_processes[event["process_id"]] = {
+                "label": event["label"],
+                "start_time": time.time(),
+                "conversation_id": event["conversation_id"]
+            }
+            self.append_live_output(event["conversation_id"], f"▶ 正在运行 {event['label']}\n")
+        elif event["type"] == "process_finished":
+            self.flush_command_output()  # 先写完剩余的输出
+            self.live_processes.pop(event["process_id"], None)
+            self.append_live_output(event["conversation_id"], f"■ 运行结束（{event['elapsed']:.1f}秒）\n\n")
+        elif event["type"] == "turn_finished":
+            # 有排队的消息时接着发出，否则当前对话的回复结束时恢复发送按钮
+            tab = self.conversation_tabs.get(event.get("conversation_id"))
+            if tab is not None:
+                if event.get("turn_id") != tab["conversation"].turn_id:
+                    return  # 已停止的旧一轮迟到的结束事件，不影响之后发起的新一轮
+                tab["conversation"].turn_active = False
+                if self.dispatch_pending_messages(tab["conversation"]):
+                    return
+            if event.get("conversation_id") == self.current_conversation.conversation_id:
+                self.send_button.config(text="发送", command=self.send_message)
 
-        # 检查是否为编程请求
-        programming_keywords = ['编程', '代码', '写一个', '创建', '开发', '实现', '程序', '脚本', 'project', 'code', '开发', '编写', '函数', '类', '模块', '算法', '功能', '运行', '测试', '调试', '错误', 'bug', '修复', '检查', '执行']
-        is_programming_request = any(keyword in user_message.lower() for keyword in programming_keywords)
+    async def get_ai_response(self, user_message, conversation=None, turn_id=None):
+        """获取AI的响应（在引擎事件循环中运行）；conversation为空时使用主窗口的对话，turn_id随结束事件一起发布"""
+        if conversation is not None:
+            ACTIVE_CONVERSATION.set(conversation)  # 只影响当前协程任务
 
-        # 首先，向AI询问是否需要查询记忆库
-        self.assess_memory_need(user_message, is_programming_request)
+        try:
+            # 首先检查是否为系统命令
+            command_result = await self.engine.run_blocking(self.process_command, user_message)
+            if command_result:
+                self.publish_message("系统", command_result)
+                return
+
+            # 检查配置是否完整
+            if not self.is_api_configured():
+                self.publish_message("系统", "错误：请先在设置中配置API URL、API Key和模型名称！")
+                return
+
+            # 检查是否为编程请求
+            programming_keywords = ['编程', '代码', '写一个', '创建', '开发', '实现', '程序', '脚本', 'project', 'code', '开发', '编写', '函数', '类', '模块', '算法', '功能', '运行', '测试', '调试', '错误', 'bug', '修复', '检查', '执行']
+            is_programming_request = any(keyword in user_message.lower() for keyword in programming_keywords)
+
+            # 首先，向AI询问是否需要查询记忆库
+            await self.assess_memory_need(user_message, is_programming_request)
+        except Exception as e:
+            self.publish_message("系统", f"错误：获取AI响应时发生未知错误 - {str(e)}")
+        finally:
+            self.engine.publish("turn_finished", user_message=user_message, conversation_id=self.conversation.conversation_id, turn_id=turn_id)
 
-    def assess_memory_need(self, user_message, is_programming_request):
+    async def assess_memory_need(self, user_message, is_programming_request):
         """第一阶段：询问AI是否需要查询记忆库"""
         # 构建一个消息询问AI是否需要查询记忆库
         assessment_prompt = f"""
@@ -1391,40 +4200,20 @@ class OPAIApp:
 """
 
         # 构建评估消息
-        assessment_messages = self.context_messages + [{"role": "user", "content": assessment_prompt}]
+        assessment_messages = self.conversation.context_messages + [{"role": "user", "content": assessment_prompt}]
 
         # 发送评估请求
         try:
-            headers = {"Content-Type": "application/json"}
-
-            # 根据API URL确定认证方式
-            api_url = self.config["api_url"]
-            if "openai.com" in api_url or "api.openai.com" in api_url:
-                headers["Authorization"] = f"Bearer {self.config['api_key']}"
-            elif "azure.com" in api_url or "openai.azure.com" in api_url:
-                headers["api-key"] = self.config['api_key']
-            else:
-                headers["Authorization"] = f"Bearer {self.config['api_key']}"
-
             data = {
                 "model": self.config["model"],
                 "messages": assessment_messages,
                 "temperature": 0.1  # 低温度获得更准确的评估
             }
 
-            import urllib3
-            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-            session = requests.Session()
-            session.trust_env = False
-
-            response = session.post(
-                self.config["api_url"],
-                headers=headers,
-                json=data,
-                timeout=30
-            )
+            response = await self.engine.run_blocking(
+                self.post_api_request, data, lane="interactive", timeout=30, stage="assessment")
 
+            requires_memory = True  # 解析或请求失败时仍然查询记忆库（更安全的做法）
             if response.status_code == 200:
                 result = response.json()
                 try:
@@ -1432,27 +4221,21 @@ class OPAIApp:
 
                     # 解析AI的评估
                     requires_memory = self.parse_memory_assessment(assessment_response)
-
-                    if requires_memory:
-                        # 如果AI认为需要查询记忆库，执行查询
-                        self.query_memory_then_respond(user_message, is_programming_request)
-                    else:
-                        # 如果不需要，直接生成回复
-                        self.generate_direct_response(user_message, is_programming_request)
-
                 except (KeyError, IndexError):
                     print(f"无法从评估响应中提取信息: {result}")
-                    # 如果解析失败，仍然尝试查询记忆库（更安全的做法）
-                    self.query_memory_then_respond(user_message, is_programming_request)
             else:
                 print(f"记忆需求评估请求失败: {response.status_code} - {response.text}")
-                # 如果评估失败，仍然执行查询
-                self.query_memory_then_respond(user_message, is_programming_request)
 
         except Exception as e:
             print(f"记忆需求评估过程中发生错误: {str(e)}")
-            # 如果评估失败，仍然执行查询
-            self.query_memory_then_respond(user_message, is_programming_request)
+            requires_memory = True
+
+        if requires_memory:
+            # 如果AI认为需要查询记忆库，执行查询
+            await self.query_memory_then_respond(user_message, is_programming_request)
+        else:
+            # 如果不需要，直接生成回复
+            await self.generate_direct_response(user_message, is_programming_request)
 
     def parse_memory_assessment(self, assessment_response):
         """解析AI的记忆需求评估"""
@@ -1479,28 +4262,28 @@ class OPAIApp:
         # 如果都失败了，返回False，让系统继续查询
         return True  # 在解析失败时，默认查询记忆以确保不遗漏重要信息
 
-    def query_memory_then_respond(self, user_message, is_programming_request):
+    async def query_memory_then_respond(self, user_message, is_programming_request):
         """查询记忆库，然后生成最终回复"""
-        # 查找相关记忆
-        relevant_memory = self.find_relevant_memory(user_message)
+        # 查找相关记忆（相似度计算较耗时，放到线程池中执行）
+        relevant_memory = await self.engine.run_blocking(self.find_relevant_memory, user_message)
 
         # 生成最终回复
-        self.generate_response_with_memory(user_message, is_programming_request, relevant_memory)
+        await self.generate_response_with_memory(user_message, is_programming_request, relevant_memory)
 
-    def generate_direct_response(self, user_message, is_programming_request):
+    async def generate_direct_response(self, user_message, is_programming_request):
         """直接生成回复（不需要记忆库信息）"""
         # 按原逻辑处理
         if is_programming_request:
-            enhanced_prompt = f"{user_message}\n\n请按照以下步骤完成任务：\n1. 首先，提供一个To Do列表，详细说明需要完成的步骤\n2. 然后，按照To Do列表逐步执行\n\n你需要使用以下JSON格式输出所有命令：\n```json\n[\n  {{\n    \"type\": \"message\",\n    \"params\": {{ \"content\": \"任务说明\" }}\n  }},\n  {{\n    \"type\": \"create_file\",\n    \"params\": {{ \"path\": \"文件路径\", \"content\": \"文件内容\" }}\n  }},\n  {{\n    \"type\": \"create_folder\",\n    \"params\": {{ \"path\": \"文件夹路径\" }}\n  }},\n  {{\n    \"type\": \"run_python\",\n    \"params\": {{ \"path\": \"Python文件路径\" }}\n  }},\n  {{\n    \"type\": \"run_javascript\",\n    \"params\": {{ \"path\": \"JavaScript文件路径\" }}\n  }},\n  {{\n    \"type\": \"run_java\",\n    \"params\": {{ \"path\": \"Java文件路径\" }}\n  }},\n  {{\n    \"type\": \"run_cpp\",\n    \"params\": {{ \"path\": \"C++文件路径\" }}\n  }},\n  {{\n    \"type\": \"run_c\",\n    \"params\": {{ \"path\": \"C文件路径\" }}\n  }},\n  {{\n    \"type\": \"run_cmd\",\n    \"params\": {{ \"command\": \"CMD命令\" }}\n  }},\n  {{\n    \"type\": \"run_powershell\",\n    \"params\": {{ \"command\": \"PowerShell命令\" }}\n  }},\n  {{\n    \"type\": \"read_file\",\n    \"params\": {{ \"path\": \"文件路径\" }}\n  }},\n  {{\n    \"type\": \"list_dir\",\n    \"params\": {{ \"path\": \"目录路径\" }}\n  }}\n]\n```"
-            messages = self.context_messages + [{"role": "user", "content": enhanced_prompt}]
+            enhanced_prompt = f"{user_message}\n\n请按照以下步骤完成任务：\n1. 首先，提供一个To Do列表，详细说明需要完成的步骤\n2. 然后，按照To Do列表逐步执行\n\n你需要使用以下JSON格式输出所有命令：\n```json\n[\n  {{\n    \"type\": \"message\",\n    \"params\": {{ \"content\": \"任务说明\" }}\n  }},\n  {{\n    \"type\": \"create_file\",\n    \"params\": {{ \"path\": \"文件路径\", \"content\": \"文件内容\" }}\n  }},\n  {{\n    \"type\": \"edit_file\",\n    \"params\": {{ \"path\": \"文件路径\", \"edits\": [{{ \"search\": \"原内容\", \"replace\": \"新内容\" }}] }}\n  }},\n  {{\n    \"type\": \"create_folder\",\n    \"params\": {{ \"path\": \"文件夹路径\" }}\n  }},\n  {{\n    \"type\": \"run_python\",\n    \"params\": {{ \"path\": \"Python文件路径\" }}\n  }},\n  {{\n    \"type\": \"run_javascript\",\n    \"params\": {{ \"path\": \"JavaScript文件路径\" }}\n  }},\n  {{\n    \"type\": \"run_java\",\n    \"params\": {{ \"path\": \"Java文件路径\" }}\n  }},\n  {{\n    \"type\": \"run_cpp\",\n    \"params\": {{ \"path\": \"C++文件路径\" }}\n  }},\n  {{\n    \"type\": \"run_c\",\n    \"params\": {{ \"path\": \"C文件路径\" }}\n  }},\n  {{\n    \"type\": \"build\",\n    \"params\": {{ \"path\": \"项目目录\" }}\n  }},\n  {{\n    \"type\": \"run_cmd\",\n    \"params\": {{ \"command\": \"CMD命令\" }}\n  }},\n  {{\n    \"type\": \"run_powershell\",\n    \"params\": {{ \"command\": \"PowerShell命令\" }}\n  }},\n  {{\n    \"type\": \"read_file\",\n    \"params\": {{ \"path\": \"文件路径\", \"offset\": 0, \"limit\": 200 }}\n  }},\n  {{\n    \"type\": \"list_dir\",\n    \"params\": {{ \"path\": \"目录路径\" }}\n  }},\n  {{\n    \"type\": \"read_output\",\n    \"params\": {{ \"id\": \"输出编号\", \"offset\": 0, \"limit\": 200 }}\n  }}\n]\n```"
+            messages = self.conversation.context_messages + [{"role": "user", "content": enhanced_prompt}]
         else:
             # 使用原始消息
-            messages = self.context_messages + [{"role": "user", "content": user_message}]
+            messages = self.conversation.context_messages + [{"role": "user", "content": user_message}]
 
         # 发送API请求
-        self.send_api_request(messages, user_message)
+        await self.send_api_request(messages, user_message)
 
-    def generate_response_with_memory(self, user_message, is_programming_request, relevant_memory):
+    async def generate_response_with_memory(self, user_message, is_programming_request, relevant_memory):
         """使用记忆信息生成回复"""
         if relevant_memory:
             # 创建一个包含相关记忆的系统消息
@@ -1510,35 +4293,21 @@ class OPAIApp:
             memory_context += f"\n原始用户消息: {user_message}"
 
             if is_programming_request:
-                enhanced_prompt = f"{memory_context}\n\n请按照以下步骤完成任务：\n1. 首先，提供一个To Do列表，详细说明需要完成的步骤\n2. 然后，按照To Do列表逐步执行\n\n你需要使用以下JSON格式输出所有命令：\n```json\n[\n  {{\n    \"type\": \"message\",\n    \"params\": {{ \"content\": \"任务说明\" }}\n  }},\n  {{\n    \"type\": \"create_file\",\n    \"params\": {{ \"path\": \"文件路径\", \"content\": \"文件内容\" }}\n  }},\n  {{\n    \"type\": \"create_folder\",\n    \"params\": {{ \"path\": \"文件夹路径\" }}\n  }},\n  {{\n    \"type\": \"run_python\",\n    \"params\": {{ \"path\": \"Python文件路径\" }}\n  }},\n  {{\n    \"type\": \"run_javascript\",\n    \"params\": {{ \"path\": \"JavaScript文件路径\" }}\n  }},\n  {{\n    \"type\": \"run_java\",\n    \"params\": {{ \"path\": \"Java文件路径\" }}\n  }},\n  {{\n    \"type\": \"run_cpp\",\n    \"params\": {{ \"path\": \"C++文件路径\" }}\n  }},\n  {{\n    \"type\": \"run_c\",\n    \"params\": {{ \"path\": \"C文件路径\" }}\n  }},\n  {{\n    \"type\": \"run_cmd\",\n    \"params\": {{ \"command\": \"CMD命令\" }}\n  }},\n  {{\n    \"type\": \"run_powershell\",\n    \"params\": {{ \"command\": \"PowerShell命令\" }}\n  }},\n  {{\n    \"type\": \"read_file\",\n    \"params\": {{ \"path\": \"文件路径\" }}\n  }},\n  {{\n    \"type\": \"list_dir\",\n    \"params\": {{ \"path\": \"目录路径\" }}\n  }}\n]\n```"
-                messages = self.context_messages + [{"role": "user", "content": enhanced_prompt}]
+                enhanced_prompt = f"{memory_context}\n\n请按照以下步骤完成任务：\n1. 首先，提供一个To Do列表，详细说明需要完成的步骤\n2. 然后，按照To Do列表逐步执行\n\n你需要使用以下JSON格式输出所有命令：\n```json\n[\n  {{\n    \"type\": \"message\",\n    \"params\": {{ \"content\": \"任务说明\" }}\n  }},\n  {{\n    \"type\": \"create_file\",\n    \"params\": {{ \"path\": \"文件路径\", \"content\": \"文件内容\" }}\n  }},\n  {{\n    \"type\": \"edit_file\",\n    \"params\": {{ \"path\": \"文件路径\", \"edits\": [{{ \"search\": \"原内容\", \"replace\": \"新内容\" }}] }}\n  }},\n  {{\n    \"type\": \"create_folder\",\n    \"params\": {{ \"path\": \"文件夹路径\" }}\n  }},\n  {{\n    \"type\": \"run_python\",\n    \"params\": {{ \"path\": \"Python文件路径\" }}\n  }},\n  {{\n    \"type\": \"run_javascript\",\n    \"params\": {{ \"path\": \"JavaScript文件路径\" }}\n  }},\n  {{\n    \"type\": \"run_java\",\n    \"params\": {{ \"path\": \"Java文件路径\" }}\n  }},\n  {{\n    \"type\": \"run_cpp\",\n    \"params\": {{ \"path\": \"C++文件路径\" }}\n  }},\n  {{\n    \"type\": \"run_c\",\n    \"params\": {{ \"path\": \"C文件路径\" }}\n  }},\n  {{\n    \"type\": \"build\",\n    \"params\": {{ \"path\": \"项目目录\" }}\n  }},\n  {{\n    \"type\": \"run_cmd\",\n    \"params\": {{ \"command\": \"CMD命令\" }}\n  }},\n  {{\n    \"type\": \"run_powershell\",\n    \"params\": {{ \"command\": \"PowerShell命令\" }}\n  }},\n  {{\n    \"type\": \"read_file\",\n    \"params\": {{ \"path\": \"文件路径\", \"offset\": 0, \"limit\": 200 }}\n  }},\n  {{\n    \"type\": \"list_dir\",\n    \"params\": {{ \"path\": \"目录路径\" }}\n  }},\n  {{\n    \"type\": \"read_output\",\n    \"params\": {{ \"id\": \"输出编号\", \"offset\": 0, \"limit\": 200 }}\n  }}\n]\n```"
+                messages = self.conversation.context_messages + [{"role": "user", "content": enhanced_prompt}]
             else:
                 # 对于非编程请求，也将相关记忆包含在内
-                messages = self.context_messages + [{"role": "user", "content": memory_context}]
+                messages = self.conversation.context_messages + [{"role": "user", "content": memory_context}]
         else:
             # 没有相关记忆，但长期记忆库非空，通知AI
-            messages = self.context_messages + [{"role": "user", "content": f"注意：长期记忆库中有 {len(self.memory['long_term_memory'])} 条记忆记录，但与当前查询的相似度未达到 {self.config.get('memory_similarity_threshold', 85)}% 的阈值。如果您觉得相关信息可能在记忆库中，请告知用户。\n\n{user_message}"}]
+            messages = self.conversation.context_messages + [{"role": "user", "content": f"注意：长期记忆库中有 {len(self.memory['long_term_memory'])} 条记忆记录，但与当前查询的相似度未达到 {self.config.get('memory_similarity_threshold', 85)}% 的阈值。如果您觉得相关信息可能在记忆库中，请告知用户。\n\n{user_message}"}]
 
         # 发送API请求
-        self.send_api_request(messages, user_message)
+        await self.send_api_request(messages, user_message)
 
-    def send_api_request(self, messages, original_user_message):
+    async def send_api_request(self, messages, original_user_message):
         """发送API请求并处理响应"""
         try:
-            # 根据API URL确定认证方式和请求格式
-            api_url = self.config["api_url"]
-            headers = {"Content-Type": "application/json"}
-
-            # 对于OpenAI API风格的服务，使用Bearer认证
-            if "openai.com" in api_url or "api.openai.com" in api_url:
-                headers["Authorization"] = f"Bearer {self.config['api_key']}"
-            # 对于Azure OpenAI，可能需要不同的认证
-            elif "azure.com" in api_url or "openai.azure.com" in api_url:
-                headers["api-key"] = self.config['api_key']
-            # 对于其他API服务，也可以添加特定的处理
-            else:
-                headers["Authorization"] = f"Bearer {self.config['api_key']}"
-
             data = {
                 "model": self.config["model"],
                 "messages": messages,  # 使用上面已经定义的messages
@@ -1548,23 +4317,17 @@ class OPAIApp:
 
             # 发送API请求
             print(f"正在向 {self.config['api_url']} 发送请求...")  # 调试信息
-            print(f"Headers: {headers}")  # 调试信息
             print(f"Data: {data}")  # 调试信息
 
             try:
-                import urllib3
-                urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)  # 禁用SSL警告
-
-                # 创建不使用系统代理的会话
-                session = requests.Session()
-                session.trust_env = False
-
-                response = session.post(
-                    self.config["api_url"],
-                    headers=headers,
-                    json=data,
+                # 重试、熔断、对冲等请求逻辑基于requests同步实现，放到线程池中执行
+                response = await self.engine.run_blocking(
+                    self.post_api_request,
+                    data,
+                    lane="interactive",
                     timeout=60,  # 增加超时时间到60秒
-                    verify=False  # 禁用SSL验证（仅用于测试）
+                    verify=False,  # 禁用SSL验证（仅用于测试）
+                    stage="chat"
                 )
 
                 print(f"收到响应，状态码: {response.status_code}")  # 调试信息
@@ -1614,12 +4377,12 @@ class OPAIApp:
                             if message_contents:
                                 # 将所有message内容合并显示
                                 ai_message = "\n".join(message_contents)
-                                self.root.after(0, lambda msg=ai_message: self.display_message("AI", msg))
-                                self.context_messages.append({"role": "assistant", "content": ai_message})
+                                self.publish_message("AI", ai_message)
+                                self.conversation.context_messages.append({"role": "assistant", "content": ai_message})
                             else:
                                 # 如果没有有效的message内容但有JSON，仍需处理
-                                self.root.after(0, lambda: self.display_message("AI", ai_response))
-                                self.context_messages.append({"role": "assistant", "content": ai_response})
+                                self.publish_message("AI", ai_response)
+                                self.conversation.context_messages.append({"role": "assistant", "content": ai_response})
                         elif json_commands and not only_message_commands:
                             # 如果包含非message命令，先提取并显示message内容
                             message_contents = []
@@ -1632,13 +4395,13 @@ class OPAIApp:
                             if message_contents:
                                 # 将所有message内容合并显示
                                 ai_message = "\n".join(message_contents)
-                                self.root.after(0, lambda msg=ai_message: self.display_message("AI", msg))
+                                self.publish_message("AI", ai_message)
 
                             # 显示用户的原始请求
-                            self.root.after(0, lambda: self.display_message("用户", original_user_message))
+                            self.publish_message("用户", original_user_message)
 
                             # 逐步执行JSON命令，只显示执行结果
-                            executed_commands = self.execute_json_commands(json_commands)
+                            executed_commands = await self.engine.run_blocking(self.execute_json_commands, json_commands)
 
                             for idx, cmd in enumerate(json_commands):
                                 cmd_type = cmd.get("type", "")
@@ -1647,10 +4410,14 @@ class OPAIApp:
                                 if cmd_type != "message" and idx < len(executed_commands):
                                     cmd_result = executed_commands[idx]
                                     # 只显示执行结果，不显示AI的意图
-                                    self.root.after(0, lambda result=cmd_result: self.display_message("系统", result.split('\n', 1)[1] if '\n' in result else result))  # 显示执行结果，但去掉命令描述
+                                    self.publish_message("系统", cmd_result.split('\n', 1)[1] if '\n' in cmd_result else cmd_result)  # 显示执行结果，但去掉命令描述
+                                    self.engine.publish("command_result", command=cmd, result=cmd_result, conversation_id=self.conversation.conversation_id)
 
                                     # 将命令执行结果添加到上下文中，以保持对话连贯性
-                                    self.context_messages.append({"role": "system", "content": f"命令执行结果: {cmd_result}"})
+                                    # 较长的输出只保留摘要，完整内容可通过read_output命令查看；按范围读取的结果不再摘要
+                                    if cmd_type not in ("read_output", "read_file"):
+                                        cmd_result = self.digest_command_output(cmd_result)
+                                    self.conversation.context_messages.append({"role": "system", "content": f"命令执行结果: {cmd_result}"})
 
                                     # 如果命令执行结果包含错误信息，考虑添加一个提示给AI
                                     if "错误" in cmd_result or "失败" in cmd_result:
@@ -1659,49 +4426,531 @@ class OPAIApp:
                                         pass
                         else:
                             # 如果没有JSON命令，正常显示AI的响应
-                            self.root.after(0, lambda: self.display_message("AI", ai_response))
-                            self.context_messages.append({"role": "assistant", "content": ai_response})
+                            self.publish_message("AI", ai_response)
+                            self.conversation.context_messages.append({"role": "assistant", "content": ai_response})
 
                         # 更新上下文消息列表
-                        self.context_messages.append({"role": "user", "content": original_user_message})
-
-                        # 限制上下文长度为最近的10条消息（系统消息+9轮对话 = 10条）
-                        if len(self.context_messages) > 10:  # 系统消息(1) + 9轮对话(用户+AI各1条 = 9)
-                            self.context_messages = self.context_messages[:1] + self.context_messages[-9:]  # 保留系统消息+最近9轮对话
+                        self.conversation.context_messages.append({"role": "user", "content": original_user_message})
+
+                        # 限制上下文长度为系统消息（及滚动摘要）+最近9条消息
+                        # 被移出窗口的消息不会直接丢弃，而是交给后台增量压缩进滚动摘要
+                        evicted_messages = []
+                        with self.conversation.context_lock:
+                            head_size = self.get_context_head_size()
+                            if len(self.conversation.context_messages) > head_size + 9:
+                                evicted_messages = self.conversation.context_messages[head_size:-9]
+                                self.conversation.context_messages = self.conversation.context_messages[:head_size] + self.conversation.context_messages[-9:]
+                        if evicted_messages:
+                            self.schedule_context_compression(evicted_messages)
                     except ValueError:  # JSON解析错误
                         error_msg = f"无法解析API响应（非JSON格式）: {response.text}"
-                        self.root.after(0, lambda: self.display_message("系统", error_msg))
+                        self.publish_message("系统", error_msg)
                 else:
                     error_msg = f"API请求失败：{response.status_code} - {response.text}"
-                    self.root.after(0, lambda: self.display_message("系统", error_msg))
+                    self.publish_message("系统", error_msg)
             except requests.exceptions.RequestException as e:
                 print(f"请求异常: {e}")  # 调试信息
                 error_msg = f"API请求异常: {str(e)}"
-                self.root.after(0, lambda: self.display_message("系统", error_msg))
+                self.publish_message("系统", error_msg)
             except Exception as e:
                 print(f"其他异常: {e}")  # 调试信息
                 error_msg = f"发生未知错误: {str(e)}"
-                self.root.after(0, lambda: self.display_message("系统", error_msg))
+                self.publish_message("系统", error_msg)
 
         except requests.exceptions.Timeout:
             error_msg = "错误：API请求超时，请检查网络连接或API地址是否正确。"
-            self.root.after(0, lambda: self.display_message("系统", error_msg))
+            self.publish_message("系统", error_msg)
         except requests.exceptions.ConnectionError:
             error_msg = "错误：无法连接到API服务器，请检查API地址是否正确、网络连接是否正常。"
-            self.root.after(0, lambda: self.display_message("系统", error_msg))
+            self.publish_message("系统", error_msg)
         except requests.exceptions.RequestException as e:
             error_msg = f"错误：网络请求失败 - {str(e)}"
-            self.root.after(0, lambda: self.display_message("系统", error_msg))
+            self.publish_message("系统", error_msg)
         except KeyError:
             error_msg = "错误：API响应格式不正确，请检查API配置。"
-            self.root.after(0, lambda: self.display_message("系统", error_msg))
+            self.publish_message("系统", error_msg)
         except Exception as e:
             error_msg = f"错误：获取AI响应时发生未知错误 - {str(e)}"
-            self.root.after(0, lambda: self.display_message("系统", error_msg))
-
-        # 恢复发送按钮
-        self.root.after(0, lambda: self.send_button.config(text="发送", command=self.send_message))
+            self.publish_message("系统", error_msg)
     
+    def build_api_headers(self, api_url, api_key):
+        """根据API地址确定认证方式，生成请求头"""
+        headers = {"Content-Type": "application/json"}
+
+        # 对于Azure OpenAI，使用api-key请求头
+        if "azure.com" in api_url or "openai.azure.com" in api_url:
+            headers["api-key"] = api_key
+        # 对于OpenAI及其他API服务，使用Bearer认证
+        else:
+            headers["Authorization"] = f"Bearer {api_key}"
+
+        return headers
+
+    def post_api_request(self, data, lane="interactive", timeout=60, verify=True, stage=None):
+        """通过请求调度器发送对话补全请求，返回响应对象
+
+        lane为"interactive"（前台交互）或"background"（后台任务），
+        后台请求会在前台有请求等待或进行时让行。
+        stage为请求所属的处理阶段，用于套用该阶段的模型、端点、温度和最大token数设置。
+        配置了多个端点时，按权重和观测到的响应时间选择端点，失败时自动切换到其他端点。
+        遇到429/5xx/超时等临时错误时按退避策略自动重试；
+        同一端点连续失败过多时熔断，熔断期间请求直接失败而不再等待超时。
+        启用对冲请求时，指定阶段的主请求在延迟阈值内没有收到首字节，会向备用端点或模型再发一份，取先返回者。
+        """
+        import random
+        import uuid
+        import urllib3
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+        # 同一请求的所有重试使用相同的请求ID，便于服务端去重
+        request_id = uuid.uuid4().hex
+
+        max_retries = self.config.get("api_max_retries", 3)
+        base_delay = self.config.get("api_retry_base_delay", 0.5)
+        max_delay = self.config.get("api_retry_max_delay", 8)
+        delay = base_delay
+        attempt = 0
+        failed_endpoints = set()  # 本次请求中失败过的端点，重试时优先切换到其他端点
+
+        # 套用该阶段的路由设置，未设置的项沿用主配置
+        stage_override = self.get_stage_override(stage)
+        data = dict(data)
+        if stage_override.get("temperature") is not None:
+            data["temperature"] = stage_override["temperature"]
+        if stage_override.get("max_tokens"):
+            data["max_tokens"] = stage_override["max_tokens"]
+
+        use_hedging = self.config.get("hedge_enabled", False) and stage in self.config.get("hedge_stages", ["chat"])
+
+        def do_post(endpoint, session=None, model=None, on_first_byte=None, cancel_event=None, request_key=None):
+            # 对冲请求的内容可能不同（备用模型），使用独立的请求ID，避免被服务端当作重复请求
+            headers = self.build_api_headers(endpoint["api_url"], endpoint["api_key"])
+            headers["Idempotency-Key"] = request_key or request_id
+            headers["X-Request-ID"] = request_key or request_id
+
+            # 模型优先级：对冲备用模型 > 阶段设置 > 端点设置 > 主配置
+            payload = dict(data)
+            if model:
+                payload["model"] = model
+            elif stage_override.get("model"):
+                payload["model"] = stage_override["model"]
+            elif endpoint.get("model"):
+                payload["model"] = endpoint["model"]
+
+            start_time = time.time()
+            response = (session or self.http_session).post(
+                endpoint["api_url"],
+                headers=headers,
+                json=payload,
+                timeout=timeout,
+                verify=verify,
+                stream=on_first_byte is not None  # 对冲模式下收到响应头即视为收到首字节
+            )
+            if on_first_byte is not None:
+                on_first_byte()
+                if cancel_event is not None and cancel_event.is_set():
+                    # 对冲中已有其他请求胜出，直接关闭连接，丢弃响应体
+                    response.close()
+                    raise HedgeCancelledError("对冲请求已被取消")
+                response.content  # 读取完整响应体
+            elapsed = time.time() - start_time
+
+            # 服务端限流时，按Retry-After暂停所有通道的请求
+            if response.status_code in [429, 503]:
+                retry_after = self.dispatcher.parse_retry_after(response.headers.get("Retry-After"))
+                if retry_after is not None or response.status_code == 429:
+                    self.dispatcher.defer_for(retry_after if retry_after is not None else 1)
+
+            return response, elapsed
+
+        while True:
+            # 按优先顺序挑选第一个未熔断的端点
+            endpoint = None
+            for candidate in self.endpoint_pool.rank(exclude=failed_endpoints, only=stage_override.get("endpoint")):
+                if self.get_circuit_breaker(candidate["api_url"]).allow_request():
+                    endpoint = candidate
+                    break
+            if endpoint is None:
+                raise CircuitOpenError("所有API端点均连续失败，已暂停请求，请稍后重试")
+
+            try:
+                if use_hedging:
+                    # 对冲胜出的可能是备用端点，后续统计以实际返回的端点为准
+                    # 主请求与对冲请求合计只占用一个通道名额，胜出方返回即释放，不被落败方拖住
+                    endpoint, response, elapsed = self.dispatcher.submit(
+                        lane, lambda: self.send_hedged_request(
+                            endpoint, do_post, failed_endpoints, stage_override.get("endpoint"), f"{request_id}-h{attempt + 1}"))
+                else:
+                    response, elapsed = self.dispatcher.submit(lane, lambda: do_post(endpoint))
+                breaker = self.get_circuit_breaker(endpoint["api_url"])
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                breaker = self.get_circuit_breaker(endpoint["api_url"])
+                breaker.record_failure()
+                self.endpoint_pool.record_failure(endpoint["name"])
+                failed_endpoints.add(endpoint["name"])
+                if attempt >= max_retries:
+                    raise
+                print(f"请求 {request_id[:8]} 在端点 {endpoint['name']} 失败（{type(e).__name__}），准备第 {attempt + 1} 次重试")
+            except requests.exceptions.RequestException:
+                # 其他请求错误（如响应体读取中断、SSL错误、无效URL）不重试，但同样计为端点失败
+                self.get_circuit_breaker(endpoint["api_url"]).record_failure()
+                self.endpoint_pool.record_failure(endpoint["name"])
+                raise
+            except BaseException:
+                # 与端点无关的异常不计入熔断，只归还可能占用的试探名额
+                self.get_circuit_breaker(endpoint["api_url"]).release_probe()
+                raise
+            else:
+                if response.status_code not in [429, 500, 502, 503, 504]:
+                    breaker.record_success()
+                    self.endpoint_pool.record_success(endpoint["name"], elapsed)
+                    return response
+
+                # 429是限流而非端点故障（端点仍有响应），不计入熔断
+                if response.status_code == 429:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+                    self.endpoint_pool.record_failure(endpoint["name"])
+                failed_endpoints.add(endpoint["name"])
+                if attempt >= max_retries:
+                    return response
+                print(f"请求 {request_id[:8]} 在端点 {endpoint['name']} 返回 {response.status_code}，准备第 {attempt + 1} 次重试")
+
+            # 还有其他可用端点时立即切换，否则按去相关抖动退避后重试：
+            # 在[base, 上次间隔*3]之间随机取值，不超过上限
+            if not self.endpoint_pool.has_alternative(failed_endpoints):
+                delay = min(max_delay, random.uniform(base_delay, delay * 3))
+                time.sleep(delay)
+            attempt += 1
+
+    def send_hedged_request(self, endpoint, do_post, failed_endpoints, pinned_endpoint=None, hedge_key=None):
+        """对冲请求：主请求在延迟阈值（观测到的首字节时间分位数）内没有收到首字节时，
+        向备用端点或备用模型再发一份相同请求（请求ID为hedge_key），使用先成功返回的响应，并取消另一方
+
+        返回 (实际返回的端点, 响应, 耗时)。落败方端点的熔断统计在这里记录，胜出方由调用方记录；
+        都失败时抛出主请求的异常。
+        """
+        hedge_delay = self.get_hedge_delay()
+        results = queue.Queue()
+        first_byte = threading.Event()
+        cancel_events = {"primary": threading.Event(), "hedge": threading.Event()}
+        start_time = time.time()
+
+        def on_primary_first_byte():
+            first_byte.set()
+            self.record_first_byte_latency(time.time() - start_time)
+
+        def run_attempt(name, target_endpoint, model, on_first_byte):
+            # 每个请求使用独立会话，互不影响连接池
+            session = requests.Session()
+            session.trust_env = False
+            try:
+                if name == "hedge":
+                    self.dispatcher.rate_limiter.acquire()  # 对冲请求同样计入每分钟请求数
+                request_key = hedge_key if name == "hedge" else None
+                response, elapsed = do_post(target_endpoint, session, model, on_first_byte or (lambda: None), cancel_events[name], request_key)
+                results.put((name, target_endpoint, response, elapsed, None))
+            except Exception as e:
+                results.put((name, target_endpoint, None, None, e))
+            finally:
+                session.close()
+
+        primary_thread = threading.Thread(target=run_attempt, args=("primary", endpoint, None, on_primary_first_byte))
+        primary_thread.daemon = True
+        primary_thread.start()
+        attempt_count = 1
+        hedge_endpoint = None
+
+        with self.hedge_lock:
+            self.hedge_stats["requests"] += 1
+
+        if not first_byte.wait(hedge_delay) and results.empty():
+            hedge_endpoint, hedge_model = self.choose_hedge_target(endpoint, failed_endpoints, pinned_endpoint)
+            if hedge_endpoint is not None:
+                with self.hedge_lock:
+                    self.hedge_stats["hedged"] += 1
+                print(f"主请求 {hedge_delay:.1f} 秒内未收到首字节，向 {hedge_endpoint['name']} 发送对冲请求")
+                hedge_thread = threading.Thread(target=run_attempt, args=("hedge", hedge_endpoint, hedge_model, None))
+                hedge_thread.daemon = True
+                hedge_thread.start()
+                attempt_count = 2
+
+        # 取先成功返回的响应；都失败时使用主请求的结果，与调用方记录熔断的端点一致
+        collected = {}
+        outcome = None
+        for _ in range(attempt_count):
+            result = results.get()
+            collected[result[0]] = result
+            name, _, response, _, error = result
+            if error is None and response.status_code in [200, 201]:
+                outcome = result
+                break
+        if outcome is None:
+            outcome = collected["primary"]
+
+        winner, winner_endpoint, response, elapsed, error = outcome
+
+        # requests无法中断进行中的连接，失败方收到响应头后立即关闭连接并丢弃结果
+        for name, cancel_event in cancel_events.items():
+            if name != winner:
+                cancel_event.set()
+
+        # 落败方已返回（失败）时计入熔断；仍在进行中的被取消，只归还其占用的试探名额
+        if hedge_endpoint is not None:
+            loser, loser_endpoint = ("hedge", hedge_endpoint) if winner == "primary" else ("primary", endpoint)
+            if loser_endpoint["api_url"] != winner_endpoint["api_url"]:
+                breaker = self.get_circuit_breaker(loser_endpoint["api_url"])
+                if loser in collected:
+                    breaker.record_failure()
+                    self.endpoint_pool.record_failure(loser_endpoint["name"])
+                else:
+                    breaker.release_probe()
+
+        if winner == "hedge" and error is None:
+            with self.hedge_lock:
+                self.hedge_stats["wins"] += 1
+
+        if error is not None:
+            raise error
+        return winner_endpoint, response, elapsed
+
+    def get_hedge_delay(self):
+        """对冲延迟：主请求首字节时间的指定分位数；样本不足时使用默认值"""
+        with self.hedge_lock:
+            samples = sorted(self.first_byte_latencies)
+        if len(samples) < 10:
+            return self.config.get("hedge_default_delay", 8.0)
+
+        percentile = self.config.get("hedge_percentile", 90)
+        index = min(int(len(samples) * percentile / 100), len(samples) - 1)
+        return max(samples[index], self.config.get("hedge_min_delay", 0.5))
+
+    def record_first_byte_latency(self, latency):
+        """记录主请求的首字节时间，用于计算对冲延迟"""
+        with self.hedge_lock:
+            self.first_byte_latencies.append(latency)
+
+    def choose_hedge_target(self, primary_endpoint, failed_endpoints, pinned_endpoint=None):
+        """选择对冲目标：优先使用配置的备用模型，否则选择另一个健康端点"""
+        hedge_model = self.config.get("hedge_model", "")
+        if hedge_model:
+            return primary_endpoint, hedge_model
+
+        if pinned_endpoint:
+            return None, None  # 阶段固定了端点，且没有备用模型时不对冲
+
+        exclude = set(failed_endpoints) | {primary_endpoint["name"]}
+        for candidate in self.endpoint_pool.rank(exclude=exclude):
+            if candidate["name"] in exclude:
+                break  # 只剩失败过的端点
+            if self.get_circuit_breaker(candidate["api_url"]).allow_request():
+                return candidate, None
+        return None, None
+
+    def get_stage_override(self, stage):
+        """获取指定阶段的模型路由设置（model、endpoint、temperature、max_tokens），空值表示沿用主配置"""
+        override = self.config.get("stage_overrides", {}).get(stage or "", {})
+        return {key: value for key, value in override.items() if value not in ("", None)}
+
+    def get_configured_endpoints(self):
+        """根据配置生成端点列表：主端点（api_url/api_key/model）加上附加端点"""
+        endpoints = []
+        if self.config.get("api_url"):
+            endpoints.append({
+                "name": "默认",
+                "api_url": self.config["api_url"],
+                "api_key": self.config.get("api_key", ""),
+                "model": self.config.get("model", ""),
+                "weight": 1
+            })
+
+        for index, endpoint in enumerate(self.config.get("api_endpoints", [])):
+            if not endpoint.get("api_url"):
+                continue
+            endpoints.append({
+                "name": endpoint.get("name") or f"端点{index + 1}",
+                "api_url": endpoint["api_url"],
+                "api_key": endpoint.get("api_key", self.config.get("api_key", "")),
+                "model": endpoint.get("model", ""),
+                "weight": endpoint.get("weight", 1)
+            })
+
+        return endpoints
+
+    def is_api_configured(self):
+        """检查是否至少有一个可用的API端点（地址、Key和模型名称齐全）"""
+        for endpoint in self.get_configured_endpoints():
+            if endpoint["api_key"] and (endpoint["model"] or self.config.get("model")):
+                return True
+        return False
+
+    def check_endpoint_health(self):
+        """定期健康检查：向被标记为异常的端点发送极小的探测请求（在后台线程中执行）"""
+        self.job_runner.ensure_background_thread("endpoint_health_check")
+
+        for endpoint in self.endpoint_pool.get_unhealthy():
+            data = {
+                "model": endpoint.get("model") or self.config.get("model"),
+                "messages": [{"role": "user", "content": "ping"}],
+                "max_tokens": 1
+            }
+            headers = self.build_api_headers(endpoint["api_url"], endpoint["api_key"])
+
+            def probe():
+                start_time = time.time()
+                response = self.http_session.post(endpoint["api_url"], headers=headers, json=data, timeout=10)
+                return response, time.time() - start_time
+
+            try:
+                response, elapsed = self.dispatcher.submit("background", probe)
+                if response.status_code in [200, 201]:
+                    self.endpoint_pool.record_success(endpoint["name"], elapsed)
+                    self.get_circuit_breaker(endpoint["api_url"]).record_success()
+                    print(f"端点 {endpoint['name']} 已恢复，响应时间 {elapsed:.2f} 秒")
+                    continue
+            except requests.exceptions.RequestException:
+                pass
+            self.endpoint_pool.record_failure(endpoint["name"])
+
+    def get_circuit_breaker(self, api_url):
+        """获取指定端点的熔断器（按端点地址分别统计）"""
+        with self.circuit_breakers_lock:
+            breaker = self.circuit_breakers.get(api_url)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    self.config.get("circuit_breaker_threshold", 5),
+                    self.config.get("circuit_breaker_cooldown", 30)
+                )
+                self.circuit_breakers[api_url] = breaker
+            return breaker
+
+    def request_chat_completion(self, messages, temperature=0.3, timeout=60, lane="background", stage=None):
+        """发送一次简单的对话补全请求，返回AI回复文本，失败时返回None"""
+        if not self.is_api_configured():
+            print("无法发送请求：API配置不完整")
+            return None
+
+        try:
+            response = self.post_api_request(
+                {
+                    "model": self.config["model"],
+                    "messages": messages,
+                    "temperature": temperature
+                },
+                lane=lane,
+                timeout=timeout,
+                stage=stage
+            )
+
+            if response.status_code not in [200, 201]:
+                print(f"请求失败：{response.status_code} - {response.text}")
+                return None
+
+            result = response.json()
+            return result["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, ValueError):
+            print("无法从API响应中提取回复内容")
+        except Exception as e:
+            print(f"请求过程中发生错误: {str(e)}")
+        return None
+
+    @property
+    def conversation(self):
+        """当前正在处理的对话：引擎中的对话流程通过ACTIVE_CONVERSATION指定，否则为主窗口选中的对话"""
+        return ACTIVE_CONVERSATION.get() or self.current_conversation
+
+    def get_context_head_size(self, conversation=None):
+        """返回上下文头部固定保留的消息数（系统提示词，以及存在时的滚动摘要）"""
+        context_messages = (conversation or self.conversation).context_messages
+        if (len(context_messages) > 1 and
+                context_messages[1].get("role") == "system" and
+                context_messages[1].get("content", "").startswith(CONTEXT_SUMMARY_PREFIX)):
+            return 2
+        return 1
+
+    def schedule_context_compression(self, evicted_messages):
+        """将移出上下文窗口的消息交给后台线程压缩进滚动摘要（请求走低优先级通道）"""
+        conversation = self.conversation
+        self.compression_queue.put((conversation, conversation.context_generation, list(evicted_messages)))
+
+        if self.compression_thread is None or not self.compression_thread.is_alive():
+            self.compression_thread = threading.Thread(target=self.context_compression_worker)
+            self.compression_thread.daemon = True
+            self.compression_thread.start()
+
+    def context_compression_worker(self):
+        """后台摘要线程：只处理新移出的消息，增量更新滚动摘要"""
+        while True:
+            conversation, generation, evicted_messages = self.compression_queue.get()
+
+            # 合并排队期间同一对话新移出的消息，一次性压缩；其他对话的任务放回队列
+            pending = []
+            while True:
+                try:
+                    next_conversation, next_generation, more_messages = self.compression_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if next_conversation is not conversation:
+                    pending.append((next_conversation, next_generation, more_messages))
+                elif next_generation != generation:
+                    # 上下文已被清除，之前的消息不再需要压缩
+                    generation, evicted_messages = next_generation, more_messages
+                else:
+                    evicted_messages.extend(more_messages)
+            for item in pending:
+                self.compression_queue.put(item)
+
+            if generation != conversation.context_generation:
+                continue  # 上下文已被清除，丢弃过期任务
+
+            new_summary = self.compress_context(conversation.context_summary, evicted_messages)
+
+            with conversation.context_lock:
+                if generation != conversation.context_generation:
+                    continue
+                conversation.context_summary = new_summary
+                summary_message = {"role": "system", "content": f"{CONTEXT_SUMMARY_PREFIX}\n{new_summary}"}
+                if self.get_context_head_size(conversation) == 2:
+                    conversation.context_messages[1] = summary_message
+                else:
+                    conversation.context_messages.insert(1, summary_message)
+
+            print(f"上下文滚动摘要已更新，新增压缩 {len(evicted_messages)} 条消息")
+
+    def compress_context(self, previous_summary, evicted_messages):
+        """将新移出的消息与已有摘要合并为新的精简摘要"""
+        max_chars = self.config.get("context_summary_max_chars", 1500)
+
+        # 单条消息过长时截断，避免摘要请求本身过大
+        lines = []
+        for message in evicted_messages:
+            content = message.get("content", "")
+            if len(content) > 2000:
+                content = content[:2000] + "..."
+            lines.append(f"[{message.get('role')}] {content}")
+        new_content = "\n".join(lines)
+
+        summary_prompt = "请将“已有摘要”与“新增对话”合并为一份精简的对话摘要，"
+        summary_prompt += f"保留用户的目标、偏好、已完成的操作、创建的文件和未解决的问题，不超过{max_chars}字，只输出摘要正文。\n\n"
+        summary_prompt += f"已有摘要：\n{previous_summary or '（无）'}\n\n"
+        summary_prompt += f"新增对话：\n{new_content}"
+
+        summary = self.request_chat_completion(
+            [{"role": "user", "content": summary_prompt}],
+            temperature=0.3,
+            stage="context_summary"
+        )
+
+        if not summary:
+            # 摘要请求失败时，退化为简单拼接，保证连续性不丢失
+            summary = f"{previous_summary}\n{new_content}".strip()
+            summary = summary[-max_chars:]
+        elif len(summary) > max_chars:
+            summary = summary[:max_chars]
+
+        return summary.strip()
+
     def open_settings(self):
         """打开设置页面"""
         SettingsWindow(self)
@@ -1715,6 +4964,59 @@ class OPAIApp:
             "conversation_save_interval": 30,  # 对话保存时间（分钟）
             "memory整理_interval": 60,  # 记忆整理时间（分钟）
             "memory_similarity_threshold": 85,  # 记忆相似度阈值（百分比）
+            "context_summary_max_chars": 1500,  # 上下文滚动摘要最大字数
+            "output_digest_head_lines": 20,  # 命令输出摘要保留的开头行数
+            "output_digest_tail_lines": 20,  # 命令输出摘要保留的结尾行数
+            "output_digest_max_chars": 4000,  # 命令输出摘要最大字符数
+            "memory_evaluation_token_budget": 3000,  # 每批记忆评估提交的对话token预算
+            "api_interactive_concurrency": 2,  # 前台交互请求的最大并发数
+            "api_background_concurrency": 1,  # 后台请求（记忆评估、摘要等）的最大并发数
+            "api_requests_per_minute": 0,  # 每分钟请求上限（0表示不限制）
+            "api_max_retries": 3,  # 临时错误（429/5xx/超时）的最大重试次数
+            "api_retry_base_delay": 0.5,  # 重试退避的基础间隔（秒）
+            "api_retry_max_delay": 8,  # 重试退避的最大间隔（秒）
+            "circuit_breaker_threshold": 5,  # 端点连续失败多少次后熔断
+            "circuit_breaker_cooldown": 30,  # 熔断后暂停请求的时间（秒）
+            "api_endpoints": [],  # 附加API端点列表，每项包含name、api_url、api_key、model、weight
+            # 各阶段的模型路由设置（model、endpoint、temperature、max_tokens），留空则沿用主配置
+            # 阶段：chat（对话回复）、assessment（记忆需求评估）、memory_evaluation（记忆整理评估）、
+            #       code_fix（代码修复）、context_summary（上下文摘要）
+            "stage_overrides": {},
+            "hedge_enabled": False,  # 是否启用对冲请求（主请求迟迟无响应时向备用端点/模型再发一份）
+            "hedge_stages": ["chat"],  # 启用对冲的阶段
+            "hedge_model": "",  # 对冲使用的备用模型（留空则改用另一个端点）
+            "hedge_percentile": 90,  # 对冲延迟取首字节时间的分位数
+            "hedge_min_delay": 0.5,  # 对冲延迟下限（秒）
+            "hedge_default_delay": 8.0,  # 样本不足时的对冲延迟（秒）
+            "engine_worker_count": 8,  # 异步引擎线程池大小（阻塞的HTTP请求和命令执行共用）
+            "coalesce_queued_messages": True,  # 回复期间连续发送的多条消息是否合并为一轮
+            "live_output_max_chars": 20000,  # 命令实时输出每次刷新最多写入对话框的字符数
+            "read_file_max_chars": 20000,  # read_file单次返回的最大字符数
+            "edit_fuzzy_threshold": 0.85,  # edit_file原内容与文件不完全一致时，模糊匹配所需的最低相似度
+            "live_output_total_max_chars": 200000,  # 每个命令实时显示的输出总字符数上限
+            "output_capture_head_chars": 32768,  # 命令结果中保留的输出开头字符数（超出部分的完整输出溢出到文件）
+            "output_capture_tail_chars": 32768,  # 命令结果中保留的输出结尾字符数
+            "output_spill_max_mb": 512,  # data/Outputs中保存的输出（spill-*.txt、out-*.txt）的总大小上限（MB）
+            "command_max_parallelism": 4,  # 一次回复中互不依赖的命令最多同时执行的数量（1为按顺序执行）
+            "compile_cache_max_mb": 256,  # C/C++/Java编译缓存的大小上限（MB）
+            "build_jobs": 0,  # build命令的并行任务数（0为CPU核心数）
+            # 各类命令的超时时间（秒）和资源上限：memory_mb内存（MB）、cpu_seconds CPU时间（秒）、
+            # max_output_bytes输出字节数，0为不限制；default为默认值，可按命令类型（run_python、build等）单独覆盖。
+            # 内存和CPU上限仅在Linux/macOS上生效
+            "command_limits": {
+                "default": {"timeout": 30, "memory_mb": 4096, "cpu_seconds": 0, "max_output_bytes": 64 * 1024 * 1024},
+                "build": {"timeout": 600, "memory_mb": 0}
+            },
+            "python_warm_pool": False,  # 运行Python文件时是否使用预热进程池（仅支持fork的系统，如Linux/macOS）
+            "python_warm_pool_modules": [],  # 预热进程预先导入的模块，如["numpy", "pandas"]
+            "node_runner_daemon": False,  # 运行JavaScript文件时是否使用常驻的Node.js守护进程
+            "runner_daemon_health_check_interval": 60,  # Node.js运行器守护进程健康检查间隔（秒）
+            "server_token": "",  # 服务器模式的访问令牌（留空则每次启动随机生成）
+            "server_max_sessions": 32,  # 服务器模式最大会话数
+            "server_session_max_pending": 8,  # 每个会话最多排队的消息数，超出时返回429
+            "server_max_concurrent_turns": 16,  # 所有会话同时进行的对话轮数上限
+            "server_event_buffer": 256,  # 每个WebSocket连接缓冲的事件数，超出时断开慢速客户端
+            "endpoint_health_check_interval": 60,  # 异常端点健康检查间隔（秒）
             "system_prompt": "你是这台Windows电脑的AI助手。你的职责是：\n" +
                              "1. 首先生成一个详细的任务To Do列表\n" +
                              "2. 然后按步骤执行任务\n" +
@@ -1737,6 +5039,10 @@ class OPAIApp:
                              "    \"params\": { \"path\": \"文件路径\", \"content\": \"文件内容\" }\n" +
                              "  },\n" +
                              "  {\n" +
+                             "    \"type\": \"edit_file\",\n" +
+                             "    \"params\": { \"path\": \"文件路径\", \"edits\": [ { \"search\": \"原内容\", \"replace\": \"新内容\" } ] }\n" +
+                             "  },\n" +
+                             "  {\n" +
                              "    \"type\": \"create_folder\",\n" +
                              "    \"params\": { \"path\": \"文件夹路径\" }\n" +
                              "  },\n" +
@@ -1761,6 +5067,10 @@ class OPAIApp:
                              "    \"params\": { \"path\": \"C文件路径\" }\n" +
                              "  },\n" +
                              "  {\n" +
+                             "    \"type\": \"build\",\n" +
+                             "    \"params\": { \"path\": \"项目目录\", \"target\": \"构建目标（可选）\" }\n" +
+                             "  },\n" +
+                             "  {\n" +
                              "    \"type\": \"run_bash\",\n" +
                              "    \"params\": { \"command\": \"bash命令\" }\n" +
                              "  },\n" +
@@ -1774,20 +5084,33 @@ class OPAIApp:
                              "  },\n" +
                              "  {\n" +
                              "    \"type\": \"read_file\",\n" +
-                             "    \"params\": { \"path\": \"文件路径\" }\n" +
+                             "    \"params\": { \"path\": \"文件路径\", \"offset\": 0, \"limit\": 200 }\n" +
                              "  },\n" +
                              "  {\n" +
                              "    \"type\": \"list_dir\",\n" +
                              "    \"params\": { \"path\": \"目录路径\" }\n" +
+                             "  },\n" +
+                             "  {\n" +
+                             "    \"type\": \"read_output\",\n" +
+                             "    \"params\": { \"id\": \"输出编号\", \"offset\": 0, \"limit\": 200 }\n" +
                              "  }\n" +
                              "]\n" +
                              "```\n\n" +
+                             "命令执行结果较长时，上下文中只保留摘要（开头和结尾若干行），并附带输出编号；\n" +
+                             "如需查看完整输出，使用read_output命令按行读取（offset为起始行，limit为行数）。\n" +
+                             "read_file默认返回从offset行开始的limit行（带行号，行号不属于文件内容）；查看日志末尾用tail参数（如\"tail\": 100），\n" +
+                             "在大文件中查找用grep参数（正则表达式，context为上下文行数），按字节读取时设置\"unit\": \"bytes\"。\n" +
+                             "修改已有文件时使用edit_file命令，只发送改动的部分：edits中每项的search必须与文件中的原内容一致（包括缩进）\n" +
+                             "且在文件中唯一，replace为替换后的内容；也可以改用diff参数提供统一diff格式的补丁。\n" +
+                             "所有修改都能定位时才会一次性写入，任一处无法定位则文件保持不变。新建文件或重写大部分内容时才使用create_file。\n" +
+                             "多文件项目使用build命令构建：自动识别Makefile、CMake、Maven、Gradle、package.json并增量并行构建，\n" +
+                             "没有构建文件时按源文件增量编译，只重新编译有变化的文件。\n\n" +
                              "作为AI助手，你需要：\n" +
                              "1. 分析需求并生成To Do列表\n" +
                              "2. 按To Do 列表逐步执行任务\n" +
                              "3. 通过run_*命令测试程序\n" +
                              "4. 如果发现错误，使用read_file命令检查文件内容\n" +
-                             "5. 使用create_file命令自动修正错误\n" +
+                             "5. 使用edit_file命令自动修正错误\n" +
                              "6. 对于高危命令，请求用户确认\n" +
                              "7. 持续测试直到程序正常运行"
         }
@@ -1817,31 +5140,32 @@ class OPAIApp:
             self.config = config
 
             # 如果系统提示词被修改，更新上下文消息
-            if config.get("system_prompt") != self.context_messages[0]["content"]:
-                # 保留其他上下文消息，只更新系统消息
-                old_context = self.context_messages[1:]  # 保留除系统消息外的所有消息
-                self.context_messages = [{"role": "system", "content": config["system_prompt"]}] + old_context
+            conversations = [tab["conversation"] for tab in self.conversation_tabs.values()] or [self.main_conversation]
+            for conversation in conversations:
+                if config.get("system_prompt") != conversation.context_messages[0]["content"]:
+                    # 保留其他上下文消息，只更新系统消息
+                    with conversation.context_lock:
+                        old_context = conversation.context_messages[1:]  # 保留除系统消息外的所有消息
+                        conversation.context_messages = [{"role": "system", "content": config["system_prompt"]}] + old_context
 
-            # 如果记忆相关配置被修改，重新启动记忆整理任务
-            if (config.get("memory整理_interval") != old_config.get("memory整理_interval") or
-                config.get("conversation_save_interval") != old_config.get("conversation_save_interval")):
+            # 更新端点列表（保留已有端点的响应时间统计）
+            self.endpoint_pool.update_endpoints(self.get_configured_endpoints())
 
-                # 重新启动记忆整理任务以应用新配置
-                self.start_memory整理()
+            # 更新请求限流设置
+            self.dispatcher.rate_limiter.set_rate(config.get("api_requests_per_minute", 0))
 
-                # 重新启动对话保存任务以应用新配置
-                # 为了做到这一点，我们需要重新启动主记忆整理任务
-                # 但要确保不会重复启动，所以我们重新设置计时器
-                try:
-                    # 停止之前的定期总结任务
-                    pass  # Tkinter的after任务无法直接取消，但新设置会覆盖它
-                except:
-                    pass
+            # 熔断参数修改后，重新创建各端点的熔断器
+            if (config.get("circuit_breaker_threshold") != old_config.get("circuit_breaker_threshold") or
+                    config.get("circuit_breaker_cooldown") != old_config.get("circuit_breaker_cooldown")):
+                with self.circuit_breakers_lock:
+                    self.circuit_breakers = {}
 
-                # 重新开始定期总结任务
-                save_interval_minutes = config.get("conversation_save_interval", 30)
-                save_interval_ms = save_interval_minutes * 60 * 1000
-                self.root.after(save_interval_ms, self.create_memory_summary)
+            # 如果记忆相关配置被修改，按新的时间间隔重新安排对应的定期任务
+            if config.get("memory整理_interval") != old_config.get("memory整理_interval"):
+                self.scheduler.reschedule("memory整理", config.get("memory整理_interval", 60) * 60)
+
+            if config.get("conversation_save_interval") != old_config.get("conversation_save_interval"):
+                self.scheduler.reschedule("memory_summary", config.get("conversation_save_interval", 30) * 60)
 
             return True
         except Exception as e:
@@ -1895,36 +5219,649 @@ class OPAIApp:
                 "long_term_memory": []
             }
 
+        # 增量记忆评估状态：已评估到的对话序号及下一个可用序号
+        evaluation_state = self.memory.setdefault("memory_evaluation", {})
+        evaluation_state.setdefault("last_evaluated_seq", 0)
+        evaluation_state.setdefault("next_seq", 1)
+
         # 创建其他必要目录
         os.makedirs(self.data_dir, exist_ok=True)
         os.makedirs(self.onpython_dir, exist_ok=True)
+        os.makedirs(self.outputs_dir, exist_ok=True)
     
     def save_memory(self):
-        """保存记忆库和对话历史"""
+        """保存记忆库和对话历史（可在后台线程调用）"""
+        with self.memory_lock:
+            try:
+                # 保存短期记忆（对话历史）
+                short_term_data = {
+                    "conversation_history": self.conversation_history
+                }
+
+                with open(self.short_term_memory_file, 'w', encoding='utf-8') as f:
+                    json.dump(short_term_data, f, ensure_ascii=False, indent=2)
+
+                # 保存长期记忆
+                long_term_data = {
+                    "memory": {
+                        "programs": self.memory.get("programs", {}),
+                        "summaries": self.memory.get("summaries", []),
+                        "memory_evaluation": self.memory.get("memory_evaluation", {})
+                    },
+                    "long_term_memory": self.memory.get("long_term_memory", [])
+                }
+
+                with open(self.long_term_memory_file, 'w', encoding='utf-8') as f:
+                    json.dump(long_term_data, f, ensure_ascii=False, indent=2)
+
+                return True
+            except Exception as e:
+                # 可能在后台线程中调用，错误提示交给UI线程显示
+                error_msg = f"保存记忆库失败: {str(e)}"
+                if self.headless:
+                    print(error_msg)
+                else:
+                    self.post_to_ui(lambda: messagebox.showerror("错误", error_msg))
+                return False
+
+    async def run_batch(self, jobs, write_result, worker_count=4):
+        """无界面模式：并发处理多个独立对话，同时进行的对话数不超过worker_count"""
+        semaphore = asyncio.Semaphore(max(1, worker_count))
+
+        async def run_job(index, job):
+            async with semaphore:
+                await self.run_conversation_job(index, job, write_result)
+
+        await asyncio.gather(*(run_job(index, job) for index, job in enumerate(jobs)))
+
+    async def run_conversation_job(self, index, job, write_result):
+        """无界面模式：在一个独立对话中依次处理作业的所有提示词，每轮结果交给write_result"""
+        conversation = Conversation(self.config["system_prompt"], f"batch-{index}")
+
+        for turn, prompt in enumerate(job["prompts"], 1):
+            record = await self.run_turn(conversation, prompt)
+            write_result(dict({"id": job["id"], "turn": turn}, **record))
+
+    async def run_turn(self, conversation, prompt):
+        """无界面模式：在指定对话中处理一轮提示词，返回本轮的回复、执行的命令及结果和耗时"""
+        messages = []
+        commands = []
+
+        # 只收集属于本对话的事件
+        def collect(event):
+            if event.get("conversation_id") != conversation.conversation_id:
+                return
+            if event["type"] == "message":
+                messages.append({"sender": event["sender"], "message": event["message"]})
+                self.record_history(event["sender"], event["message"])
+            elif event["type"] == "command_result":
+                commands.append({
+                    "type": event["command"].get("type"),
+                    "params": event["command"].get("params", {}),
+                    "result": event["result"]
+                })
+
+        self.engine.subscribe(collect)
+        self.record_history("用户", prompt)
+        start_time = time.time()
+        error = None
         try:
-            # 保存短期记忆（对话历史）
-            short_term_data = {
-                "conversation_history": self.conversation_history
-            }
+            await self.get_ai_response(prompt, conversation)
+        except Exception as e:
+            error = str(e)
+        finally:
+            self.engine.unsubscribe(collect)
+
+        return {
+            "prompt": prompt,
+            "messages": messages,
+            "commands": commands,
+            "elapsed": round(time.time() - start_time, 3),
+            "error": error
+        }
 
-            with open(self.short_term_memory_file, 'w', encoding='utf-8') as f:
-                json.dump(short_term_data, f, ensure_ascii=False, indent=2)
 
-            # 保存长期记忆
-            long_term_data = {
-                "memory": {
-                    "programs": self.memory.get("programs", {}),
-                    "summaries": self.memory.get("summaries", [])
-                },
-                "long_term_memory": self.memory.get("long_term_memory", [])
-            }
+def read_headless_jobs(lines):
+    """解析无界面模式的输入：每行一个JSON对象 {"id": ..., "prompt": ...} 或 {"id": ..., "prompts": [...]}，
+    也可以是纯文本（整行作为一个提示词）
+    """
+    jobs = []
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError:
+            item = line
+
+        if isinstance(item, str):
+            item = {"prompt": item}
+        if not isinstance(item, dict):
+            print(f"第 {line_number} 行格式不正确，已跳过")
+            continue
+
+        prompts = item.get("prompts") or ([item["prompt"]] if item.get("prompt") else [])
+        if not prompts:
+            print(f"第 {line_number} 行没有提示词，已跳过")
+            continue
+        jobs.append({"id": item.get("id", line_number), "prompts": [str(prompt) for prompt in prompts]})
+    return jobs
+
+
+def run_headless(args):
+    """无界面模式入口：读取提示词，并发处理多个独立对话，结果逐轮写入JSONL"""
+    import sys
+    import contextlib
+
+    result_file = sys.stdout if args.output == "-" else open(args.output, 'w', encoding='utf-8')
+    write_lock = threading.Lock()
+    turn_count = 0
+
+    def write_result(record):
+        nonlocal turn_count
+        with write_lock:
+            result_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            result_file.flush()
+            turn_count += 1
+
+    # 调试输出统一写到标准错误，标准输出只保留结果
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.input == "-":
+            jobs = read_headless_jobs(sys.stdin)
+        else:
+            with open(args.input, 'r', encoding='utf-8') as f:
+                jobs = read_headless_jobs(f)
+
+        app = OPAIApp(None)
+        if not app.is_api_configured():
+            print("错误：请先在config.json中配置API URL、API Key和模型名称！")
+            return 1
+
+        start_time = time.time()
+        try:
+            app.engine.submit(app.run_batch(jobs, write_result, args.workers)).result()
+        finally:
+            if result_file is not sys.stdout:
+                result_file.close()
+
+        if not args.no_save:
+            app.save_memory()
+
+        elapsed = time.time() - start_time
+        print(f"完成 {len(jobs)} 个对话、{turn_count} 轮，用时 {elapsed:.2f} 秒"
+              f"（{turn_count / elapsed if elapsed > 0 else 0:.2f} 轮/秒，并发数 {args.workers}）")
+    return 0
+
+
+class WebSocketConnection:
+    """最简WebSocket连接（RFC 6455）：服务器端收发文本帧，处理ping/close，不支持分片消息"""
+    GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+    MAX_MESSAGE_SIZE = 1024 * 1024
+
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.send_lock = threading.Lock()
+        self.closed = False
+
+    @staticmethod
+    def accept_key(client_key):
+        """根据客户端的Sec-WebSocket-Key计算握手应答"""
+        import base64
+        import hashlib
+        digest = hashlib.sha1((client_key + WebSocketConnection.GUID).encode("ascii")).digest()
+        return base64.b64encode(digest).decode("ascii")
+
+    def send_frame(self, opcode, payload):
+        """发送一帧（服务器发出的帧不加掩码）"""
+        import struct
+        header = bytes([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header += bytes([length])
+        elif length < 65536:
+            header += bytes([126]) + struct.pack(">H", length)
+        else:
+            header += bytes([127]) + struct.pack(">Q", length)
 
-            with open(self.long_term_memory_file, 'w', encoding='utf-8') as f:
-                json.dump(long_term_data, f, ensure_ascii=False, indent=2)
+        with self.send_lock:
+            if self.closed:
+                return
+            self.wfile.write(header + payload)
+            self.wfile.flush()
 
+    def send_text(self, text):
+        """发送文本消息"""
+        self.send_frame(0x1, text.encode("utf-8"))
+
+    def close(self, code=1000, reason=""):
+        """发送关闭帧"""
+        import struct
+        try:
+            self.send_frame(0x8, struct.pack(">H", code) + reason.encode("utf-8"))
+        except OSError:
+            pass
+        self.closed = True
+
+    def read_exact(self, size):
+        """读取指定字节数，连接断开时返回None"""
+        data = self.rfile.read(size)
+        if data is None or len(data) < size:
+            return None
+        return data
+
+    def receive(self):
+        """读取下一条文本消息；连接关闭时返回None（ping自动应答）"""
+        import struct
+        while not self.closed:
+            header = self.read_exact(2)
+            if header is None:
+                return None
+            fin, opcode = header[0] & 0x80, header[0] & 0x0F
+            masked, length = header[1] & 0x80, header[1] & 0x7F
+            if length == 126:
+                extended = self.read_exact(2)
+                length = struct.unpack(">H", extended)[0] if extended else 0
+            elif length == 127:
+                extended = self.read_exact(8)
+                length = struct.unpack(">Q", extended)[0] if extended else 0
+            if length > self.MAX_MESSAGE_SIZE:
+                self.close(1009, "message too big")
+                return None
+
+            mask = self.read_exact(4) if masked else b""
+            payload = self.read_exact(length) if length else b""
+            if payload is None or mask is None:
+                return None
+            if masked:
+                payload = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+
+            if opcode == 0x8:  # 关闭
+                self.close()
+                return None
+            if opcode == 0x9:  # ping
+                self.send_frame(0xA, payload)
+                continue
+            if opcode == 0xA:  # pong
+                continue
+            if not fin or opcode == 0x0:
+                self.close(1003, "fragmented messages are not supported")
+                return None
+            if opcode == 0x1:
+                return payload.decode("utf-8", errors="replace")
+            # 其他类型（二进制等）忽略
+
+
+class EventSubscriber:
+    """会话事件订阅者（一个WebSocket连接）：事件先进入有界队列，客户端消费过慢时断开连接"""
+    def __init__(self, max_buffered):
+        self.events = queue.Queue(maxsize=max_buffered)
+        self.overflowed = threading.Event()
+
+
+class ServerSession:
+    """服务器模式下的会话：独立的对话上下文，待处理消息数有上限（背压）"""
+    def __init__(self, session_id, system_prompt, max_pending):
+        self.session_id = session_id
+        self.conversation = Conversation(system_prompt, session_id)
+        self.max_pending = max_pending
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.turn_lock = None  # asyncio.Lock，保证同一会话的各轮按顺序执行（在引擎事件循环中创建）
+        self.turn_counter = itertools.count(1)
+        self.subscribers = []
+        self.created_at = time.time()
+
+    def try_reserve(self):
+        """为一条新消息占用待处理名额，已满时返回False"""
+        with self.lock:
+            if self.pending >= self.max_pending:
+                return False
+            self.pending += 1
             return True
-        except Exception as e:
-            messagebox.showerror("错误", f"保存记忆库失败: {str(e)}")
+
+    def release(self):
+        """一轮处理完成后释放待处理名额"""
+        with self.lock:
+            self.pending -= 1
+
+    def add_subscriber(self, max_buffered):
+        """新增事件订阅者"""
+        subscriber = EventSubscriber(max_buffered)
+        with self.lock:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def remove_subscriber(self, subscriber):
+        """移除事件订阅者"""
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def deliver(self, event):
+        """把事件推送给所有订阅者；订阅者缓冲区已满时标记溢出并移除"""
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.events.put_nowait(event)
+            except queue.Full:
+                subscriber.overflowed.set()
+                self.remove_subscriber(subscriber)
+
+
+class SessionServer:
+    """本地服务器的会话管理：各会话上下文独立，共享引擎、记忆库、连接池和缓存"""
+    def __init__(self, app, token):
+        self.app = app
+        self.token = token
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.turn_semaphore = None  # 全局同时进行的轮数上限（在引擎事件循环中创建）
+        self.stats = {"turns": 0, "rejected": 0, "total_elapsed": 0.0}
+        self.stats_lock = threading.Lock()
+        app.engine.subscribe(self.route_event)
+
+    def create_session(self):
+        """创建会话，会话数已达上限时返回None"""
+        import uuid
+        with self.sessions_lock:
+            if len(self.sessions) >= self.app.config.get("server_max_sessions", 32):
+                return None
+            session_id = f"s-{uuid.uuid4().hex[:12]}"
+            session = ServerSession(
+                session_id,
+                self.app.config["system_prompt"],
+                self.app.config.get("server_session_max_pending", 8)
+            )
+            self.sessions[session_id] = session
+            return session
+
+    def get_session(self, session_id):
+        """按编号查找会话"""
+        with self.sessions_lock:
+            return self.sessions.get(session_id)
+
+    def delete_session(self, session_id):
+        """删除会话，返回是否存在"""
+        with self.sessions_lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def route_event(self, event):
+        """把引擎事件转发给所属会话的订阅者"""
+        session = self.get_session(event.get("conversation_id"))
+        if session is not None:
+            session.deliver(event)
+
+    def submit_turn(self, session, message):
+        """提交一条消息；待处理消息已满时返回None（客户端应稍后重试），否则返回(轮次编号, Future)"""
+        if not session.try_reserve():
+            with self.stats_lock:
+                self.stats["rejected"] += 1
+            return None
+        turn_id = next(session.turn_counter)
+        return turn_id, self.app.engine.submit(self.run_session_turn(session, turn_id, message))
+
+    async def run_session_turn(self, session, turn_id, message):
+        """在引擎中执行一轮：同一会话按顺序执行，不同会话并发执行（受全局上限约束）"""
+        if session.turn_lock is None:
+            session.turn_lock = asyncio.Lock()
+        if self.turn_semaphore is None:
+            self.turn_semaphore = asyncio.Semaphore(self.app.config.get("server_max_concurrent_turns", 16))
+
+        try:
+            async with session.turn_lock:
+                async with self.turn_semaphore:
+                    record = await self.app.run_turn(session.conversation, message)
+        finally:
+            session.release()
+
+        record["turn_id"] = turn_id
+        with self.stats_lock:
+            self.stats["turns"] += 1
+            self.stats["total_elapsed"] += record["elapsed"]
+        session.deliver(dict(record, type="turn_result", conversation_id=session.session_id))
+        return record
+
+    def describe(self):
+        """服务器状态（/health）"""
+        with self.sessions_lock:
+            sessions = list(self.sessions.values())
+        with self.stats_lock:
+            stats = dict(self.stats)
+        with self.app.hedge_lock:
+            hedge_stats = dict(self.app.hedge_stats)
+        return {
+            "status": "ok",
+            "sessions": len(sessions),
+            "pending_turns": sum(session.pending for session in sessions),
+            "turns": stats["turns"],
+            "rejected": stats["rejected"],
+            "average_turn_seconds": round(stats["total_elapsed"] / stats["turns"], 3) if stats["turns"] else None,
+            "hedge_stats": hedge_stats
+        }
+
+
+class OPAIRequestHandler(BaseHTTPRequestHandler):
+    """服务器模式的HTTP/WebSocket请求处理"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        print(f"[服务器] {self.address_string()} {format % args}")
+
+    @property
+    def session_server(self):
+        return self.server.session_server
+
+    def send_json(self, status, data, headers=None):
+        """返回JSON响应"""
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        """读取JSON请求体，格式不正确时返回None"""
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > WebSocketConnection.MAX_MESSAGE_SIZE:
+            return None
+        try:
+            data = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+    def parse_path(self):
+        """拆分路径与查询参数"""
+        from urllib.parse import urlsplit, parse_qs
+        parts = urlsplit(self.path)
+        segments = [segment for segment in parts.path.split("/") if segment]
+        return segments, {key: values[-1] for key, values in parse_qs(parts.query).items()}
+
+    def authorized(self, query):
+        """校验访问令牌（请求头Authorization: Bearer或查询参数token）"""
+        import hmac
+        token = query.get("token", "")
+        authorization = self.headers.get("Authorization", "")
+        if authorization.startswith("Bearer "):
+            token = authorization[len("Bearer "):]
+        # 按字节比较：compare_digest对含非ASCII字符的str会抛出TypeError
+        if hmac.compare_digest(token.encode("utf-8"), self.session_server.token.encode("utf-8")):
+            return True
+        self.send_json(401, {"error": "unauthorized"})
+        return False
+
+    def do_GET(self):
+        segments, query = self.parse_path()
+        if segments == ["health"]:
+            self.send_json(200, self.session_server.describe())
+            return
+        if not self.authorized(query):
+            return
+
+        if segments == ["sessions"]:
+            with self.session_server.sessions_lock:
+                sessions = list(self.session_server.sessions.values())
+            self.send_json(200, [
+                {"session_id": session.session_id, "pending": session.pending, "created_at": session.created_at}
+                for session in sessions
+            ])
+        elif len(segments) == 3 and segments[0] == "sessions" and segments[2] == "events":
+            session = self.session_server.get_session(segments[1])
+            if session is None:
+                self.send_json(404, {"error": "session not found"})
+            elif self.headers.get("Upgrade", "").lower() != "websocket":
+                self.send_json(426, {"error": "websocket upgrade required"})
+            else:
+                self.handle_websocket(session)
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        segments, query = self.parse_path()
+        if not self.authorized(query):
+            return
+
+        if segments == ["sessions"]:
+            session = self.session_server.create_session()
+            if session is None:
+                self.send_json(503, {"error": "too many sessions"})
+            else:
+                self.send_json(201, {"session_id": session.session_id})
+        elif len(segments) == 3 and segments[0] == "sessions" and segments[2] == "messages":
+            session = self.session_server.get_session(segments[1])
+            data = self.read_json()
+            if session is None:
+                self.send_json(404, {"error": "session not found"})
+            elif not data or not str(data.get("message", "")).strip():
+                self.send_json(400, {"error": "message is required"})
+            else:
+                submitted = self.session_server.submit_turn(session, str(data["message"]))
+                if submitted is None:
+                    # 背压：该会话待处理消息已满
+                    self.send_json(429, {"error": "too many pending messages"}, {"Retry-After": "1"})
+                    return
+                turn_id, future = submitted
+                if data.get("wait", True):
+                    self.send_json(200, future.result())
+                else:
+                    self.send_json(202, {"turn_id": turn_id})
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_DELETE(self):
+        segments, query = self.parse_path()
+        if not self.authorized(query):
+            return
+        if len(segments) == 2 and segments[0] == "sessions" and self.session_server.delete_session(segments[1]):
+            self.send_json(200, {"deleted": segments[1]})
+        else:
+            self.send_json(404, {"error": "session not found"})
+
+    def handle_websocket(self, session):
+        """WebSocket事件流：推送会话事件，客户端可发送 {"message": "..."} 提交消息"""
+        client_key = self.headers.get("Sec-WebSocket-Key", "")
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", WebSocketConnection.accept_key(client_key))
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+        connection = WebSocketConnection(self.rfile, self.wfile)
+        subscriber = session.add_subscriber(self.session_server.app.config.get("server_event_buffer", 256))
+
+        def pump_events():
+            # 独立线程把事件写给客户端，读取客户端消息不会被慢速发送阻塞
+            while not connection.closed:
+                if subscriber.overflowed.is_set():
+                    connection.close(1008, "client too slow")
+                    return
+                try:
+                    event = subscriber.events.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                try:
+                    connection.send_text(json.dumps(event, ensure_ascii=False, default=str))
+                except OSError:
+                    connection.closed = True
+
+        def reply(event):
+            # 不能阻塞读取客户端消息的线程：缓冲区已满说明客户端消费过慢，与推送事件时一样断开连接
+            try:
+                subscriber.events.put_nowait(event)
+                return True
+            except queue.Full:
+                subscriber.overflowed.set()
+                connection.close(1008, "client too slow")
+                return False
+
+        sender = threading.Thread(target=pump_events, name=f"OPAI-WS-{session.session_id}")
+        sender.daemon = True
+        sender.start()
+
+        try:
+            while True:
+                text = connection.receive()
+                if text is None:
+                    break
+                try:
+                    message = str(json.loads(text).get("message", "")).strip()
+                except (ValueError, AttributeError):
+                    message = ""
+                if not message:
+                    event = {"type": "error", "error": "message is required"}
+                else:
+                    submitted = self.session_server.submit_turn(session, message)
+                    if submitted is None:
+                        event = {"type": "rejected", "error": "too many pending messages"}
+                    else:
+                        event = {"type": "accepted", "turn_id": submitted[0]}
+                if not reply(event):
+                    break
+        except OSError:
+            pass
+        finally:
+            connection.closed = True
+            session.remove_subscriber(subscriber)
+            sender.join(timeout=1)
+
+
+def run_server(args):
+    """服务器模式入口：在本机提供HTTP/WebSocket接口，多个客户端共享同一个OPAI进程"""
+    import secrets
+
+    app = OPAIApp(None)
+    if not app.is_api_configured():
+        print("错误：请先在config.json中配置API URL、API Key和模型名称！")
+        return 1
+
+    token = app.config.get("server_token") or secrets.token_urlsafe(16)
+    httpd = ThreadingHTTPServer((args.host, args.port), OPAIRequestHandler)
+    httpd.daemon_threads = True
+    httpd.session_server = SessionServer(app, token)
+
+    # 定期总结对话和整理记忆（与界面模式相同的后台任务）
+    app.start_memory_summarization()
+
+    print(f"OPAI服务器已启动: http://{args.host}:{httpd.server_port}")
+    print(f"访问令牌: {token}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        app.save_memory()
+        print("OPAI服务器已停止")
+    return 0
+
 
 class InstallConfirmWindow:
     """安装确认窗口"""
@@ -2055,7 +5992,7 @@ class SettingsWindow:
         self.app = app
         self.window = tk.Toplevel(app.root)
         self.window.title("设置")
-        self.window.geometry("500x400")
+        self.window.geometry("600x520")
         self.window.resizable(False, False)
         
         # 模态窗口 - 阻止主窗口交互
@@ -2089,6 +6026,95 @@ class SettingsWindow:
         self.model_entry = ttk.Entry(api_frame, textvariable=self.model_var, width=50)
         self.model_entry.grid(row=2, column=1, padx=10, pady=10)
 
+        ttk.Label(api_frame, text="每分钟请求上限:").grid(row=3, column=0, sticky=tk.W, padx=10, pady=10)
+        self.api_requests_per_minute_var = tk.StringVar(value=str(self.app.config.get("api_requests_per_minute", 0)))
+        rate_frame = ttk.Frame(api_frame)
+        rate_frame.grid(row=3, column=1, sticky=tk.W, padx=10, pady=10)
+        tk.Spinbox(rate_frame, from_=0, to=10000, textvariable=self.api_requests_per_minute_var, width=10).pack(side=tk.LEFT)
+        ttk.Label(rate_frame, text="次 (0表示不限制)").pack(side=tk.LEFT, padx=5)
+
+        ttk.Label(api_frame, text="失败重试次数:").grid(row=4, column=0, sticky=tk.W, padx=10, pady=10)
+        self.api_max_retries_var = tk.StringVar(value=str(self.app.config.get("api_max_retries", 3)))
+        retry_frame = ttk.Frame(api_frame)
+        retry_frame.grid(row=4, column=1, sticky=tk.W, padx=10, pady=10)
+        tk.Spinbox(retry_frame, from_=0, to=10, textvariable=self.api_max_retries_var, width=10).pack(side=tk.LEFT)
+        ttk.Label(retry_frame, text="次 (429、5xx和超时时自动重试)").pack(side=tk.LEFT, padx=5)
+
+        ttk.Label(api_frame, text="熔断阈值:").grid(row=5, column=0, sticky=tk.W, padx=10, pady=10)
+        self.circuit_breaker_threshold_var = tk.StringVar(value=str(self.app.config.get("circuit_breaker_threshold", 5)))
+        breaker_frame = ttk.Frame(api_frame)
+        breaker_frame.grid(row=5, column=1, sticky=tk.W, padx=10, pady=10)
+        tk.Spinbox(breaker_frame, from_=1, to=100, textvariable=self.circuit_breaker_threshold_var, width=10).pack(side=tk.LEFT)
+        ttk.Label(breaker_frame, text="次连续失败后暂停请求").pack(side=tk.LEFT, padx=5)
+
+        ttk.Label(api_frame, text="熔断冷却时间:").grid(row=6, column=0, sticky=tk.W, padx=10, pady=10)
+        self.circuit_breaker_cooldown_var = tk.StringVar(value=str(self.app.config.get("circuit_breaker_cooldown", 30)))
+        cooldown_frame = ttk.Frame(api_frame)
+        cooldown_frame.grid(row=6, column=1, sticky=tk.W, padx=10, pady=10)
+        tk.Spinbox(cooldown_frame, from_=1, to=3600, textvariable=self.circuit_breaker_cooldown_var, width=10).pack(side=tk.LEFT)
+        ttk.Label(cooldown_frame, text="秒").pack(side=tk.LEFT, padx=5)
+
+        # 多端点设置页面
+        endpoints_frame = ttk.Frame(notebook)
+        notebook.add(endpoints_frame, text="端点设置")
+
+        ttk.Label(
+            endpoints_frame,
+            text="附加API端点（JSON列表，每项包含 name、api_url、api_key、model、weight）：\n"
+                 "请求会按权重和响应时间在健康端点间分配，端点异常时自动切换。",
+            justify=tk.LEFT
+        ).pack(anchor=tk.W, padx=10, pady=(10, 0))
+        self.api_endpoints_text = tk.Text(endpoints_frame, height=15, width=60)
+        self.api_endpoints_text.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        self.api_endpoints_text.insert("1.0", json.dumps(self.app.config.get("api_endpoints", []), ensure_ascii=False, indent=2))
+
+        # 模型路由设置页面
+        routing_frame = ttk.Frame(notebook)
+        notebook.add(routing_frame, text="模型路由")
+
+        ttk.Label(routing_frame, text="为各阶段单独指定模型、端点、温度和最大token数，留空则沿用主配置：").grid(
+            row=0, column=0, columnspan=5, sticky=tk.W, padx=10, pady=(10, 5))
+        for column, title in enumerate(["阶段", "模型", "端点", "温度", "最大token"]):
+            ttk.Label(routing_frame, text=title).grid(row=1, column=column, sticky=tk.W, padx=5, pady=5)
+
+        endpoint_names = [endpoint["name"] for endpoint in self.app.get_configured_endpoints()]
+        stage_overrides = self.app.config.get("stage_overrides", {})
+        self.stage_override_vars = {}
+        for row, (stage, title) in enumerate(STAGE_TITLES.items(), start=2):
+            override = stage_overrides.get(stage, {})
+            stage_vars = {
+                "model": tk.StringVar(value=override.get("model", "")),
+                "endpoint": tk.StringVar(value=override.get("endpoint", "")),
+                "temperature": tk.StringVar(value="" if override.get("temperature") is None else str(override["temperature"])),
+                "max_tokens": tk.StringVar(value=str(override.get("max_tokens") or ""))
+            }
+            self.stage_override_vars[stage] = stage_vars
+
+            ttk.Label(routing_frame, text=f"{title}:").grid(row=row, column=0, sticky=tk.W, padx=5, pady=5)
+            ttk.Entry(routing_frame, textvariable=stage_vars["model"], width=18).grid(row=row, column=1, padx=5, pady=5)
+            ttk.Combobox(routing_frame, textvariable=stage_vars["endpoint"], values=[""] + endpoint_names, width=10).grid(row=row, column=2, padx=5, pady=5)
+            ttk.Entry(routing_frame, textvariable=stage_vars["temperature"], width=6).grid(row=row, column=3, padx=5, pady=5)
+            ttk.Entry(routing_frame, textvariable=stage_vars["max_tokens"], width=8).grid(row=row, column=4, padx=5, pady=5)
+
+        # 对冲请求设置
+        hedge_row = len(STAGE_TITLES) + 2
+        self.hedge_enabled_var = tk.BooleanVar(value=self.app.config.get("hedge_enabled", False))
+        ttk.Checkbutton(routing_frame, text="对话回复启用对冲请求", variable=self.hedge_enabled_var).grid(
+            row=hedge_row, column=0, columnspan=2, sticky=tk.W, padx=5, pady=(15, 5))
+        ttk.Label(routing_frame, text="备用模型:").grid(row=hedge_row + 1, column=0, sticky=tk.W, padx=5, pady=5)
+        self.hedge_model_var = tk.StringVar(value=self.app.config.get("hedge_model", ""))
+        ttk.Entry(routing_frame, textvariable=self.hedge_model_var, width=18).grid(row=hedge_row + 1, column=1, padx=5, pady=5)
+        ttk.Label(routing_frame, text="(留空则改用另一个端点)").grid(row=hedge_row + 1, column=2, columnspan=3, sticky=tk.W, padx=5, pady=5)
+        ttk.Label(routing_frame, text="延迟分位数:").grid(row=hedge_row + 2, column=0, sticky=tk.W, padx=5, pady=5)
+        self.hedge_percentile_var = tk.StringVar(value=str(self.app.config.get("hedge_percentile", 90)))
+        tk.Spinbox(routing_frame, from_=50, to=99, textvariable=self.hedge_percentile_var, width=6).grid(row=hedge_row + 2, column=1, sticky=tk.W, padx=5, pady=5)
+
+        hedge_stats = self.app.hedge_stats
+        ttk.Label(
+            routing_frame,
+            text=f"对冲统计: 共 {hedge_stats['requests']} 次请求，触发对冲 {hedge_stats['hedged']} 次，备用请求胜出 {hedge_stats['wins']} 次"
+        ).grid(row=hedge_row + 3, column=0, columnspan=5, sticky=tk.W, padx=5, pady=5)
+
         # 对话设置页面
         conversation_frame = ttk.Frame(notebook)
         notebook.add(conversation_frame, text="对话设置")
@@ -2099,6 +6125,37 @@ class SettingsWindow:
         self.conversation_save_interval_spinbox.grid(row=0, column=1, sticky=tk.W, padx=10, pady=10)
         ttk.Label(conversation_frame, text="分钟 (范围: 1-1440，即1分钟到24小时)").grid(row=0, column=2, sticky=tk.W, padx=5, pady=10)
 
+        self.coalesce_queued_messages_var = tk.BooleanVar(value=self.app.config.get("coalesce_queued_messages", True))
+        ttk.Checkbutton(
+            conversation_frame,
+            text="回复期间连续发送的多条消息合并为一轮发送",
+            variable=self.coalesce_queued_messages_var
+        ).grid(row=1, column=0, columnspan=3, sticky=tk.W, padx=10, pady=10)
+
+        ttk.Label(conversation_frame, text="命令最大并行数:").grid(row=2, column=0, sticky=tk.W, padx=10, pady=10)
+        self.command_max_parallelism_var = tk.StringVar(value=str(self.app.config.get("command_max_parallelism", 4)))
+        tk.Spinbox(conversation_frame, from_=1, to=16, textvariable=self.command_max_parallelism_var, width=10).grid(row=2, column=1, sticky=tk.W, padx=10, pady=10)
+        ttk.Label(conversation_frame, text="(互不依赖的命令同时执行，1为按顺序执行)").grid(row=2, column=2, sticky=tk.W, padx=5, pady=10)
+
+        self.python_warm_pool_var = tk.BooleanVar(value=self.app.config.get("python_warm_pool", False))
+        ttk.Checkbutton(
+            conversation_frame,
+            text="运行Python文件时使用预热进程池（仅Linux/macOS）",
+            variable=self.python_warm_pool_var
+        ).grid(row=3, column=0, columnspan=3, sticky=tk.W, padx=10, pady=10)
+
+        ttk.Label(conversation_frame, text="预先导入的模块:").grid(row=4, column=0, sticky=tk.W, padx=10, pady=10)
+        self.python_warm_pool_modules_var = tk.StringVar(value=", ".join(self.app.config.get("python_warm_pool_modules", [])))
+        ttk.Entry(conversation_frame, textvariable=self.python_warm_pool_modules_var, width=30).grid(row=4, column=1, sticky=tk.W, padx=10, pady=10)
+        ttk.Label(conversation_frame, text="(用逗号分隔，如 numpy, pandas)").grid(row=4, column=2, sticky=tk.W, padx=5, pady=10)
+
+        self.node_runner_daemon_var = tk.BooleanVar(value=self.app.config.get("node_runner_daemon", False))
+        ttk.Checkbutton(
+            conversation_frame,
+            text="运行JavaScript文件时使用常驻的Node.js进程",
+            variable=self.node_runner_daemon_var
+        ).grid(row=5, column=0, columnspan=3, sticky=tk.W, padx=10, pady=10)
+
         # 记忆库设置页面
         memory_frame = ttk.Frame(notebook)
         notebook.add(memory_frame, text="记忆库设置")
@@ -2115,6 +6172,10 @@ class SettingsWindow:
         self.memory_similarity_threshold_spinbox.grid(row=1, column=1, sticky=tk.W, padx=10, pady=10)
         ttk.Label(memory_frame, text="% (范围: 1-100)").grid(row=1, column=2, sticky=tk.W, padx=5, pady=10)
 
+        # 后台定期任务运行状态
+        ttk.Label(memory_frame, text="后台任务状态:").grid(row=2, column=0, sticky=tk.NW, padx=10, pady=10)
+        ttk.Label(memory_frame, text=self.describe_job_metrics(), justify=tk.LEFT).grid(row=2, column=1, columnspan=2, sticky=tk.W, padx=10, pady=10)
+
         # 系统提示词设置页面
         prompt_frame = ttk.Frame(notebook)
         notebook.add(prompt_frame, text="提示词设置")
@@ -2172,11 +6233,56 @@ class SettingsWindow:
         )
         cancel_button.pack(side=tk.RIGHT)
     
+    def describe_job_metrics(self):
+        """生成后台定期任务运行统计的文本描述"""
+        job_titles = {"memory_summary": "记忆库总结", "memory整理": "记忆整理", "endpoint_health_check": "端点健康检查"}
+        lines = []
+        for name, metrics in self.app.scheduler.get_metrics().items():
+            next_run = datetime.fromtimestamp(metrics["next_run"]).strftime("%H:%M:%S")
+            if metrics["last_duration"] is None:
+                last_duration = "尚未运行"
+            else:
+                last_duration = f"{metrics['last_duration']:.1f}秒"
+            status = "运行中" if metrics["running"] else f"下次 {next_run}"
+            lines.append(f"{job_titles.get(name, name)}: {status}，上次耗时 {last_duration}，"
+                         f"失败 {metrics['failures']} 次，跳过 {metrics['skipped']} 次")
+        return "\n".join(lines) if lines else "暂无定期任务"
+
     def save_settings(self):
         """保存设置"""
         # 获取系统提示词
         system_prompt = self.system_prompt_text.get("1.0", tk.END).strip()
 
+        # 解析附加API端点
+        try:
+            api_endpoints = json.loads(self.api_endpoints_text.get("1.0", tk.END).strip() or "[]")
+            if not isinstance(api_endpoints, list):
+                raise ValueError("必须是JSON列表")
+        except ValueError as e:
+            messagebox.showerror("错误", f"附加API端点格式不正确: {str(e)}")
+            return
+
+        # 解析各阶段的模型路由设置
+        stage_overrides = {}
+        try:
+            for stage, stage_vars in self.stage_override_vars.items():
+                override = {
+                    "model": stage_vars["model"].get().strip(),
+                    "endpoint": stage_vars["endpoint"].get().strip()
+                }
+                temperature = stage_vars["temperature"].get().strip()
+                max_tokens = stage_vars["max_tokens"].get().strip()
+                if temperature:
+                    override["temperature"] = float(temperature)
+                if max_tokens:
+                    override["max_tokens"] = int(max_tokens)
+                override = {key: value for key, value in override.items() if value != ""}
+                if override:
+                    stage_overrides[stage] = override
+        except ValueError:
+            messagebox.showerror("错误", f"{STAGE_TITLES[stage]}的温度或最大token数格式不正确")
+            return
+
         # 检测系统主题（如果启用自动检测）
         dark_theme = self.dark_theme_var.get()
         auto_detect_theme = self.auto_detect_theme_var.get()
@@ -2185,18 +6291,33 @@ class SettingsWindow:
             # 根据系统主题自动设置
             dark_theme = self.app.detect_system_theme()
 
-        # 创建新的配置字典
-        new_config = {
+        # 创建新的配置字典（在现有配置基础上更新，保留设置页面未涉及的配置项）
+        new_config = dict(self.app.config)
+        new_config.update({
             "api_url": self.api_url_var.get(),
             "api_key": self.api_key_var.get(),
             "model": self.model_var.get(),
+            "api_requests_per_minute": int(self.api_requests_per_minute_var.get()),
+            "api_endpoints": api_endpoints,
+            "stage_overrides": stage_overrides,
+            "hedge_enabled": self.hedge_enabled_var.get(),
+            "hedge_model": self.hedge_model_var.get().strip(),
+            "hedge_percentile": int(self.hedge_percentile_var.get()),
+            "api_max_retries": int(self.api_max_retries_var.get()),
+            "circuit_breaker_threshold": int(self.circuit_breaker_threshold_var.get()),
+            "circuit_breaker_cooldown": int(self.circuit_breaker_cooldown_var.get()),
             "conversation_save_interval": int(self.conversation_save_interval_var.get()),
+            "coalesce_queued_messages": self.coalesce_queued_messages_var.get(),
+            "command_max_parallelism": int(self.command_max_parallelism_var.get()),
+            "python_warm_pool": self.python_warm_pool_var.get(),
+            "python_warm_pool_modules": [name.strip() for name in self.python_warm_pool_modules_var.get().split(",") if name.strip()],
+            "node_runner_daemon": self.node_runner_daemon_var.get(),
             "memory整理_interval": int(self.memory整理_interval_var.get()),
             "memory_similarity_threshold": int(self.memory_similarity_threshold_var.get()),
             "system_prompt": system_prompt,
             "dark_theme": dark_theme,
             "auto_detect_theme": auto_detect_theme
-        }
+        })
 
         # 保存配置
         if self.app.save_config(new_config):
@@ -2208,6 +6329,25 @@ class SettingsWindow:
 
 
 if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="OnPython AI (OPAI)")
+    parser.add_argument("--headless", action="store_true", help="无界面模式：从JSONL文件或标准输入读取提示词并批量处理")
+    parser.add_argument("--input", default="-", help="输入JSONL文件（默认为标准输入）")
+    parser.add_argument("--output", default="-", help="结果JSONL文件（默认为标准输出）")
+    parser.add_argument("--workers", type=int, default=4, help="同时处理的对话数")
+    parser.add_argument("--no-save", action="store_true", help="不把批处理的对话写入记忆库")
+    parser.add_argument("--serve", action="store_true", help="服务器模式：在本机提供HTTP/WebSocket会话接口")
+    parser.add_argument("--host", default="127.0.0.1", help="服务器监听地址")
+    parser.add_argument("--port", type=int, default=8765, help="服务器监听端口")
+    args = parser.parse_args()
+
+    if args.headless:
+        sys.exit(run_headless(args))
+    if args.serve:
+        sys.exit(run_server(args))
+
     try:
         print("正在启动OnPython AI (OPAI)...")
         root = tk.Tk()